@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Measure how long it takes to find the plans a user can see, which is what
+# GET /plans?email= does for the plan dropdown.
+#
+# A scratch database is seeded with plans, sites that carry some of those
+# plans and groups of sites and users. The plans of a user are then looked
+# up the way the API used to, with queries per plan and per site, and from
+# the ACL index, both right after the index was rebuilt and when it is up
+# to date.
+#
+#  python benchmarks/plans_by_email.py --plans 50 --sites 5000
+#
+
+import optparse
+import random
+import time
+
+from pymongo import ASCENDING, MongoClient
+
+from minion.backend import acl
+
+def seed(db, options):
+    for name in ('plans', 'sites', 'groups', 'users', 'counters'):
+        db[name].drop()
+    db.sites.create_index([('plans', ASCENDING)])
+    db.groups.create_index([('users', ASCENDING)])
+    db.groups.create_index([('sites', ASCENDING)])
+
+    random.seed(options.seed)
+    plan_names = ["plan-%d" % n for n in range(options.plans)]
+    db.plans.insert([{"name": name, "description": name, "workflow": []} for name in plan_names])
+    urls = ["https://site-%d.example.com" % n for n in range(options.sites)]
+    db.sites.insert([{"url": url, "plans": random.sample(plan_names, options.plans_per_site)} for url in urls])
+    emails = ["user-%d@example.com" % n for n in range(options.users)]
+    db.users.insert([{"email": email, "role": "user"} for email in emails])
+    for n in range(options.groups):
+        db.groups.insert({"name": "group-%d" % n,
+                          "sites": random.sample(urls, options.sites_per_group),
+                          "users": random.sample(emails, options.users_per_group)})
+    acl.bump_version(db.counters)
+    return emails
+
+def per_plan_queries(db, email):
+    """ The plans of the user as the API used to find them. """
+    matched = []
+    for plan in db.plans.find():
+        sitez = db.sites.find({'plans': plan['name']})
+        if sitez.count():
+            for site in sitez:
+                if db.groups.find({'users': email, 'sites': site['url']}).count():
+                    matched.append(plan['name'])
+                    break
+    return matched
+
+def from_acl_index(db, index, email):
+    """ The plans of the user as GET /plans?email= finds them now. """
+    user = index.user(email)
+    if user is None or not user.plans:
+        return []
+    return [plan['name'] for plan in db.plans.find({'name': {'$in': list(user.plans)}})]
+
+def measure(function, emails):
+    start = time.time()
+    for email in emails:
+        function(email)
+    return (time.time() - start) / len(emails)
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=27017)
+    parser.add_option("--database", default="minion_benchmark")
+    parser.add_option("--plans", type="int", default=50)
+    parser.add_option("--sites", type="int", default=5000)
+    parser.add_option("--plans-per-site", type="int", default=3)
+    parser.add_option("--groups", type="int", default=200)
+    parser.add_option("--sites-per-group", type="int", default=25)
+    parser.add_option("--users", type="int", default=1000)
+    parser.add_option("--users-per-group", type="int", default=10)
+    parser.add_option("--lookups", type="int", default=10)
+    parser.add_option("--seed", type="int", default=1)
+
+    (options, args) = parser.parse_args()
+
+    client = MongoClient(host=options.host, port=options.port)
+    db = client[options.database]
+    emails = seed(db, options)
+    sample = random.sample(emails, options.lookups)
+
+    index = acl.ACLIndex(db.users, db.groups, db.sites, db.plans, db.counters)
+    for email in sample:
+        assert sorted(per_plan_queries(db, email)) == sorted(from_acl_index(db, index, email))
+
+    def rebuilt(email):
+        acl.bump_version(db.counters)
+        return from_acl_index(db, index, email)
+
+    print "%-22s %12s" % ("lookup", "ms/request")
+    print "%-22s %12.2f" % ("per-plan queries", 1000 * measure(lambda email: per_plan_queries(db, email), sample))
+    print "%-22s %12.2f" % ("acl index, rebuilt", 1000 * measure(rebuilt, sample))
+    print "%-22s %12.2f" % ("acl index, current", 1000 * measure(lambda email: from_acl_index(db, index, email), sample))
+
+    client.drop_database(options.database)
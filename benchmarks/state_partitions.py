@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Measure state update throughput for different numbers of state partitions.
+#
+# This applies the same updates that plugin workers send (session_start, batches
+# of issues and session_finish) to a scratch database. Updates are routed with
+# state_queue() and every partition is consumed by one thread that applies its
+# updates serially, just like a state worker with --concurrency 1 does.
+#
+#  python benchmarks/state_partitions.py --scans 200 --partitions 1,2,4,8
+#
+
+import optparse
+import threading
+import time
+import uuid
+
+from pymongo import MongoClient
+
+from minion.backend import tasks
+
+def create_scans(collection, count, sessions):
+    ids = []
+    for n in range(count):
+        scan = { "id": str(uuid.uuid4()),
+                 "state": "STARTED",
+                 "configuration": { "target": "http://example.com" },
+                 "plan": { "name": "basic" },
+                 "sessions": [ { "id": str(uuid.uuid4()),
+                                 "state": "QUEUED" } for m in range(sessions) ] }
+        collection.insert(scan)
+        ids.append((scan['id'], [s['id'] for s in scan['sessions']]))
+    return ids
+
+def session_updates(scan_id, session_id, batches, batch_size):
+    updates = [(tasks.session_start, [scan_id, session_id, time.time()])]
+    for n in range(batches):
+        issues = [{"Summary": "Issue %d" % m, "Severity": "Info"} for m in range(batch_size)]
+        updates.append((tasks.session_report_issues, [scan_id, session_id, issues]))
+    updates.append((tasks.session_finish, [scan_id, session_id, "FINISHED", time.time()]))
+    return updates
+
+def consume(updates):
+    for task, args, seq in updates:
+        task(*args, seq=seq)
+
+def run(collection, options, partitions):
+    collection.drop()
+    tasks.db.issues.drop()
+    scans = create_scans(collection, options.scans, options.sessions)
+
+    # Route every update the same way the plugin workers do
+    tasks.cfg['state'] = {'partitions': partitions}
+    queues = {}
+    total = 0
+    for scan_id, session_ids in scans:
+        queue = queues.setdefault(tasks.state_queue(scan_id), [])
+        for session_id in session_ids:
+            for seq, (task, args) in enumerate(session_updates(scan_id, session_id, options.batches, options.batch_size)):
+                queue.append((task, args, seq + 1))
+                total += 1
+
+    threads = [threading.Thread(target=consume, args=(q,)) for q in queues.values()]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    return total, elapsed
+
+if __name__ == "__main__":
+
+    parser = optparse.OptionParser()
+    parser.add_option("--host", default="127.0.0.1")
+    parser.add_option("--port", type="int", default=27017)
+    parser.add_option("--database", default="minion_benchmark")
+    parser.add_option("--scans", type="int", default=200)
+    parser.add_option("--sessions", type="int", default=8)
+    parser.add_option("--batches", type="int", default=5)
+    parser.add_option("--batch-size", type="int", default=20)
+    parser.add_option("--partitions", default="1,2,4,8")
+
+    (options, args) = parser.parse_args()
+
+    client = MongoClient(host=options.host, port=options.port)
+    collection = client[options.database].scans
+    tasks.db = client[options.database]
+    tasks.scans = collection
+
+    print "%10s %10s %10s %12s" % ("partitions", "updates", "seconds", "updates/sec")
+    for partitions in [int(p) for p in options.partitions.split(',')]:
+        total, elapsed = run(collection, options, partitions)
+        print "%10d %10d %10.2f %12.1f" % (partitions, total, elapsed, total / elapsed)
+
+    client.drop_database(options.database)
@@ -0,0 +1,106 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Who can see what follows from group membership: a user can see the scans
+# of the sites in their groups and the plans of those sites. Instead of
+# querying the users, groups and sites for every permission check, the API
+# keeps an index of the role, the sites and the plans of every user.
+#
+# The index is rebuilt when its version is behind the version counter in
+# the counters collection:
+#
+#   { "_id": "acl", "version": 42, "epoch": "<random id>" }
+#
+# Every view that changes users, groups, sites or plans bumps the counter
+# after its write, which makes every API process rebuild its index on its
+# next permission check. The epoch is set when the counter is created, so
+# a counter that is removed and starts again from 1 is not mistaken for
+# the old one.
+#
+# The counter is read at most once per request when the index is given a
+# scope, a function that returns an object that lives as long as the
+# request (flask.g) or None outside of one.
+#
+
+import collections
+import threading
+import uuid
+
+ACL_COUNTER = "acl"
+
+def bump_version(counters):
+    counters.update({"_id": ACL_COUNTER},
+                    {"$inc": {"version": 1}, "$setOnInsert": {"epoch": str(uuid.uuid4())}},
+                    upsert=True)
+
+def current_version(counters):
+    counter = counters.find_one({"_id": ACL_COUNTER}, {"version": 1, "epoch": 1})
+    return (counter.get('epoch'), counter['version']) if counter else None
+
+UserAccess = collections.namedtuple('UserAccess', ['role', 'targets', 'plans'])
+
+def build(users, groups, sites, plans):
+    """ Return the role, the sites and the plans of every user, and the
+    sites and plans of the group members that are not a user. """
+    targets = {}
+    for group in groups.find({}, {"_id": 0, "users": 1, "sites": 1}):
+        for email in group.get('users', []):
+            targets.setdefault(email, set()).update(group.get('sites', []))
+    existing_plans = set(plan['name'] for plan in plans.find({}, {"_id": 0, "name": 1}))
+    site_plans = dict((site['url'], set(site.get('plans', [])) & existing_plans)
+                      for site in sites.find({}, {"_id": 0, "url": 1, "plans": 1}))
+    def access(role, urls):
+        user_plans = set()
+        for url in urls:
+            user_plans.update(site_plans.get(url, ()))
+        return UserAccess(role, frozenset(urls), frozenset(user_plans))
+    index = {}
+    for user in users.find({}, {"_id": 0, "email": 1, "role": 1}):
+        index[user['email']] = access(user.get('role'), targets.get(user['email'], set()))
+    members = dict((email, access(None, urls)) for email, urls in targets.items() if email not in index)
+    return index, members
+
+class ACLIndex(object):
+
+    def __init__(self, users, groups, sites, plans, counters, scope=None):
+        self._collections = (users, groups, sites, plans)
+        self._counters = counters
+        self._scope = scope
+        self._lock = threading.Lock()
+        self._version = ()
+        self._index = {}
+        self._members = {}
+
+    def _refresh(self):
+        scope = self._scope() if self._scope else None
+        if scope is not None and getattr(scope, 'acl_checked', False):
+            return
+        version = current_version(self._counters)
+        if version != self._version:
+            with self._lock:
+                if version != self._version:
+                    self._index, self._members = build(*self._collections)
+                    self._version = version
+        if scope is not None:
+            scope.acl_checked = True
+
+    def changed(self):
+        """ Check the version again on the next lookup, even in the same
+        scope. Call this after bump_version. """
+        scope = self._scope() if self._scope else None
+        if scope is not None:
+            scope.acl_checked = False
+
+    def user(self, email):
+        """ Return the UserAccess of the user, or None if there is no such
+        user. """
+        self._refresh()
+        return self._index.get(email)
+
+    def member(self, email):
+        """ Like user, but an email without a user that is listed in groups
+        gets the sites and plans of those groups, with a role of None. """
+        self._refresh()
+        return self._index.get(email) or self._members.get(email)
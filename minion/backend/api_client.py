@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# The client that the workers use to talk to the backend API. It keeps
+# connections to the API alive, applies timeouts, retries idempotent
+# requests that fail because the API is briefly unavailable, can cache
+# lookups that do not change during a scan and keeps track of how many
+# calls are made and how long they take.
+#
+# The client can be tuned in the backend configuration:
+#
+#   "api_client": { "connect_timeout": 5, "read_timeout": 30,
+#                   "retries": 3, "backoff_factor": 0.2,
+#                   "pool_maxsize": 64, "cache_ttl": 60,
+#                   "cache_size": 1000, "report_interval": 300 }
+#
+
+import logging
+import os
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
+
+logger = logging.getLogger(__name__)
+
+
+class APIClient(object):
+
+    def __init__(self, url, key=None, connect_timeout=5, read_timeout=30, retries=3,
+                 backoff_factor=0.2, pool_maxsize=64, cache_ttl=60, cache_size=1000,
+                 report_interval=300):
+        self.url = url.rstrip('/')
+        self.timeout = (connect_timeout, read_timeout)
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.report_interval = report_interval
+        self.session = requests.Session()
+        if key:
+            self.session.headers['X-Minion-Backend-Key'] = key
+        # Only idempotent requests are retried, a POST is never sent twice
+        retry = Retry(total=retries, connect=retries, read=retries, backoff_factor=backoff_factor,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize, max_retries=retry)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._stats = {}
+        self._reported = time.time()
+
+    def request(self, method, path, endpoint=None, **kwargs):
+        """ Make a request to the API. The call is counted under endpoint,
+        which defaults to the path. """
+        kwargs.setdefault('timeout', self.timeout)
+        start = time.time()
+        failed = True
+        try:
+            r = self.session.request(method, self.url + path, **kwargs)
+            failed = r.status_code >= 400
+            return r
+        finally:
+            self._count(method + " " + (endpoint or path), time.time() - start, failed)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def get_json(self, path, params=None, endpoint=None, cache=False):
+        """ GET path and return the decoded response. With cache=True a
+        successful response is reused for cache_ttl seconds. At most
+        cache_size responses are kept. """
+        key = (path, tuple(sorted((params or {}).items())))
+        if cache:
+            with self._lock:
+                cached = self._cache.get(key)
+                if cached and cached[0] > time.time():
+                    self._count_cache_hit(endpoint or path)
+                    return cached[1]
+        r = self.get(path, params=params, endpoint=endpoint)
+        r.raise_for_status()
+        j = r.json()
+        if cache:
+            with self._lock:
+                self._store(key, j)
+        return j
+
+    def _store(self, key, j):
+        now = time.time()
+        if key not in self._cache and len(self._cache) >= self.cache_size:
+            for k, (expires, _) in self._cache.items():
+                if expires <= now:
+                    del self._cache[k]
+            if len(self._cache) >= self.cache_size:
+                del self._cache[min(self._cache, key=lambda k: self._cache[k][0])]
+        self._cache[key] = (now + self.cache_ttl, j)
+
+    def clear_cache(self):
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self):
+        """ Return, for every endpoint, the number of calls, failures and
+        cache hits and the total and maximum latency in seconds. """
+        with self._lock:
+            return dict((endpoint, dict(s)) for endpoint, s in self._stats.items())
+
+    def _endpoint_stats(self, endpoint):
+        return self._stats.setdefault(endpoint, {'calls': 0, 'failures': 0, 'cache_hits': 0,
+                                                 'seconds': 0.0, 'max_seconds': 0.0})
+
+    def _count(self, endpoint, seconds, failed):
+        with self._lock:
+            s = self._endpoint_stats(endpoint)
+            s['calls'] += 1
+            s['seconds'] += seconds
+            s['max_seconds'] = max(s['max_seconds'], seconds)
+            if failed:
+                s['failures'] += 1
+        self._report()
+
+    def _count_cache_hit(self, endpoint):
+        self._endpoint_stats("GET " + endpoint)['cache_hits'] += 1
+
+    def _report(self):
+        if self.report_interval is None or time.time() - self._reported < self.report_interval:
+            return
+        self._reported = time.time()
+        for endpoint, s in sorted(self.stats().items()):
+            logger.info("API %s: %d calls, %d failures, %d cache hits, %.3fs avg, %.3fs max"
+                        % (endpoint, s['calls'], s['failures'], s['cache_hits'],
+                           s['seconds'] / s['calls'] if s['calls'] else 0.0, s['max_seconds']))
+
+#
+# Worker processes are forked after the tasks module has been imported, so
+# every process creates its own client instead of sharing the connections
+# of its parent.
+#
+
+_client = None
+_client_pid = None
+
+def api_client(cfg):
+    global _client, _client_pid
+    if _client is None or _client_pid != os.getpid():
+        _client = APIClient(cfg['api']['url'], key=cfg['api'].get('key'), **cfg.get('api_client', {}))
+        _client_pid = os.getpid()
+    return _client
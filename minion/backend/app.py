@@ -19,4 +19,12 @@ import minion.backend.views.issues
 def configure_app(app, production=True, debug=False):
     app.debug = debug
     app.use_evalex = False
+    _check_indexes()
     return app
+
+def _check_indexes():
+    from minion.backend.indexes import check_indexes
+    from minion.backend.views.base import backend_config, mongo_client
+    mode = backend_config['mongodb'].get('indexes')
+    if mode in ('check', 'create'):
+        check_indexes(mongo_client.minion, create=(mode == 'create'), log=app.logger)
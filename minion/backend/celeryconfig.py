@@ -1,4 +1,15 @@
+import datetime
+
 CELERY_ACCEPT_CONTENT = ["json", "pickle"]
 CELERY_MONGODB_SCHEDULER_DB = "minion"
 CELERY_MONGODB_SCHEDULER_COLLECTION = "scanschedule"
 CELERY_MONGODB_SCHEDULER_URL = "mongodb://localhost"
+
+# Fail the plugin sessions that are not going to finish by themselves
+CELERYBEAT_SCHEDULE = {
+    "check-sessions": {
+        "task": "minion.backend.tasks.check_sessions",
+        "schedule": datetime.timedelta(minutes=1),
+        "options": {"queue": "scan"},
+    },
+}
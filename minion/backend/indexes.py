@@ -0,0 +1,130 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# The indexes that the queries of the backend rely on. Every index is
+# declared with the collection it belongs to, its keys and the options it
+# is created with. Indexes are created with minion-db-index or, when the
+# backend configuration asks for it, when the API starts:
+#
+#   "mongodb": { "host": "127.0.0.1", "port": 27017, "indexes": "check" }
+#
+# With "check" missing indexes are logged, with "create" they are created.
+#
+
+import logging
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import OperationFailure
+
+logger = logging.getLogger(__name__)
+
+INDEXES = [
+    # Scans are looked up by id, positional session updates include the id
+    ('scans', [('id', ASCENDING)], {'unique': True}),
+    # Latest scans of a site and plan, /scans, /reports/status and /issues
+    ('scans', [('configuration.target', ASCENDING), ('plan.name', ASCENDING), ('created', DESCENDING)], {}),
+    # Scans that are running, checked by the session watchdog
+    ('scans', [('state', ASCENDING)], {}),
+    # Scan history of all sites, pages of the history continue after (created, _id)
+    ('scans', [('created', DESCENDING), ('_id', DESCENDING)], {}),
+    # Issues of a scan in the order in which they were reported and per severity
+    ('issues', [('scan_id', ASCENDING), ('session_id', ASCENDING), ('seq', ASCENDING), ('n', ASCENDING)], {}),
+    ('issues', [('scan_id', ASCENDING), ('severity', ASCENDING)], {}),
+    # Issue search by site, plan and code
+    ('issues', [('target', ASCENDING), ('plan', ASCENDING), ('code', ASCENDING)], {}),
+    # /issues/search, most recently found first, on its own or by code, severity or site
+    ('issues', [('found', DESCENDING), ('_id', DESCENDING)], {}),
+    ('issues', [('code', ASCENDING), ('found', DESCENDING)], {}),
+    ('issues', [('severity', ASCENDING), ('found', DESCENDING)], {}),
+    ('issues', [('target', ASCENDING), ('found', DESCENDING)], {}),
+    # One latest scan per site and plan, latestscans relies on this being unique
+    ('latest_scans', [('target', ASCENDING), ('plan', ASCENDING)], {'unique': True}),
+    ('users', [('email', ASCENDING)], {'unique': True}),
+    ('groups', [('name', ASCENDING)], {'unique': True}),
+    ('groups', [('users', ASCENDING)], {}),
+    ('groups', [('sites', ASCENDING)], {}),
+    ('sites', [('id', ASCENDING)], {'unique': True}),
+    ('sites', [('url', ASCENDING)], {'unique': True}),
+    ('sites', [('plans', ASCENDING)], {}),
+    ('plans', [('name', ASCENDING)], {'unique': True}),
+    ('invites', [('id', ASCENDING)], {'unique': True}),
+    ('invites', [('recipient', ASCENDING)], {}),
+    ('scanschedule', [('site', ASCENDING), ('plan', ASCENDING)], {}),
+    ('siteCredentials', [('site', ASCENDING), ('plan', ASCENDING)], {}),
+]
+
+def index_name(keys):
+    """ The name MongoDB gives an index with these keys. """
+    return "_".join("%s_%s" % (field, direction) for field, direction in keys)
+
+def _existing_indexes(db, collection):
+    return dict((name, info['key']) for name, info in db[collection].index_information().items())
+
+def missing_indexes(db, indexes=INDEXES):
+    """ Return the declared indexes that do not exist. An index exists
+    when an index with the same keys exists, whatever its name. """
+    missing = []
+    existing = {}
+    for collection, keys, options in indexes:
+        if collection not in existing:
+            existing[collection] = _existing_indexes(db, collection).values()
+        if [tuple(k) for k in keys] not in [[tuple(k) for k in e] for e in existing[collection]]:
+            missing.append((collection, keys, options))
+    return missing
+
+def undeclared_indexes(db, indexes=INDEXES):
+    """ Return (collection, name, keys) for the indexes that exist but that
+    are not declared, apart from the _id index. """
+    declared = {}
+    for collection, keys, options in indexes:
+        declared.setdefault(collection, []).append([tuple(k) for k in keys])
+    undeclared = []
+    for collection in sorted(declared):
+        for name, keys in sorted(_existing_indexes(db, collection).items()):
+            if name != '_id_' and [tuple(k) for k in keys] not in declared[collection]:
+                undeclared.append((collection, name, keys))
+    return undeclared
+
+def unused_indexes(db, indexes=INDEXES):
+    """ Return (collection, name) for the indexes that have not been used
+    since the server started. This needs MongoDB 3.2 or newer; on older
+    servers nothing is returned. """
+    unused = []
+    for collection in sorted(set(c for c, keys, options in indexes)):
+        try:
+            result = db[collection].aggregate([{'$indexStats': {}}], cursor={})
+        except OperationFailure:
+            return []
+        for stats in result:
+            if stats['name'] != '_id_' and stats['accesses']['ops'] == 0:
+                unused.append((collection, stats['name']))
+    return unused
+
+def create_indexes(db, indexes=INDEXES):
+    """ Create the declared indexes that are missing. Returns the indexes
+    that were created and the ones that could not be created, for example
+    because a unique index conflicts with existing documents, with the
+    reason. """
+    created, failed = [], []
+    for collection, keys, options in missing_indexes(db, indexes):
+        try:
+            db[collection].create_index(keys, background=True, **options)
+            created.append((collection, keys, options))
+        except OperationFailure as e:
+            failed.append((collection, keys, options, str(e)))
+    return created, failed
+
+def check_indexes(db, create=False, log=logger):
+    """ Log the missing indexes, or create them when create is True. Used
+    when the API starts. """
+    if create:
+        created, failed = create_indexes(db)
+        for collection, keys, options in created:
+            log.info("Created index %s on %s" % (index_name(keys), collection))
+        for collection, keys, options, reason in failed:
+            log.error("Cannot create index %s on %s: %s" % (index_name(keys), collection, reason))
+    else:
+        for collection, keys, options in missing_indexes(db):
+            log.warning("Missing index %s on %s, run minion-db-index to create it" % (index_name(keys), collection))
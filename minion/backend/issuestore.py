@@ -0,0 +1,286 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Issues are not stored in the sessions of their scan document but in the
+# issues collection, one document per issue:
+#
+#   { "_id": <the Id of the issue>,
+#     "scan_id": "...", "session_id": "...",
+#     "target": "http://...", "plan": "basic",
+#     "code": "XFO-0", "severity": "High",
+#     "seq": 3, "n": 0,
+#     "found": ISODate("2015-01-01T10:00:00Z"),
+#     "issue": { <the issue as reported by the plugin> } }
+#
+# seq is the sequence number of the session update that stored the issue and
+# n its position in that batch, together they keep the issues in the order in
+# which the plugin reported them. found is when the issue was stored. Because
+# the _id is the Id of the issue an update that is applied twice does not
+# store its issues twice.
+#
+# Scans created before issues had their own collection have the issues
+# embedded in their sessions until they are migrated with
+# minion-db-migrate-issues. The functions below read both.
+#
+
+import datetime
+import re
+import uuid
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+def issue_documents(scan_id, session_id, target, plan, issues, seq=None, found=None):
+    found = found or datetime.datetime.utcnow()
+    documents = []
+    for n, issue in enumerate(issues):
+        documents.append({"_id": issue.get('Id') or str(uuid.uuid4()),
+                          "scan_id": scan_id,
+                          "session_id": session_id,
+                          "target": target,
+                          "plan": plan,
+                          "code": issue.get('Code'),
+                          "severity": issue.get('Severity'),
+                          "seq": seq or 0,
+                          "n": n,
+                          "found": found,
+                          "issue": issue})
+    return documents
+
+def insert_issues(collection, documents):
+    """ Insert the issue documents. Issues that are already stored are
+    skipped. """
+    if not documents:
+        return
+    try:
+        collection.insert(documents, continue_on_error=True)
+    except DuplicateKeyError:
+        pass
+
+def session_issues(collection, scan_id, query=None):
+    """ Return a dictionary with the stored issues of every session of the
+    scan, in the order in which they were reported. """
+    spec = {"scan_id": scan_id}
+    spec.update(query or {})
+    issues = {}
+    cursor = collection.find(spec, {"session_id": 1, "issue": 1}).sort(
+        [("session_id", ASCENDING), ("seq", ASCENDING), ("n", ASCENDING)])
+    for document in cursor:
+        issues.setdefault(document['session_id'], []).append(document['issue'])
+    return issues
+
+def embed_issues(collection, scan):
+    """ Put the issues of the scan in its sessions, which is how the API
+    has always returned them. """
+    stored = session_issues(collection, scan['id'])
+    for session in scan.get('sessions', []):
+        session['issues'] = session.get('issues', []) + stored.get(session['id'], [])
+    return scan
+
+def embed_issues_of_scans(scans, collection, scan_list):
+    """ Like embed_issues, for many scans with one query on the issues and
+    one on the scans that still have embedded issues. The scans only need
+    the ids of their sessions, which keep their order. """
+    ids = [scan['id'] for scan in scan_list]
+    stored = {}
+    cursor = collection.find({"scan_id": {"$in": ids}}, {"scan_id": 1, "session_id": 1, "issue": 1}).sort(
+        [("scan_id", ASCENDING), ("session_id", ASCENDING), ("seq", ASCENDING), ("n", ASCENDING)])
+    for document in cursor:
+        stored.setdefault((document['scan_id'], document['session_id']), []).append(document['issue'])
+    embedded = {}
+    for scan in scans.find({"id": {"$in": ids}, "sessions.issues": {"$exists": True}},
+                           {"_id": 0, "id": 1, "sessions.id": 1, "sessions.issues": 1}):
+        for session in scan.get('sessions', []):
+            embedded[(scan['id'], session['id'])] = session.get('issues', [])
+    for scan in scan_list:
+        for session in scan.get('sessions', []):
+            key = (scan['id'], session['id'])
+            session['issues'] = embedded.get(key, []) + stored.get(key, [])
+    return scan_list
+
+def severity_counts(collection, scan):
+    """ Return the number of issues of the scan per severity. """
+    counts = {}
+    for session in scan.get('sessions', []):
+        for issue in session.get('issues', []):
+            counts[issue.get('Severity')] = counts.get(issue.get('Severity'), 0) + 1
+    result = collection.aggregate([{"$match": {"scan_id": scan['id']}},
+                                   {"$group": {"_id": "$severity", "count": {"$sum": 1}}}])
+    if isinstance(result, dict):
+        result = result['result']
+    for group in result:
+        counts[group['_id']] = counts.get(group['_id'], 0) + group['count']
+    return counts
+
+#
+# Scans and their sessions count their issues per severity:
+#
+#   "issue_counts": { "critical": 0, "high": 2, "medium": 0, "low": 1, "info": 7 }
+#
+# The counters are incremented with the same update that stores a batch of
+# issues. Scans created before there were counters get them from
+# minion-db-count-issues.
+#
+
+SEVERITIES = ('Critical', 'High', 'Medium', 'Low', 'Info')
+
+def empty_counts():
+    return dict((severity.lower(), 0) for severity in SEVERITIES)
+
+def complete_counts(counts):
+    """ Whether the counters have every severity. Scans get complete counters
+    when they are created; partial ones do not count all issues. """
+    return counts is not None and all(severity.lower() in counts for severity in SEVERITIES)
+
+def uncounted_query():
+    """ The query for the scans that do not have complete counters. """
+    return {"$or": [{"issue_counts." + severity.lower(): {"$exists": False}} for severity in SEVERITIES]}
+
+def count_increments(issues):
+    """ Return the $inc that adds the issues to the counters of the scan
+    and of the session, which has to be matched by the update. """
+    inc = {}
+    for issue in issues:
+        if issue.get('Severity') in SEVERITIES:
+            for field in ("issue_counts.", "sessions.$.issue_counts."):
+                key = field + issue['Severity'].lower()
+                inc[key] = inc.get(key, 0) + 1
+    return inc
+
+def issue_counts(scans, collection, scan):
+    """ Return the counters of the scan, or count its issues when it does
+    not have complete counters. Scan summaries are read without the issues in
+    their sessions, those are then read from scans. """
+    if complete_counts(scan.get('issue_counts')):
+        return dict(scan['issue_counts'])
+    if scan.get('sessions') and not any('issues' in session for session in scan['sessions']):
+        scan = scans.find_one({"id": scan['id']}, {"_id": 0, "id": 1, "sessions.issues": 1}) or scan
+    counts = empty_counts()
+    for severity, count in severity_counts(collection, scan).items():
+        if severity in SEVERITIES:
+            counts[severity.lower()] = count
+    return counts
+
+def backfill_counts(scans, collection, scan, force=False):
+    """ Count the issues of the scan and its sessions and store the
+    counters. Scans that already have complete counters are left alone
+    unless force is True. Returns the counters of the scan. """
+    sessions = dict((session['id'], empty_counts()) for session in scan.get('sessions', []))
+    for session in scan.get('sessions', []):
+        for issue in session.get('issues', []):
+            if issue.get('Severity') in SEVERITIES:
+                sessions[session['id']][issue['Severity'].lower()] += 1
+    result = collection.aggregate([{"$match": {"scan_id": scan['id']}},
+                                   {"$group": {"_id": {"session_id": "$session_id", "severity": "$severity"},
+                                               "count": {"$sum": 1}}}])
+    if isinstance(result, dict):
+        result = result['result']
+    for group in result:
+        if group['_id']['session_id'] in sessions and group['_id'].get('severity') in SEVERITIES:
+            sessions[group['_id']['session_id']][group['_id']['severity'].lower()] += group['count']
+
+    counts = empty_counts()
+    update = {}
+    for n, session in enumerate(scan.get('sessions', [])):
+        update["sessions.%d.issue_counts" % n] = sessions[session['id']]
+        for severity, count in sessions[session['id']].items():
+            counts[severity] += count
+    update["issue_counts"] = counts
+
+    spec = {"id": scan['id']}
+    if not force:
+        spec.update(uncounted_query())
+    scans.update(spec, {"$set": update})
+    return counts
+
+def migrate_scan(scans, collection, scan):
+    """ Move the issues that are embedded in the sessions of the scan to the
+    issues collection. Returns the number of issues that were moved. """
+    moved = 0
+    for session in scan.get('sessions', []):
+        if 'issues' not in session:
+            continue
+        insert_issues(collection, issue_documents(scan['id'], session['id'],
+                                                  scan.get('configuration', {}).get('target'),
+                                                  scan.get('plan', {}).get('name'),
+                                                  session['issues'],
+                                                  found=scan.get('finished') or scan.get('created')))
+        scans.update({"id": scan['id'], "sessions.id": session['id']},
+                     {"$unset": {"sessions.$.issues": ""}})
+        moved += len(session['issues'])
+    return moved
+
+def backfill_found(scans, collection):
+    """ Give the issues that were stored before issues had a found time the
+    time their scan finished. Returns the number of scans whose issues were
+    updated. """
+    updated = 0
+    for scan_id in collection.find({"found": {"$exists": False}}).distinct("scan_id"):
+        scan = scans.find_one({"id": scan_id}, {"created": 1, "finished": 1})
+        found = scan and (scan.get('finished') or scan.get('created'))
+        if found:
+            collection.update({"scan_id": scan_id, "found": {"$exists": False}},
+                              {"$set": {"found": found}}, multi=True)
+            updated += 1
+    return updated
+
+#
+# Issue search. search_query() turns the filters of GET /issues/search into
+# a query on the issues collection and facet_counts() counts the matching
+# issues per severity, code, site or plan.
+#
+
+FACETS = ('severity', 'code', 'target', 'plan')
+
+def severities_at_least(severity):
+    """ Return the severities that are as severe as severity or more, or
+    None when severity is not known. """
+    names = [s.lower() for s in SEVERITIES]
+    if severity is None or severity.lower() not in names:
+        return None
+    return list(SEVERITIES[:names.index(severity.lower()) + 1])
+
+def search_query(targets=None, plans=None, codes=None, code_prefixes=None, severities=None,
+                 since=None, until=None):
+    """ Return the query for the issues that match all of the given
+    filters. Filters that are None are not applied. """
+    query = {}
+    if targets is not None:
+        query["target"] = {"$in": list(targets)}
+    if plans:
+        query["plan"] = {"$in": list(plans)}
+    code_conditions = []
+    if codes:
+        code_conditions.append({"code": {"$in": list(codes)}})
+    for prefix in code_prefixes or []:
+        # An anchored prefix can use the code index
+        code_conditions.append({"code": {"$regex": "^" + re.escape(prefix)}})
+    if len(code_conditions) == 1:
+        query.update(code_conditions[0])
+    elif code_conditions:
+        query["$or"] = code_conditions
+    if severities is not None:
+        query["severity"] = {"$in": list(severities)}
+    if since is not None or until is not None:
+        query["found"] = {}
+        if since is not None:
+            query["found"]["$gte"] = since
+        if until is not None:
+            query["found"]["$lt"] = until
+    return query
+
+def facet_counts(collection, query, facets, limit=50):
+    """ Return, for every facet, the number of matching issues per value,
+    for the limit most common values. """
+    counts = {}
+    for facet in facets:
+        result = collection.aggregate([{"$match": query},
+                                       {"$group": {"_id": "$" + facet, "count": {"$sum": 1}}},
+                                       {"$sort": {"count": DESCENDING}},
+                                       {"$limit": limit}])
+        if isinstance(result, dict):
+            result = result['result']
+        counts[facet] = dict((group['_id'], group['count']) for group in result)
+    return counts
@@ -0,0 +1,79 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# The reports show, for every site and plan, the most recent scan and the
+# schedule. Instead of looking those up one site and plan at a time they
+# are kept in the latest_scans collection, one document per site and plan:
+#
+#   { "target": "https://www.mozilla.org", "plan": "basic",
+#     "scan": { <the scan without its sessions' configuration and issues> },
+#     "crontab": { ... }, "scheduleEnabled": true }
+#
+# The scan is recorded whenever it is created or changes state, and when one
+# of its sessions finishes, which also catches the issues that sessions
+# report after their scan has been stopped. A scan only
+# replaces the one that is there when it was created at the same time or
+# later. The schedule is recorded when it is set. minion-db-latest-scans
+# fills the collection for existing scans and schedules.
+#
+
+from pymongo import ASCENDING, DESCENDING
+from pymongo.errors import DuplicateKeyError
+
+# The fields of a scan that summarize_scan needs
+LATEST_SCAN_FIELDS = {"_id": 0, "id": 1, "meta": 1, "state": 1, "configuration": 1, "plan": 1,
+                      "created": 1, "queued": 1, "started": 1, "finished": 1, "issue_counts": 1,
+                      "sessions.id": 1, "sessions.plugin": 1, "sessions.state": 1}
+
+def ensure_unique(latest_scans):
+    """ The upsert in _record only keeps one document per site and plan when
+    they are unique, so the index is ensured whatever the indexes setting of
+    the backend is. pymongo remembers that it did this for a while. """
+    latest_scans.ensure_index([("target", ASCENDING), ("plan", ASCENDING)], unique=True)
+
+def record_scan(latest_scans, scans, scan_id):
+    """ Make the scan the latest scan of its site and plan, unless a more
+    recent scan is already recorded. """
+    scan = scans.find_one({"id": scan_id}, LATEST_SCAN_FIELDS)
+    if scan is None:
+        return
+    ensure_unique(latest_scans)
+    _record(latest_scans, scan)
+
+def _record(latest_scans, scan):
+    try:
+        latest_scans.update({"target": scan['configuration']['target'],
+                             "plan": scan['plan']['name'],
+                             "$or": [{"scan": None}, {"scan.created": {"$lte": scan['created']}}]},
+                            {"$set": {"scan": scan}}, upsert=True)
+    except DuplicateKeyError:
+        # A more recent scan is recorded, the upsert conflicts with it
+        pass
+
+def record_schedule(latest_scans, target, plan, crontab, enabled):
+    ensure_unique(latest_scans)
+    latest_scans.update({"target": target, "plan": plan},
+                        {"$set": {"crontab": crontab, "scheduleEnabled": enabled}}, upsert=True)
+
+def backfill(latest_scans, scans, scanschedules):
+    """ Record the latest scan of every site and plan and every schedule.
+    Returns the number of scans and schedules recorded. """
+    ensure_unique(latest_scans)
+    result = scans.aggregate([{"$sort": {"created": DESCENDING}},
+                              {"$group": {"_id": {"target": "$configuration.target", "plan": "$plan.name"},
+                                          "id": {"$first": "$id"}}}],
+                             allowDiskUse=True)
+    if isinstance(result, dict):
+        result = result['result']
+    recorded_scans = 0
+    for group in result:
+        record_scan(latest_scans, scans, group['id'])
+        recorded_scans += 1
+    recorded_schedules = 0
+    for schedule in scanschedules.find({}, {"site": 1, "plan": 1, "crontab": 1, "enabled": 1}):
+        record_schedule(latest_scans, schedule['site'], schedule['plan'],
+                        schedule.get('crontab'), schedule.get('enabled', False))
+        recorded_schedules += 1
+    return recorded_scans, recorded_schedules
@@ -24,7 +24,8 @@ def verify_by_file(target, match, filename):
 
     target_file = urlparse.urljoin(target, filename)
     try:
-        r = minion.curly.get(target_file)
+        # A body longer than the match cannot match, no need to download all of it
+        r = minion.curly.get(target_file, max_body_bytes=len(match) + 1)
         r.raise_for_status()
     except (minion.curly.CurlyError, minion.curly.BadResponseError) as error:
         return None
@@ -39,7 +40,7 @@ def verify_by_header(target, match):
     the X-Minion-Site-Ownership header. """
 
     try:
-        r = minion.curly.get(target)
+        r = minion.curly.get(target, headers_only=True)
         r.raise_for_status()
     except (minion.curly.CurlyError, minion.curly.BadResponseError) as error:
         return None
@@ -2,37 +2,53 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-import Queue
 import datetime
+import errno
+import fcntl
 import json
 import os
+import select
 import signal
 import socket
+import stat
 import subprocess
+import sys
 import threading
 import time
 import traceback
 import uuid
+import zlib
 
 from celery import Celery
 from celery.app.control import Control
-from celery.exceptions import TaskRevokedError
 from celery.execute import send_task
 from celery.signals import celeryd_after_setup
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
+from celery.worker import state as worker_state
 from pymongo import MongoClient
 import requests
-from twisted.internet import reactor
+from twisted.internet import defer, reactor
 from twisted.internet.error import ProcessDone, ProcessTerminated, ProcessExitedAlready
+from twisted.internet.process import reapAllProcesses
 from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
 
-from minion.backend import ownership
+from minion.backend import issuestore, latestscans, ownership
+from minion.backend.api_client import api_client
 from minion.backend.utils import backend_config, scan_config, scannable
+from minion.backend.workflow import ready_sessions, DONE_STATES, STOP_STATES
 
 
 cfg = backend_config()
-celery = Celery('tasks', broker=cfg['celery']['broker'], backend=cfg['celery']['backend'])
+
+# Nobody reads the results of run_plugin; the session watchdog only looks at them
+# for a while. With the amqp result backend every result is a queue, so results
+# expire after an hour instead of a day. Every process that declares result
+# queues has to agree on this, so it is set here and not in celeryconfig.
+celery = Celery('tasks', broker=cfg['celery']['broker'], backend=cfg['celery']['backend'],
+                changes={'CELERY_TASK_RESULT_EXPIRES': cfg['celery'].get('result_expires', 3600)})
 
 # If the config does not mention mongo then we do not set it up. That is ok because
 # that will only happen in plugin-workers that do not need direct mongodb access.
@@ -45,17 +61,44 @@ if cfg.get('mongodb') is not None:
 logger = get_task_logger(__name__)
 
 
+#
+# State updates are spread over a number of state queues, each of which is
+# consumed by a single state worker. All updates of a scan go to the same
+# queue, so they are still applied in order, while updates of different scans
+# are applied in parallel. The number of queues is set in the backend
+# configuration with "state": {"partitions": N}. With one partition (the
+# default) everything goes to the 'state' queue, like before.
+#
+
+def state_partitions():
+    return cfg.get('state', {}).get('partitions', 1)
+
+def state_queue(scan_id):
+    partitions = state_partitions()
+    if partitions <= 1:
+        return 'state'
+    return 'state-%d' % ((zlib.crc32(scan_id.encode('utf-8')) & 0xffffffff) % partitions)
+
+
 def find_session(scan, session_id):
     for session in scan['sessions']:
         if session['id'] == session_id:
             return session
 
 
+def record_latest_scan(scan_id):
+    # The latest_scans collection only feeds the reports, so failing to update it is not fatal
+    try:
+        latestscans.record_scan(db.latest_scans, scans, scan_id)
+    except Exception as e:
+        logger.exception("(Ignored) failure while recording the latest scan %s" % scan_id)
+
 @celery.task
 def scan_start(scan_id, t):
     scans.update({"id": scan_id},
                  {"$set": {"state": "STARTED",
                            "started": datetime.datetime.utcfromtimestamp(t)}})
+    record_latest_scan(scan_id)
 
 
 @celery.task
@@ -67,7 +110,7 @@ def run_scheduled_scan(target, plan):
         'user': 'cron'
       } 
 
-    r = requests.post(cfg['api']['url'] + "/scans", 
+    r = api_client(cfg).post("/scans",
         headers={'Content-Type':'application/json'},
         data=json.dumps(data));
     r.raise_for_status()
@@ -76,7 +119,7 @@ def run_scheduled_scan(target, plan):
     logger.debug("Scheduled scan created - Target:" + target + " Plan:" + plan + " Request result: " + str(r.status_code))
     
     #2: Start the scan
-    q = requests.put(cfg['api']['url'] + "/scans/" + scan_id + "/control",
+    q = api_client(cfg).put("/scans/" + scan_id + "/control",
         headers={'Content-Type':'text/plain'},
         data="START",
         params={"email":'cron'});
@@ -102,6 +145,15 @@ def scan_finish(scan_id, state, t, failure=None):
             logger.error("Cannot find scan %s" % scan_id)
             return
 
+        #
+        # Sessions finish independently, so more than one of them can try to finish
+        # the scan. Only the first one counts.
+        #
+
+        if scan.get('finished'):
+            logger.info("Scan %s has already been finished" % scan_id)
+            return
+
         #
         # Mark the scan as finished with the provided state
         #
@@ -140,6 +192,8 @@ def scan_finish(scan_id, state, t, failure=None):
                 scans.update({"id": scan_id, "sessions.id": s['id']},
                              {"$set": {"sessions.$.state": "CANCELLED"}})
 
+        record_latest_scan(scan_id)
+
     except Exception as e:
 
         logger.exception("Error while finishing scan. Trying to mark scan as FAILED.")
@@ -148,6 +202,7 @@ def scan_finish(scan_id, state, t, failure=None):
             scans.update({"id": scan_id},
                          {"$set": {"state": "FAILED",
                                    "finished": datetime.datetime.utcnow()}})
+            record_latest_scan(scan_id)
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
@@ -181,7 +236,17 @@ def scan_stop(scan_id):
             if session['state'] in ('QUEUED', 'STARTED'):
                 scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$.state": "STOPPED", "sessions.$.finished": datetime.datetime.utcnow()}})
             if '_task' in session:
-                revoke(session['_task'], terminate=True, signal='SIGUSR1')
+                revoke_session(session)
+
+        #
+        # Nobody is waiting for the revoked sessions anymore, so finish the scan here. This
+        # also cancels the sessions that did not run yet.
+        #
+
+        scan_finish(scan_id, "STOPPED", time.time())
+
+        # scan_finish does not record a scan that had been finished already
+        record_latest_scan(scan_id)
 
     except Exception as e:
 
@@ -190,42 +255,257 @@ def scan_stop(scan_id):
         try:
             if scan:
                 scans.update({"id": scan_id}, {"$set": {"state": "FAILED", "finished": datetime.datetime.utcnow()}})
+                record_latest_scan(scan_id)
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
 @celery.task
 def session_queue(scan_id, session_id, t):
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$set": {"sessions.$.state": "QUEUED",
-                           "sessions.$.queued": datetime.datetime.utcfromtimestamp(t)}})
+    # Only move sessions that are still CREATED so that a session can be claimed once
+    result = scans.update({"id": scan_id, "sessions": {"$elemMatch": {"id": session_id, "state": "CREATED"}}},
+                          {"$set": {"sessions.$.state": "QUEUED",
+                                    "sessions.$.queued": datetime.datetime.utcfromtimestamp(t)}})
+    return result['n'] == 1
 
-@celery.task
-def session_start(scan_id, session_id, t):
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$set": {"sessions.$.state": "STARTED",
-                           "sessions.$.started": datetime.datetime.utcfromtimestamp(t)}})
+#
+# The updates that a plugin worker sends for a session are not acknowledged one
+# by one. Instead each of them carries a sequence number and the state worker
+# only applies an update after the one before it. An update that arrives early
+# is retried until the gap is filled and an update that was already applied is
+# dropped. Updates without a sequence number are applied right away.
+#
+# When the gap is not filled in time the update is applied anyway, but the
+# sequence number of the session is left before the gap. Otherwise the missing
+# update would be dropped as a duplicate when it does arrive.
+#
 
-@celery.task
+ORDERED_UPDATE_RETRIES = 100
+ORDERED_UPDATE_RETRY_DELAY = 0.1
+
+def apply_session_update(task, scan_id, session_id, seq, update):
+    if seq is None:
+        if update:
+            scans.update({"id": scan_id, "sessions.id": session_id}, update)
+        return
+
+    # Apply the update only if the previous one has been applied
+    update.setdefault("$set", {})["sessions.$._seq"] = seq
+    result = scans.update({"id": scan_id,
+                           "sessions": {"$elemMatch": {"id": session_id, "_seq": seq - 1 if seq > 1 else None}}},
+                          update)
+    if result['n'] == 1:
+        return
+
+    scan = scans.find_one({"id": scan_id, "sessions.id": session_id}, {"sessions.$": 1})
+    if scan is None:
+        logger.error("Cannot find session %s/%s" % (scan_id, session_id))
+        return
+
+    if scan['sessions'][0].get('_seq', 0) >= seq:
+        logger.info("Dropping duplicate update %d for session %s/%s" % (seq, scan_id, session_id))
+        return
+
+    if task.request.retries < ORDERED_UPDATE_RETRIES:
+        raise task.retry(countdown=ORDERED_UPDATE_RETRY_DELAY)
+
+    # The missing update may not come anymore. Better to apply this one than to lose it.
+    logger.error("Applying update %d for session %s/%s out of order" % (seq, scan_id, session_id))
+    del update["$set"]["sessions.$._seq"]
+    if not update["$set"]:
+        del update["$set"]
+    if update:
+        scans.update({"id": scan_id, "sessions.id": session_id}, update)
+
+class SessionUpdates(object):
+
+    """
+    Sends the state updates of one plugin session to the state worker without
+    waiting for each of them. Call wait() where the updates need to be stored:
+    because the state worker applies them in order, waiting for the last one
+    that stores a result is enough. Updates like session_report_issues do not
+    store a result, so they cannot be waited for.
+    """
+
+    # Seconds wait() waits for the state worker
+    WAIT_TIMEOUT = 300
+
+    def __init__(self, scan_id, session_id):
+        self._scan_id = scan_id
+        self._session_id = session_id
+        self._seq = 0
+        self._last = None
+
+    def send(self, task_name, *args):
+        self._seq += 1
+        result = send_task("minion.backend.tasks." + task_name,
+                           [self._scan_id, self._session_id] + list(args),
+                           kwargs={'seq': self._seq},
+                           queue=state_queue(self._scan_id))
+        if not celery.tasks["minion.backend.tasks." + task_name].ignore_result:
+            self._last = result
+        return result
+
+    def wait(self):
+        if self._last is not None:
+            self._last.get(timeout=self.WAIT_TIMEOUT)
+
+class IssueBuffer(object):
+
+    """
+    Collects the issues that a plugin reports so that they can be stored in
+    batches. The buffer should be flushed when it holds max_issues issues or
+    max_bytes of encoded issues, or when the oldest issue in it has waited for
+    max_delay seconds.
+    """
+
+    def __init__(self, max_issues=100, max_bytes=256*1024, max_delay=1.0):
+        self.max_issues = max_issues
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self._issues = []
+        self._bytes = 0
+        self._since = None
+
+    def add(self, issue, size):
+        if not self._issues:
+            self._since = time.time()
+        self._issues.append(issue)
+        self._bytes += size
+
+    def should_flush(self):
+        if not self._issues:
+            return False
+        return (len(self._issues) >= self.max_issues
+                or self._bytes >= self.max_bytes
+                or time.time() - self._since >= self.max_delay)
+
+    def flush(self):
+        issues = self._issues
+        self._issues = []
+        self._bytes = 0
+        self._since = None
+        return issues
+
+#
+# The batch limits can be changed in the backend configuration:
+#
+#   "issue_batching": { "max_issues": 100, "max_bytes": 262144, "max_delay": 1.0 }
+#
+
+def issue_buffer_for_config(cfg):
+    return IssueBuffer(**cfg.get('issue_batching', {}))
+
+class ProgressBuffer(object):
+
+    """
+    Coalesces the progress that a plugin reports. Plugins can report progress
+    as often as they like but only the latest progress is kept and it should
+    be stored at most once every interval seconds.
+    """
+
+    def __init__(self, interval=5.0):
+        self.interval = interval
+        self._progress = None
+        self._last = None
+
+    def add(self, progress):
+        self._progress = progress
+
+    def should_flush(self):
+        if self._progress is None:
+            return False
+        return self._last is None or time.time() - self._last >= self.interval
+
+    def flush(self):
+        progress = self._progress
+        self._progress = None
+        if progress is not None:
+            self._last = time.time()
+        return progress
+
+#
+# How often progress is stored can be changed in the backend configuration:
+#
+#   "progress_reporting": { "interval": 5.0 }
+#
+
+def progress_buffer_for_config(cfg):
+    return ProgressBuffer(**cfg.get('progress_reporting', {}))
+
+@celery.task(bind=True, ignore_result=True, max_retries=None)
+def session_start(self, scan_id, session_id, t, threaded=False, seq=None):
+    update = {"sessions.$.state": "STARTED",
+              "sessions.$.started": datetime.datetime.utcfromtimestamp(t)}
+    if threaded:
+        update["sessions.$._threaded"] = True
+    apply_session_update(self, scan_id, session_id, seq, {"$set": update})
+
+@celery.task(ignore_result=True)
 def session_set_task_id(scan_id, session_id, task_id):
     scans.update({"id": scan_id, "sessions.id": session_id},
                  {"$set": {"sessions.$._task": task_id}})
 
-@celery.task
-def session_report_issue(scan_id, session_id, issue):
-    scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$push": {"sessions.$.issues": issue}})
+#
+# Issues are stored in the issues collection (see issuestore). They are
+# inserted before the ordered update is applied: inserting them again when
+# the update is retried does nothing.
+#
 
-@celery.task
-def session_finish(scan_id, session_id, state, t, failure=None):
-    if failure:
-        scans.update({"id": scan_id, "sessions.id": session_id},
-                     {"$set": {"sessions.$.state": state,
-                               "sessions.$.finished": datetime.datetime.utcfromtimestamp(t),
-                               "sessions.$.failure": failure}})
+_scan_details = {}
+
+def scan_details(scan_id):
+    """ Return the target and plan name of a scan and whether it counts its
+    issues. These never change while the scan runs, so they are remembered. """
+    if scan_id not in _scan_details:
+        scan = scans.find_one({"id": scan_id}, {"configuration.target": 1, "plan.name": 1, "issue_counts": 1})
+        if scan is None:
+            return None, None, False
+        if len(_scan_details) >= 1000:
+            _scan_details.clear()
+        _scan_details[scan_id] = (scan['configuration']['target'], scan['plan']['name'],
+                                  issuestore.complete_counts(scan.get('issue_counts')))
+    return _scan_details[scan_id]
+
+def store_issues(task, scan_id, session_id, issues, seq):
+    target, plan, counted = scan_details(scan_id)
+    issuestore.insert_issues(db.issues, issuestore.issue_documents(scan_id, session_id, target, plan, issues, seq))
+    # The counters are part of the ordered update, so they are incremented once. Scans
+    # created before there were counters are not given partial ones.
+    inc = issuestore.count_increments(issues) if counted else {}
+    apply_session_update(task, scan_id, session_id, seq, {"$inc": inc} if inc else {})
+
+@celery.task(bind=True, ignore_result=True, max_retries=None)
+def session_report_issue(self, scan_id, session_id, issue, seq=None):
+    store_issues(self, scan_id, session_id, [issue], seq)
+
+@celery.task(bind=True, ignore_result=True, max_retries=None)
+def session_report_issues(self, scan_id, session_id, issues, seq=None):
+    store_issues(self, scan_id, session_id, issues, seq)
+
+@celery.task(bind=True, ignore_result=True, max_retries=None)
+def session_report_progress(self, scan_id, session_id, progress, seq=None):
+    apply_session_update(self, scan_id, session_id, seq,
+                         {"$set": {"sessions.$.progress": progress}})
+
+@celery.task(bind=True, max_retries=None)
+def session_finish(self, scan_id, session_id, state, t, failure=None, seq=None):
+    # A session that has been finished already, for example by the session watchdog,
+    # keeps its state. The update still counts in the sequence of the session.
+    scan = scans.find_one({"id": scan_id, "sessions.id": session_id}, {"sessions.$": 1})
+    if scan and scan['sessions'][0]['state'] in DONE_STATES:
+        logger.info("Session %s/%s has already finished as %s" % (scan_id, session_id, scan['sessions'][0]['state']))
+        apply_session_update(self, scan_id, session_id, seq, {})
+    elif failure:
+        apply_session_update(self, scan_id, session_id, seq,
+                             {"$set": {"sessions.$.state": state,
+                                       "sessions.$.finished": datetime.datetime.utcfromtimestamp(t),
+                                       "sessions.$.failure": failure}})
     else:
-        scans.update({"id": scan_id, "sessions.id": session_id},
-                     {"$set": {"sessions.$.state": state,
-                               "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}})
+        apply_session_update(self, scan_id, session_id, seq,
+                             {"$set": {"sessions.$.state": state,
+                                       "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}})
+    # The issues of the session may have arrived after its scan was recorded as finished or stopped
+    record_latest_scan(scan_id)
 
 
 
@@ -245,96 +525,484 @@ plugin_runner_process = None
 #
 #
 
-class Runner(ProcessProtocol):
+def get_scan_state(scan_id, session_id=None):
+    """ Get the scan without the issues of the sessions. When a session_id
+    is given then only that session is returned. """
+    params = {'session_id': session_id} if session_id else {}
+    j = api_client(cfg).get_json("/scans/" + scan_id + "/state", params=params, endpoint="/scans/<id>/state")
+    return j.get('scan')
 
-    def __init__(self, plugin_class, configuration, session_id, callback):
-        self._plugin_class = plugin_class
-        self._configuration = configuration
-        self._session_id = session_id
-        self._callback = callback
-        self._exit_status = None
-        self._process = None
-        self._buffer = ""
+def get_site_info(url):
+    # Sites rarely change, so a recent answer is good enough
+    j = api_client(cfg).get_json('/sites', params={'url': url}, cache=True)
+    return j['sites'][0]
 
-    # ProcessProtocol Methods
+def set_finished(scan_id, state, failure=None):
+    send_task("minion.backend.tasks.scan_finish",
+              [scan_id, state, time.time(), failure],
+              queue=state_queue(scan_id)).get()
 
-    def _parseLines(self, buffer):
-        lines = buffer.split("\n")
-        if len(lines) == 1:
-            return ([], buffer)
-        elif buffer.endswith("\n"):
-            return (lines[0:-1],"")
-        else:
-            return (lines[0:-1],lines[-1])
+#
+# run_plugin
+#
 
-    def outReceived(self, data):
-        # Parse incoming data, taking incomplete lines into account
-        buffer = self._buffer + data
-        lines, self._buffer = self._parseLines(buffer)
-        # Process all the complete lines that we received
-        for line in lines:
-            self._process_message(line)
+#
+# When the backend configuration has a plugin runner pool:
+#
+#   "plugin_runner_pool": { "socket": "/var/run/minion/plugin-runner.sock" }
+#
+# then plugin sessions are forked from a warm minion-plugin-runner --serve
+# process instead of starting a new minion-plugin-runner for every session. If
+# the pool cannot be reached we fall back to starting one ourselves. The pool
+# is off unless it is configured.
+#
+# Whoever listens on the socket chooses the pid that we signal, so the socket
+# is only used when its directory belongs to us and nobody else can write to
+# it, like /var/run/minion with mode 0700.
+#
 
-    def errReceived(self, data):
-        pass # TODO What to do with stderr?
+POOL_CONNECT_TIMEOUT = 10
 
-    def processEnded(self, reason):
-        if isinstance(reason.value, ProcessTerminated):
-            self._exit_status = reason.value.status
-        if isinstance(reason.value, ProcessDone):
-            self._exit_status = reason.value.status
-        self._process = None
-        reactor.stop()
+def trusted_socket_directory(path):
+    st = os.stat(os.path.dirname(os.path.abspath(path)))
+    return st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
 
-    # Runner
+class PooledPluginRunner(object):
 
-    def _process_message(self, message):
-        # TODO Harden this by catching JSON parse errors and invalid messages
-        m = json.loads(message)
-        self._callback(m)
+    """ Looks enough like a subprocess.Popen for run_plugin to use it for a
+    plugin session that runs in the plugin runner pool. The last line the
+    pool sends is the exit status of the session, which is taken out of the
+    output by a relay thread and returned by wait(). """
 
-    def _locate_program(self, program_name):
-        for path in os.getenv('PATH').split(os.pathsep):
-            program_path = os.path.join(path, program_name)
-            if os.path.isfile(program_path) and os.access(program_path, os.X_OK):
-                return program_path
+    def __init__(self, path, plugin, configuration, session_id, scan_id):
+        if not trusted_socket_directory(path):
+            raise socket.error("The directory of %s can be written by others" % path)
+        self.returncode = None
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.socket.settimeout(POOL_CONNECT_TIMEOUT)
+            self.socket.connect(path)
+            self.socket.sendall(json.dumps({"plugin": plugin,
+                                            "configuration": configuration,
+                                            "session_id": session_id,
+                                            "scan_id": scan_id}) + "\n")
+            # Read the hello unbuffered so that all other output is left on the socket
+            hello = ""
+            while not hello.endswith("\n"):
+                c = self.socket.recv(1)
+                if not c:
+                    raise socket.error("Connection closed by the plugin runner pool")
+                hello += c
+            self.pid = json.loads(hello)['data']['pid']
+            self.socket.settimeout(None)
+            read_fd, write_fd = os.pipe()
+            self.stdout = os.fdopen(read_fd, 'rb')
+            # The stderr of the session goes to the log of the pool
+            self.stderr = None
+        except:
+            self.socket.close()
+            raise
+        self._relay = threading.Thread(target=self._relay_output, args=(os.fdopen(write_fd, 'wb'),))
+        self._relay.daemon = True
+        self._relay.start()
+
+    def _relay_output(self, out):
+        try:
+            for line in self.socket.makefile('rb'):
+                if '"exit"' in line:
+                    try:
+                        msg = json.loads(line)
+                    except ValueError:
+                        msg = None
+                    if isinstance(msg, dict) and msg.get('msg') == 'exit':
+                        self.returncode = msg['data']['status']
+                        continue
+                out.write(line)
+                out.flush()
+        except (IOError, socket.error) as e:
+            logger.warning("Lost the connection to the plugin runner pool: %s" % str(e))
+        finally:
+            out.close()
+            self.socket.close()
+
+    def send_signal(self, signum):
+        os.kill(self.pid, signum)
+
+    def wait(self):
+        self._relay.join()
+        if self.returncode is None:
+            # The pool went away before it could tell us how the session ended
+            logger.warning("The plugin runner pool did not report the exit status of %d" % self.pid)
+            self.returncode = 1
+        return self.returncode
+
+def start_plugin_runner(scan_id, session_id, session):
+    pool = cfg.get('plugin_runner_pool', {})
+    if pool.get('socket'):
+        try:
+            return PooledPluginRunner(pool['socket'], session['plugin']['class'],
+                                      session['configuration'], session_id, scan_id)
+        except (socket.error, ValueError, KeyError) as e:
+            logger.warning("Cannot use the plugin runner pool, starting a plugin runner: %s" % str(e))
 
-    def run(self):
+    return subprocess.Popen(plugin_runner_arguments(scan_id, session_id, session),
+                            bufsize=1, stdout=subprocess.PIPE, stderr=subprocess.PIPE, close_fds=True)
 
-        #
-        # Setup the arguments
-        #
+def plugin_runner_arguments(scan_id, session_id, session):
+    return [ "minion-plugin-runner",
+             "-c", json.dumps(session['configuration']),
+             "-p", session['plugin']['class'],
+             "-s", session_id,
+             "--scan-id", scan_id ]
 
-        self._arguments = [ "minion-plugin-runner",
-                           "-c", json.dumps(self._configuration),
-                           "-p", self._plugin_class,
-                           "-s", self._session_id ]
+#
+# The output of a plugin runner is read without threads. PluginOutput polls
+# stdout and stderr and splits stdout into lines as data comes in. Lines
+# longer than MAX_LINE_LENGTH are dropped. The last STDERR_TAIL_BYTES of
+# stderr are kept so they can be added to the failure record of the session.
+#
 
-        #
-        # Spawn a plugin-runner process
-        #
+MAX_LINE_LENGTH = 1024 * 1024
+STDERR_TAIL_BYTES = 16 * 1024
+
+class LineFramer(object):
+
+    """ Splits data into lines as it comes in. Feeding it an empty string
+    marks the end of the data and returns whatever is left as the last line. """
+
+    def __init__(self, max_line_length=MAX_LINE_LENGTH):
+        self.max_line_length = max_line_length
+        self._partial = []
+        self._partial_length = 0
+        self._skipping = False
+
+    def feed(self, data):
+        lines = []
+        if not data:
+            if self._partial_length and not self._skipping:
+                lines.append("".join(self._partial))
+            self._partial = []
+            self._partial_length = 0
+            return lines
+        while data:
+            i = data.find("\n")
+            if i == -1:
+                self._append(data)
+                break
+            self._append(data[:i])
+            if not self._skipping:
+                lines.append("".join(self._partial))
+            self._partial = []
+            self._partial_length = 0
+            self._skipping = False
+            data = data[i+1:]
+        return lines
+
+    def _append(self, data):
+        if self._skipping:
+            return
+        if self._partial_length + len(data) > self.max_line_length:
+            logger.error("Plugin emitted a line longer than %d bytes, ignoring it" % self.max_line_length)
+            self._partial = []
+            self._partial_length = 0
+            self._skipping = True
+            return
+        self._partial.append(data)
+        self._partial_length += len(data)
+
+def stderr_tail(stderr, data, tail_bytes=STDERR_TAIL_BYTES):
+    return (stderr + data)[-tail_bytes:]
+
+class PluginOutput(object):
+
+    def __init__(self, stdout, stderr=None, max_line_length=MAX_LINE_LENGTH, stderr_tail_bytes=STDERR_TAIL_BYTES):
+        self.stderr_tail_bytes = stderr_tail_bytes
+        self.stderr = ""
+        self.closed = False
+        self._framer = LineFramer(max_line_length)
+        self._files = {}
+        self._poll = select.poll()
+        for f in (stdout, stderr):
+            if f is not None:
+                fd = f.fileno()
+                fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+                self._poll.register(fd, select.POLLIN | select.POLLPRI)
+                self._files[fd] = f
+        self._stdout = stdout.fileno()
+
+    def read(self, timeout):
+        """ Wait at most timeout seconds for output and return the complete
+        lines that were read from stdout. Sets closed when both stdout and
+        stderr are done. """
+        lines = []
+        try:
+            events = self._poll.poll(timeout * 1000)
+        except select.error as e:
+            if e.args[0] != errno.EINTR:
+                raise
+            return lines
+        for fd, event in events:
+            try:
+                data = os.read(fd, 65536)
+            except OSError as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    continue
+                raise
+            if fd == self._stdout:
+                lines.extend(self._framer.feed(data))
+            else:
+                self.stderr = stderr_tail(self.stderr, data, self.stderr_tail_bytes)
+            if not data:
+                self._poll.unregister(fd)
+                self._files.pop(fd).close()
+                self.closed = not self._files
+        return lines
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        self._files = {}
+        self.closed = True
+
+def with_stderr(failure, stderr):
+    """ Add the stderr of a plugin runner to a failure record. """
+    if not stderr:
+        return failure
+    if not isinstance(failure, dict):
+        failure = { "hostname": socket.gethostname(),
+                    "message": failure or "The plugin failed",
+                    "exception": None }
+    failure = dict(failure)
+    failure['stderr'] = stderr
+    return failure
+
+class PluginSession(object):
+
+    """ Turns the messages of a plugin runner into state updates of its plugin
+    session. Session updates are sent without waiting for them; end() waits
+    for the last one. """
+
+    def __init__(self, scan_id, session_id):
+        self.scan_id = scan_id
+        self.session_id = session_id
+        self.updates = SessionUpdates(scan_id, session_id)
+        self.issues = issue_buffer_for_config(cfg)
+        self.progress = progress_buffer_for_config(cfg)
+        self.started = False
+        self.finished = None
+        self.stderr = ""
+
+    def start(self, threaded=False):
+        self.updates.send("session_start", time.time(), threaded)
+
+    def handle_line(self, line):
+
+        line = line.strip()
+        if not line:
+            return
 
-        plugin_runner_path = self._locate_program("minion-plugin-runner")
-        if plugin_runner_path is None:
-            # TODO EMIT FAILURE
-            return False
+        if self.finished is not None:
+            logger.error("Plugin emitted (ignored) message after finishing: " + line)
+            return
 
-        self._process = reactor.spawnProcess(self, plugin_runner_path, self._arguments, env=None)
+        msg = json.loads(line)
+
+        # Start: the plugin runner is ready to be stopped with USR1
+        if msg['msg'] == 'start':
+            self.started = True
+
+        # Issue: buffer it, it is persisted with the next batch
+        if msg['msg'] == 'issue':
+            self.issues.add(msg['data'], len(line))
+
+        # Progress: keep the latest, it is persisted with the next tick
+        if msg['msg'] == 'progress':
+            self.progress.add({"percentage": msg['data'].get('percentage'),
+                               "description": msg['data'].get('description')})
+
+        # Finish: update the session state. A state we do not know fails the session.
+        if msg['msg'] == 'finish':
+            self.flush_issues()
+            self.flush_progress()
+            self.finished = msg['data']['state']
+            failure = msg['data'].get('failure')
+            if self.finished not in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
+                failure = { "hostname": socket.gethostname(),
+                            "message": "The plugin finished in unknown state %s" % self.finished,
+                            "exception": None }
+                self.finished = 'FAILED'
+            if self.finished == 'FAILED':
+                failure = with_stderr(failure, self.stderr)
+            self.updates.send("session_finish", self.finished, time.time(), failure)
+
+    def tick(self):
+        if self.issues.should_flush():
+            self.flush_issues()
+        if self.progress.should_flush():
+            self.flush_progress()
+
+    def flush_issues(self):
+        batch = self.issues.flush()
+        if batch:
+            self.updates.send("session_report_issues", batch)
+
+    def flush_progress(self):
+        progress = self.progress.flush()
+        if progress is not None:
+            self.updates.send("session_report_progress", progress)
+
+    def end(self):
+        """ Called when the plugin runner has exited. Returns the state in
+        which the session finished. """
+        self.flush_issues()
+        self.flush_progress()
+        if not self.finished:
+            failure = { "hostname": socket.gethostname(),
+                        "message": "The plugin did not finish correctly",
+                        "exception": None }
+            failure = with_stderr(failure, self.stderr)
+            if self.stderr:
+                logger.warning("Plugin session %s/%s did not finish correctly: %s" % (self.scan_id, self.session_id, self.stderr))
+            self.updates.send("session_finish", 'FAILED', time.time(), failure)
+            self.finished = 'FAILED'
+        self.updates.wait()
+        return self.finished
+
+def supervise_plugin_runner(plugin_session, p):
+
+    """ Feed the output of the plugin runner p to the plugin session until
+    the plugin runner exits. A USR1 signal, which we get when the task is
+    revoked, is passed on to the plugin runner to stop it. When the output
+    cannot be handled, for example because it is not JSON, the plugin
+    runner is killed and the exception is raised, which fails the session. """
+
+    def signal_handler(signum, frame):
+        p.send_signal(signal.SIGUSR1)
+
+    signal.signal(signal.SIGUSR1, signal_handler)
+    try:
+        output = PluginOutput(p.stdout, p.stderr)
+        try:
+            while not output.closed:
+                lines = output.read(0.25)
+                plugin_session.stderr = output.stderr
+                for line in lines:
+                    plugin_session.handle_line(line)
+                plugin_session.tick()
+        except Exception:
+            logger.exception("Error while handling plugin runner output. Killing the plugin runner.")
+            try:
+                p.send_signal(signal.SIGKILL)
+            except OSError:
+                pass
+            output.close()
+            p.wait()
+            raise
+        p.wait()
+    finally:
+        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
 
-        #
-        # Run the twisted reactor. It will be stopped either when the plugin-runner has
-        # finished or when it has timed out.
-        #
+#
+# Plugin workers started with 'minion-plugin-worker async' use the threads
+# pool and run many plugin sessions in one process. Those sessions are not
+# supervised by their task thread but by a single PluginSupervisor that runs
+# all plugin runners on a twisted reactor in a background thread. The task
+# thread only waits for its plugin runner to exit.
+#
+# A task thread cannot be signalled when its task is revoked, so the
+# supervisor regularly checks which of its tasks have been revoked instead.
+# The threads pool cannot terminate a task either, so these sessions are
+# marked _threaded and revoked without terminate (see revoke_session).
+#
+# The plugin session sends its updates with send_task, which can block, so
+# the reactor hands the output of a runner to the reactor thread pool. The
+# calls of one runner are made one after the other, in order.
+#
+
+def in_task_thread():
+    return not isinstance(threading.current_thread(), threading._MainThread)
+
+class Runner(ProcessProtocol):
+
+    """ A plugin runner process supervised by the PluginSupervisor. """
+
+    # Seconds a plugin runner has to emit its start message before a stop
+    # kills it instead of signalling it
+    START_TIMEOUT = 10
 
-        reactor.run()
+    def __init__(self, plugin_session):
+        self.plugin_session = plugin_session
+        self.done = threading.Event()
+        self.error = None
+        self.exit_status = None
+        self.stopping = False
+        self._framer = LineFramer()
+        self._process = None
+        self._terminate_id = None
+        self._spawned = None
+        self._calls = defer.succeed(None)
+        self._ticking = False
+
+    def _call(self, f, *args):
+        """ Call f in the reactor thread pool after the calls before it. """
+        def failed(failure):
+            logger.error("Error while handling plugin runner output: " + failure.getTraceback())
+            if self.error is None:
+                self.error = (failure.type, failure.value, failure.getTracebackObject())
+            self.terminate()
+        self._calls.addCallback(lambda _: deferToThread(f, *args)).addErrback(failed)
+
+    def _handle_lines(self, lines):
+        for line in lines:
+            self.plugin_session.handle_line(line)
+
+    def _add_stderr(self, data):
+        self.plugin_session.stderr = stderr_tail(self.plugin_session.stderr, data)
+
+    def _tick(self):
+        try:
+            self.plugin_session.tick()
+        except Exception:
+            logger.exception("Error while sending plugin session updates")
+        finally:
+            self._ticking = False
 
-        return self._exit_status
+    def outReceived(self, data):
+        lines = self._framer.feed(data)
+        if lines:
+            self._call(self._handle_lines, lines)
+
+    def errReceived(self, data):
+        self._call(self._add_stderr, data)
+
+    def tick(self):
+        if not self._ticking:
+            self._ticking = True
+            self._call(self._tick)
+
+    def processEnded(self, reason):
+        lines = self._framer.feed("")
+        if lines:
+            self._call(self._handle_lines, lines)
+        if isinstance(reason.value, (ProcessDone, ProcessTerminated)):
+            self.exit_status = reason.value.exitCode
+        self._process = None
+        if self._terminate_id is not None and self._terminate_id.active():
+            self._terminate_id.cancel()
+        self._calls.addCallback(lambda _: self.done.set())
+
+    def spawn(self, arguments):
+        path = locate_program(arguments[0])
+        if path is None:
+            raise Exception("Cannot find %s" % arguments[0])
+        self._process = reactor.spawnProcess(self, path, arguments, env=os.environ)
+        self._spawned = time.time()
 
     def terminate(self):
         if self._process is not None:
             try:
                 self._process.signalProcess('KILL')
-            except ProcessExitedAlready as e:
+            except ProcessExitedAlready:
                 pass
         if self._terminate_id is not None:
             if self._terminate_id.active():
@@ -348,36 +1016,91 @@ class Runner(ProcessProtocol):
         # start a timer to force kill the runner if it does not stop
         # on time.
         #
+        # Until the runner has emitted its start message it has not
+        # installed its USR1 handler and the signal would kill it, so the
+        # stop is left for a later tick. A runner that does not start on
+        # time is killed.
+        #
 
-        self._process.signalProcess(signal.SIGUSR1)
-        self._terminate_id = reactor.callLater(10, self.terminate)
-
-
-def get_scan(api_url, scan_id):
-    r = requests.get(api_url + "/scans/" + scan_id)
-    r.raise_for_status()
-    j = r.json()
-    return j['scan']
-
-def get_site_info(api_url, url):
-    r = requests.get(api_url + '/sites', params={'url': url})
-    r.raise_for_status()
-    j = r.json()
-    return j['sites'][0]
-
-def set_finished(scan_id, state, failure=None):
-    send_task("minion.backend.tasks.scan_finish",
-              [scan_id, state, time.time(), failure],
-              queue='state').get()
+        if not self.plugin_session.started:
+            if time.time() - self._spawned < self.START_TIMEOUT:
+                return
+            self.stopping = True
+            self.terminate()
+            return
 
-#
-# run_plugin
-#
+        self.stopping = True
+        try:
+            self._process.signalProcess(signal.SIGUSR1)
+        except ProcessExitedAlready:
+            return
+        self._terminate_id = reactor.callLater(10, self.terminate)
 
-def find_session(scan, session_id):
-    for session in scan['sessions']:
-        if session['id'] == session_id:
-            return session
+def revoke_session(session):
+    """ Revoke the task of a plugin session. A prefork worker passes USR1
+    on to the plugin runner, a session that runs in a task thread is
+    stopped by the PluginSupervisor when it sees the revoke. """
+    if session.get('_threaded'):
+        revoke(session['_task'])
+    else:
+        revoke(session['_task'], terminate=True, signal='SIGUSR1')
+
+def locate_program(program_name):
+    for path in os.getenv('PATH').split(os.pathsep):
+        program_path = os.path.join(path, program_name)
+        if os.path.isfile(program_path) and os.access(program_path, os.X_OK):
+            return program_path
+
+class PluginSupervisor(object):
+
+    TICK = 0.25
+
+    def __init__(self):
+        self.runners = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def _start_reactor(self):
+        with self._lock:
+            if self._thread is None:
+                # Without signal handlers the reactor does not notice exiting
+                # processes by itself, _tick reaps them.
+                self._thread = threading.Thread(target=reactor.run, kwargs={'installSignalHandlers': False})
+                self._thread.daemon = True
+                self._thread.start()
+                reactor.callFromThread(LoopingCall(self._tick).start, self.TICK)
+
+    def run(self, task_id, plugin_session, arguments):
+        """ Run a plugin runner for plugin_session and wait for it to exit. """
+        self._start_reactor()
+        runner = Runner(plugin_session)
+        reactor.callFromThread(self._spawn, task_id, runner, arguments)
+        while not runner.done.wait(1.0):
+            pass
+        if runner.error is not None:
+            raise runner.error[0], runner.error[1], runner.error[2]
+        return runner.exit_status
+
+    def _spawn(self, task_id, runner, arguments):
+        try:
+            runner.spawn(arguments)
+            self.runners[task_id] = runner
+        except Exception:
+            runner.error = sys.exc_info()
+            runner.done.set()
+
+    def _tick(self):
+        reapAllProcesses()
+        for task_id, runner in self.runners.items():
+            if runner.done.is_set():
+                del self.runners[task_id]
+                continue
+            runner.tick()
+            if task_id in worker_state.revoked and not runner.stopping:
+                logger.info("Stopping plugin session %s/%s" % (runner.plugin_session.scan_id, runner.plugin_session.session_id))
+                runner.schedule_stop()
+
+supervisor = PluginSupervisor()
 
 @celery.task
 def run_plugin(scan_id, session_id):
@@ -387,126 +1110,59 @@ def run_plugin(scan_id, session_id):
     try:
 
         #
-        # Find the scan for this plugin session. Bail out if the scan has been marked as STOPPED or if
-        # the state is not STARTED.
+        # Find the scan and the plugin session. The session is QUEUED and only this task is going to
+        # finish it, so when they cannot be loaded we raise, which marks the session FAILED below.
         #
 
-        scan = get_scan(cfg['api']['url'], scan_id)
+        scan = get_scan_state(scan_id, session_id)
         if not scan:
-            logger.error("Cannot load scan %s" % scan_id)
-            return
+            raise Exception("Cannot load scan %s" % scan_id)
+
+        session = find_session(scan, session_id)
+        if not session:
+            raise Exception("Cannot find session %s/%s" % (scan_id, session_id))
+
+        #
+        # Bail out if the scan has been marked as STOPPED, scan_stop has stopped the session already.
+        # When the scan is not STARTED anymore, for example because another session aborted it, the
+        # session is cancelled.
+        #
 
         if scan['state'] in ('STOPPING', 'STOPPED'):
             return
 
         if scan['state'] != 'STARTED':
             logger.error("Scan %s has invalid state. Expected STARTED but got %s" % (scan_id, scan['state']))
+            if session['state'] == 'QUEUED':
+                send_task("minion.backend.tasks.session_finish",
+                          [scan_id, session_id, "CANCELLED", time.time()],
+                          queue=state_queue(scan_id)).get()
+                return "CANCELLED"
             return
 
         #
-        # Find the plugin session in the scan. Bail out if the session has been marked as STOPPED or if
-        # the state is not QUEUED.
+        # Bail out if the session is not QUEUED. Then it has been finished already or another
+        # delivery of this task is running it.
         #
 
-        session = find_session(scan, session_id)
-        if not session:
-            logger.error("Cannot find session %s/%s" % (scan_id, session_id))
-            return
-
         if session['state'] != 'QUEUED':
             logger.error("Session %s/%s has invalid state. Expected QUEUED but got %s" % (scan_id, session_id, session['state']))
             return
 
         #
-        # Move the session in the STARTED state
+        # Move the session in the STARTED state and run the plugin
         #
-        send_task("minion.backend.tasks.session_start",
-                  [scan_id, session_id, time.time()],
-                  queue='state').get()
 
-        finished = None
+        threaded = in_task_thread()
+        plugin_session = PluginSession(scan_id, session_id)
+        plugin_session.start(threaded)
 
-        #
-        # This is an experiment to see if removing Twisted makes the celery workers more stable.
-        #
-
-        def enqueue_output(fd, queue):
-            try:
-                for line in iter(fd.readline, b''):
-                    queue.put(line)
-            except Exception as e:
-                logger.exception("Error while reading a line from the plugin-runner")
-            finally:
-                fd.close()
-                queue.put(None)
-
-        def make_signal_handler(p):
-            def signal_handler(signum, frame):
-                p.send_signal(signal.SIGUSR1)
-            return signal_handler
-
-        arguments = [ "minion-plugin-runner",
-                      "-c", json.dumps(session['configuration']),
-                      "-p", session['plugin']['class'],
-                      "-s", session_id ]
-
-        p = subprocess.Popen(arguments, bufsize=1, stdout=subprocess.PIPE, close_fds=True)
-
-        signal.signal(signal.SIGUSR1, make_signal_handler(p))
-
-        q = Queue.Queue()
-        t = threading.Thread(target=enqueue_output, args=(p.stdout, q))
-        t.daemon = True
-        t.start()
-
-        while True:
-            try:
-                line = q.get(timeout=0.25)
-                if line is None:
-                    break
-
-                line = line.strip()
-
-                if finished is not None:
-                    logger.error("Plugin emitted (ignored) message after finishing: " + line)
-                    return
-
-                msg = json.loads(line)
-
-                # Issue: persist it
-                if msg['msg'] == 'issue':
-                    send_task("minion.backend.tasks.session_report_issue",
-                              args=[scan_id, session_id, msg['data']],
-                              queue='state').get()
-
-                # Progress: update the progress
-                if msg['msg'] == 'progress':
-                    pass # TODO
-
-                # Finish: update the session state, wait for the plugin runner to finish, return the state
-                if msg['msg'] == 'finish':
-                    finished = msg['data']['state']
-                    if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], session['id'], msg['data']['state'], time.time(), msg['data']['failure']],
-                                  queue='state').get()
-
-            except Queue.Empty:
-                pass
-
-        return_code = p.wait()
-
-        signal.signal(signal.SIGUSR1, signal.SIG_DFL)
-
-        if not finished:
-            failure = { "hostname": socket.gethostname(),
-                        "message": "The plugin did not finish correctly",
-                        "exception": None }
-            send_task("minion.backend.tasks.session_finish",
-                      [scan['id'], session['id'], 'FAILED', time.time(), failure],
-                      queue='state').get()
+        if threaded:
+            supervisor.run(run_plugin.request.id, plugin_session, plugin_runner_arguments(scan_id, session_id, session))
+        else:
+            supervise_plugin_runner(plugin_session, start_plugin_runner(scan_id, session_id, session))
 
-        return finished
+        return plugin_session.end()
 
     except Exception as e:
 
@@ -524,7 +1180,7 @@ def run_plugin(scan_id, session_id):
                         "exception": traceback.format_exc() }
             send_task("minion.backend.tasks.session_finish",
                       [scan_id, session_id, "FAILED", time.time(), failure],
-                      queue='state').get()
+                      queue=state_queue(scan_id)).get()
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
@@ -541,12 +1197,6 @@ def run_plugin(scan_id, session_id):
 
 
 
-def get_scan(api_url, scan_id):
-    r = requests.get(api_url + "/scans/" + scan_id)
-    r.raise_for_status()
-    j = r.json()
-    return j['scan']
-
 def queue_for_session(session, cfg):
     queue = 'plugin'
     if 'plugin_worker_queues' in cfg:
@@ -555,6 +1205,232 @@ def queue_for_session(session, cfg):
             queue = cfg['plugin_worker_queues'][weight]
     return queue
 
+def dispatch_ready_sessions(scan):
+
+    """
+    Queue and dispatch all sessions of the scan whose dependencies are done. Each
+    run_plugin task is linked to scan_session_done, which continues the scan when
+    the session has finished. Returns the number of sessions dispatched.
+    """
+
+    dispatched = 0
+
+    for session in ready_sessions(scan['sessions']):
+
+        #
+        # Mark the session as QUEUED. This is a claim: when more than one completion
+        # callback of the same scan runs at the same time, only one gets to dispatch
+        # the session. If we lost, someone else is running it.
+        #
+
+        #scans.update({"id": scan['id'], "sessions.id": session['id']}, {"$set": {"sessions.$.state": "QUEUED", "sessions.$.queued": datetime.datetime.utcnow()}})
+        claimed = send_task("minion.backend.tasks.session_queue",
+                            [scan['id'], session['id'], time.time()],
+                            queue=state_queue(scan['id'])).get()
+        session['state'] = 'QUEUED'
+        if not claimed:
+            continue
+
+        #
+        # Execute the plugin. The plugin worker will set the session state and issues.
+        #
+
+        logger.info("Scan %s running plugin %s" % (scan['id'], session['plugin']['class']))
+
+        queue = queue_for_session(session, cfg)
+        result = send_task("minion.backend.tasks.run_plugin",
+                           [scan['id'], session['id']],
+                           queue=queue,
+                           link=scan_session_done.subtask((scan['id'], session['id']), queue='scan'),
+                           link_error=scan_session_error.subtask((scan['id'], session['id']), queue='scan'))
+
+        #scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$._task": result.id}})
+        send_task("minion.backend.tasks.session_set_task_id",
+                  [scan['id'], session['id'], result.id],
+                  queue=state_queue(scan['id']))
+
+        dispatched += 1
+
+    return dispatched
+
+def advance_scan(scan):
+
+    """
+    Move a STARTED scan forward: dispatch what can run and finish the scan when
+    there is nothing left to run.
+    """
+
+    dispatch_ready_sessions(scan)
+
+    if any(session['state'] in ('QUEUED', 'STARTED') for session in scan['sessions']):
+        return
+
+    #
+    # Move the scan to the FINISHED state
+    #
+
+    scan['state'] = 'FINISHED'
+
+    #
+    # If one of the plugin has failed then marked the scan as failed
+    #
+    for session in scan['sessions']:
+        if session['state'] == 'FAILED':
+            scan['state'] = 'FAILED'
+
+    #scans.update({"id": scan_id}, {"$set": {"state": "FINISHED", "finished": datetime.datetime.utcnow()}})
+    send_task("minion.backend.tasks.scan_finish",
+              [scan['id'], scan['state'], time.time()],
+              queue=state_queue(scan['id'])).get()
+
+def stop_scan(scan, state):
+
+    """
+    Stop the scan because a session ended in the given state or because the
+    user stopped it. Sessions that are still running are revoked and sessions
+    that did not run yet are cancelled.
+    """
+
+    for session in scan['sessions']:
+        if session['state'] in ('QUEUED', 'STARTED') and session.get('_task'):
+            revoke_session(session)
+
+    # Mark the scan as failed
+    #scans.update({"id": scan_id}, {"$set": {"state": plugin_result, "finished": datetime.datetime.utcnow()}})
+    send_task("minion.backend.tasks.scan_finish",
+              [scan['id'], state, time.time()],
+              queue=state_queue(scan['id'])).get()
+
+    # Mark all remaining sessions as cancelled
+    for s in scan['sessions']:
+        if s['state'] == 'CREATED':
+            s['state'] = 'CANCELLED'
+            #scans.update({"id": scan['id'], "sessions.id": s['id']}, {"$set": {"sessions.$.state": "CANCELLED", "sessions.$.finished": datetime.datetime.utcnow()}})
+            send_task("minion.backend.tasks.session_finish",
+                      [scan['id'], s['id'], "CANCELLED", time.time()],
+                      queue=state_queue(scan['id'])).get()
+
+def _session_done(scan_id, session_id, plugin_result, failure=None):
+
+    try:
+
+        scan = get_scan_state(scan_id)
+        if not scan:
+            logger.error("Cannot load scan %s" % scan_id)
+            return
+
+        #
+        # Nothing to do when the scan has already been finished, for example
+        # because an other session aborted it.
+        #
+
+        if scan.get('finished') or scan['state'] not in ('STARTED', 'STOPPING', 'STOPPED'):
+            return
+
+        #
+        # The stored state of a finished session is what counts. The session watchdog
+        # fails a session and then stops its plugin, which then ends as STOPPED. That
+        # should not stop the whole scan.
+        #
+
+        session = find_session(scan, session_id)
+        if session and session['state'] in DONE_STATES:
+            plugin_result = session['state']
+        elif session and plugin_result in DONE_STATES:
+            session['state'] = plugin_result
+            # With a failure the plugin worker did not get to store the state itself
+            if failure:
+                send_task("minion.backend.tasks.session_finish",
+                          [scan_id, session_id, plugin_result, time.time(), failure],
+                          queue=state_queue(scan_id)).get()
+
+        #
+        # If the user stopped the workflow or if the plugin aborted then stop the whole scan
+        #
+
+        if scan['state'] in ('STOPPING', 'STOPPED'):
+            return stop_scan(scan, 'STOPPED')
+
+        if plugin_result in STOP_STATES:
+            return stop_scan(scan, plugin_result)
+
+        advance_scan(scan)
+
+    except Exception as e:
+
+        logger.exception("Error while continuing scan. Marking scan FAILED.")
+
+        try:
+            failure = { "hostname": socket.gethostname(),
+                        "reason": "backend-exception",
+                        "message": str(e),
+                        "exception": traceback.format_exc() }
+            send_task("minion.backend.tasks.scan_finish",
+                      [scan_id, "FAILED", time.time(), failure],
+                      queue=state_queue(scan_id)).get()
+        except Exception as e:
+            logger.exception("Error when marking scan as FAILED")
+
+@celery.task(ignore_result=True)
+def scan_session_done(plugin_result, scan_id, session_id):
+    _session_done(scan_id, session_id, plugin_result)
+
+@celery.task(ignore_result=True)
+def scan_session_error(task_id, scan_id, session_id):
+    logger.error("Plugin task %s for session %s/%s failed" % (task_id, scan_id, session_id))
+    failure = { "hostname": socket.gethostname(),
+                "message": "The plugin task %s failed" % task_id,
+                "exception": None }
+    _session_done(scan_id, session_id, "FAILED", failure)
+
+#
+# The completion callbacks of run_plugin are not called when the plugin worker
+# process running it dies: celery then only stores a WorkerLostError as the
+# result of the task. check_sessions, which celery beat runs every minute (see
+# celeryconfig), fails the sessions of STARTED scans whose task has failed
+# without anyone noticing or that have been running for longer than the session
+# timeout, and continues their scans. The timeout can be changed in the backend
+# configuration:
+#
+#   "session_watchdog": { "timeout": 86400 }
+#
+
+SESSION_TIMEOUT = 86400
+
+def lost_session(session, now, timeout):
+    """ Return why the QUEUED or STARTED session will not finish by itself, or
+    None when it may still finish. Only the task of a STARTED session can be
+    lost with its worker, so only those task results are looked at. """
+    if session['state'] == 'STARTED' and session.get('_task') and celery.AsyncResult(session['_task']).state == 'FAILURE':
+        return "The plugin task %s failed" % session['_task']
+    since = session.get('started') or session.get('queued')
+    if since and now - since > datetime.timedelta(seconds=timeout):
+        return "The plugin session did not finish within %d seconds" % timeout
+
+@celery.task(ignore_result=True)
+def check_sessions():
+
+    timeout = cfg.get('session_watchdog', {}).get('timeout', SESSION_TIMEOUT)
+    now = datetime.datetime.utcnow()
+
+    for scan in scans.find({"state": "STARTED", "sessions.state": {"$in": ["QUEUED", "STARTED"]}},
+                           {"id": 1, "sessions.id": 1, "sessions.state": 1, "sessions._task": 1, "sessions._threaded": 1,
+                            "sessions.queued": 1, "sessions.started": 1}):
+        for session in scan['sessions']:
+            if session['state'] not in ('QUEUED', 'STARTED'):
+                continue
+            message = lost_session(session, now, timeout)
+            if message is None:
+                continue
+            logger.error("Failing plugin session %s/%s: %s" % (scan['id'], session['id'], message))
+            if session.get('_task'):
+                revoke_session(session)
+            failure = { "hostname": socket.gethostname(),
+                        "reason": "session-lost",
+                        "message": message,
+                        "exception": None }
+            _session_done(scan['id'], session['id'], "FAILED", failure)
+
 @celery.task(ignore_result=True)
 def scan(scan_id):
 
@@ -564,7 +1440,7 @@ def scan(scan_id):
         # See if the scan exists.
         #
 
-        scan = get_scan(cfg['api']['url'], scan_id)
+        scan = get_scan_state(scan_id)
         if not scan:
             logger.error("Cannot load scan %s" % scan_id)
             return
@@ -584,7 +1460,7 @@ def scan(scan_id):
         scan['state'] = 'STARTED'
         send_task("minion.backend.tasks.scan_start",
                   [scan_id, time.time()],
-                  queue='state').get()
+                  queue=state_queue(scan_id)).get()
 
         #
         # Check this site against the access control lists
@@ -603,7 +1479,7 @@ def scan(scan_id):
         #
 
         target = scan['configuration']['target']
-        site = get_site_info(cfg['api']['url'], target)
+        site = get_site_info(target)
         if not site:
             return set_finished(scan_id, 'ABORTED')
 
@@ -616,82 +1492,11 @@ def scan(scan_id):
                 return set_finished(scan_id, 'ABORTED', failure=failure)
 
         #
-        # Run each plugin session
+        # Dispatch the sessions that can run right away. The scan task is done after
+        # that; the rest of the scan is driven by the plugin completion callbacks.
         #
 
-        for session in scan['sessions']:
-
-            #
-            # Mark the session as QUEUED
-            #
-
-            session['state'] = 'QUEUED'
-            #scans.update({"id": scan['id'], "sessions.id": session['id']}, {"$set": {"sessions.$.state": "QUEUED", "sessions.$.queued": datetime.datetime.utcnow()}})
-            send_task("minion.backend.tasks.session_queue",
-                      [scan['id'], session['id'], time.time()],
-                      queue='state').get()
-
-            #
-            # Execute the plugin. The plugin worker will set the session state and issues.
-            #
-
-            logger.info("Scan %s running plugin %s" % (scan['id'], session['plugin']['class']))
-
-            queue = queue_for_session(session, cfg)
-            result = send_task("minion.backend.tasks.run_plugin",
-                               [scan_id, session['id']],
-                               queue=queue)
-
-            #scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$._task": result.id}})
-            send_task("minion.backend.tasks.session_set_task_id",
-                      [scan_id, session['id'], result.id],
-                      queue='state').get()
-
-            try:
-                plugin_result = result.get()
-            except TaskRevokedError as e:
-                plugin_result = "STOPPED"
-
-            session['state'] = plugin_result
-
-            #
-            # If the user stopped the workflow or if the plugin aborted then stop the whole scan
-            #
-
-            if plugin_result in ('ABORTED', 'STOPPED'):
-                # Mark the scan as failed
-                #scans.update({"id": scan_id}, {"$set": {"state": plugin_result, "finished": datetime.datetime.utcnow()}})
-                send_task("minion.backend.tasks.scan_finish",
-                          [scan_id, plugin_result, time.time()],
-                          queue='state').get()
-                # Mark all remaining sessions as cancelled
-                for s in scan['sessions']:
-                    if s['state'] == 'CREATED':
-                        s['state'] = 'CANCELLED'
-                        #scans.update({"id": scan['id'], "sessions.id": s['id']}, {"$set": {"sessions.$.state": "CANCELLED", "sessions.$.finished": datetime.datetime.utcnow()}})
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], s['id'], "CANCELLED", time.time()],
-                                  queue='state').get()
-                # We are done with this scan
-                return
-
-        #
-        # Move the scan to the FINISHED state
-        #
-
-        scan['state'] = 'FINISHED'
-
-        #
-        # If one of the plugin has failed then marked the scan as failed
-        #
-        for session in scan['sessions']:
-            if session['state'] == 'FAILED':
-                scan['state'] = 'FAILED'
-
-        #scans.update({"id": scan_id}, {"$set": {"state": "FINISHED", "finished": datetime.datetime.utcnow()}})
-        send_task("minion.backend.tasks.scan_finish",
-                  [scan_id, scan['state'], time.time()],
-                  queue='state').get()
+        advance_scan(scan)
 
     except Exception as e:
 
@@ -710,6 +1515,6 @@ def scan(scan_id):
                         "exception": traceback.format_exc() }
             send_task("minion.backend.tasks.scan_finish",
                       [scan_id, "FAILED", time.time(), failure],
-                      queue='state').get()
+                      queue=state_queue(scan_id)).get()
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
@@ -1,5 +1,6 @@
 #!/usr/bin/env python
 
+import base64
 import calendar
 import functools
 import importlib
@@ -8,9 +9,11 @@ import json
 import pkgutil
 import operator
 
-from flask import abort, Flask, jsonify, request, session
-from pymongo import MongoClient
+from bson import json_util
+from flask import abort, Flask, g, has_app_context, json as flask_json, jsonify, request, session, Response, stream_with_context
+from pymongo import ASCENDING, MongoClient
 
+from minion.backend.acl import ACLIndex, bump_version
 from minion.backend.app import app
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
@@ -23,10 +26,22 @@ invites = mongo_client.minion.invites
 groups = mongo_client.minion.groups
 plans = mongo_client.minion.plans
 scans = mongo_client.minion.scans
+issues = mongo_client.minion.issues
+latest_scans = mongo_client.minion.latest_scans
 sites = mongo_client.minion.sites
 users = mongo_client.minion.users
 scanschedules = mongo_client.minion.scanschedule
 siteCredentials = mongo_client.minion.siteCredentials
+counters = mongo_client.minion.counters
+
+# Who can see which sites and plans, see acl.py. Views that change users,
+# groups, sites or plans call acl_changed() after their write. The version
+# of the index is checked once per request.
+acl = ACLIndex(users, groups, sites, plans, counters, scope=lambda: g if has_app_context() else None)
+
+def acl_changed():
+    bump_version(counters)
+    acl.changed()
 
 def api_guard(*decor_args):
     """ Decorate a view function to be protected by requiring
@@ -112,6 +127,138 @@ def _check_required_fields(expected, fields):
             return False
     return True
 
+#
+# Listing endpoints accept a sparse fieldset: ?fields=id,url only returns
+# those fields of every item. The fields also become the projection of the
+# query so that MongoDB does not send the rest.
+#
+
+def requested_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return None
+    return [field.strip() for field in fields.split(',') if field.strip()]
+
+def fields_projection(fields, required=()):
+    """ Return the projection for the requested fields plus the fields
+    that are required to build the response, or None for all fields. """
+    if fields is None:
+        return None
+    projection = dict((field, 1) for field in list(fields) + list(required))
+    projection['_id'] = 0
+    return projection
+
+def wants_field(fields, field):
+    return fields is None or field in fields
+
+def sparse(document, fields):
+    if fields is None:
+        return document
+    return dict((field, document[field]) for field in fields if field in document)
+
+#
+# Listing endpoints can be paged with ?limit=N. The response then has a
+# 'next' cursor which, passed as ?after=<cursor>, returns the next page.
+# A cursor is an opaque token holding the sort key of the last document of
+# the page. Without ?limit= and ?after= listings return what they always
+# returned.
+#
+# With ?stream=ndjson the items are written one JSON document per line and
+# with ?stream=json as a plain JSON array. Streamed listings are written
+# while the MongoDB cursor is read, so the whole listing is never held in
+# memory.
+#
+
+MAX_PAGE_SIZE = 1000
+
+class InvalidCursor(Exception):
+    pass
+
+def _encode_cursor(value, _id):
+    return base64.urlsafe_b64encode(json_util.dumps([value, _id]))
+
+def _decode_cursor(token):
+    try:
+        value, _id = json_util.loads(base64.urlsafe_b64decode(str(token)))
+    except (TypeError, ValueError):
+        raise InvalidCursor()
+    return value, _id
+
+def _after_query(query, after, field, direction):
+    value, _id = _decode_cursor(after)
+    op = "$gt" if direction == ASCENDING else "$lt"
+    if field == '_id':
+        condition = {"_id": {op: _id}}
+    else:
+        condition = {"$or": [{field: {op: value}}, {field: value, "_id": {op: _id}}]}
+    return {"$and": [query, condition]} if query else condition
+
+def _page_projection(projection, field):
+    # The sort key has to be returned to build the next cursor
+    if projection is None:
+        return None
+    projection = dict(projection)
+    if any(v for k, v in projection.items() if k != '_id'):
+        projection[field] = 1
+    else:
+        projection.pop(field, None)
+    projection['_id'] = 1
+    return projection
+
+def listing(name, collection, query, transform, projection=None, order=('_id', ASCENDING),
+            default_limit=None, assemble=None, extra=None):
+    """ Respond with transform(document) for every document that matches
+    the query, as the name field of the response. assemble can turn the
+    list of items into the value of that field. extra holds more fields for
+    the response, these are not streamed. Listings that assemble their items
+    are not streamed either, they always get the regular response. """
+    field, direction = order
+    limit = request.args.get('limit', default_limit)
+    after = request.args.get('after')
+    stream = request.args.get('stream') if assemble is None else None
+    try:
+        if after:
+            query = _after_query(query, after, field, direction)
+        if limit is not None:
+            limit = min(max(int(limit), 1), MAX_PAGE_SIZE)
+    except InvalidCursor:
+        return jsonify(success=False, reason='invalid-cursor')
+    except ValueError:
+        return jsonify(success=False, reason='invalid-limit')
+
+    cursor = collection.find(query, _page_projection(projection, field)).sort([(field, direction), ('_id', direction)])
+    if limit is not None:
+        # One more than asked for tells us whether there is a next page
+        cursor = cursor.limit(limit + (0 if stream else 1))
+
+    if stream == 'ndjson':
+        def generate():
+            for document in cursor:
+                yield flask_json.dumps(transform(document)) + "\n"
+        return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if stream == 'json':
+        def generate():
+            yield "["
+            for n, document in enumerate(cursor):
+                yield ("," if n else "") + flask_json.dumps(transform(document))
+            yield "]"
+        return Response(stream_with_context(generate()), mimetype='application/json')
+
+    items, last, more = [], None, False
+    for document in cursor:
+        if limit is not None and len(items) == limit:
+            more = True
+            break
+        last = (document.get(field), document['_id'])
+        items.append(transform(document))
+    response = dict(extra or {})
+    response[name] = assemble(items) if assemble else items
+    # Only clients that page get a cursor, the default limit of a listing
+    # does not change its response
+    if 'limit' in request.args or after:
+        response['next'] = _encode_cursor(*last) if more else None
+    return jsonify(success=True, **response)
+
 def sanitize_session(session):
     for field in ('created', 'queued', 'started', 'finished'):
         if session.get(field) is not None:
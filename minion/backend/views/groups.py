@@ -8,7 +8,7 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import _check_required_fields, api_guard, groups, users, sites
+from minion.backend.views.base import _check_required_fields, acl_changed, api_guard, fields_projection, groups, listing, requested_fields, users, sites, sparse
 
 def _check_group_exists(group_name):
     return groups.find_one({'name': group_name}) is not None
@@ -23,6 +23,7 @@ def sanitize_group(group):
 # Retrieve all groups in minion
 #
 #  GET /groups
+#  GET /groups?fields=name,sites
 #
 # Returns a list of groups
 #
@@ -36,7 +37,9 @@ def sanitize_group(group):
 @app.route('/groups', methods=['GET'])
 @api_guard
 def list_groups():
-    return jsonify(success=True, groups=[sanitize_group(group) for group in groups.find()])
+    fields = requested_fields()
+    return listing('groups', groups, {}, lambda group: sparse(sanitize_group(group), fields),
+                   fields_projection(fields))
 
 #
 # Expects a partially filled out site as POST data:
@@ -91,6 +94,7 @@ def create_group():
                   'users': group.get('users', []),
                   'created': datetime.datetime.utcnow() }
     groups.insert(new_group)
+    acl_changed()
     return jsonify(success=True, group=sanitize_group(new_group))
 
 @app.route('/groups/<group_name>', methods=['GET'])
@@ -114,6 +118,7 @@ def delete_group(group_name):
     if not group:
         return jsonify(success=False, reason='no-such-group')
     groups.remove({'name': group_name})
+    acl_changed()
     return jsonify(success=True)
 
 #
@@ -149,6 +154,7 @@ def patch_group(group_name):
     for user in patch.get('removeUsers', []):
         if isinstance(user, unicode) or isinstance(user, str):
             groups.update({'name':group_name},{'$pull': {'users': user}})
+    acl_changed()
     # Return the modified group
     group = groups.find_one({'name': group_name})
     return jsonify(success=True, group=sanitize_group(group))
@@ -9,7 +9,7 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, backend_config, invites, users, groups, sites
+from minion.backend.views.base import api_guard, backend_config, invites, listing, users, groups, sites
 from minion.backend.views.users import _find_groups_for_user, _find_sites_for_user, update_group_association, remove_group_association
 
 def send_email(action_type, data, extra_data=None):
@@ -54,12 +54,11 @@ def notify_on_action(action_type, invite_data):
         "subject": subject}
     return email_data
 
-def search(model, filters=None):
+def search_query(filters=None):
     if filters:
-        filters = {field: value for field, value in filters.iteritems() if value is not None}
-        return model.find(filters)
+        return {field: value for field, value in filters.iteritems() if value is not None}
     else:
-        return model.find()
+        return {}
 
 def sanitize_invite(invite):
     if invite.get('_id'):
@@ -72,12 +71,6 @@ def sanitize_invite(invite):
         invite['expire_on'] = calendar.timegm(invite['expire_on'].utctimetuple())
     return invite
 
-def sanitize_invites(invite_results):
-    results = []
-    for invite in invite_results:
-        results.append(sanitize_invite(invite))
-    return results
-
 #
 #
 # Create a new invite
@@ -168,8 +161,7 @@ def create_invites():
 def get_invites():
     recipient = request.args.get('recipient', None)
     sender = request.args.get('sender', None)
-    results = search(invites, filters={'sender': sender, 'recipient': recipient})
-    return jsonify(success=True, invites=sanitize_invites(results))
+    return listing('invites', invites, search_query(filters={'sender': sender, 'recipient': recipient}), sanitize_invite)
 
 # 
 # GET an invitation record given the invitation id
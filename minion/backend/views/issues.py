@@ -1,7 +1,12 @@
 #!/usr/bin/env python
 
+import datetime
+
 from flask import jsonify, request
-from minion.backend.views.base import api_guard, groups, sites, scans, sanitize_time
+from pymongo import DESCENDING
+
+from minion.backend.issuestore import FACETS, facet_counts, search_query, session_issues, severities_at_least
+from minion.backend.views.base import acl, api_guard, groups, issues, listing, sites, scans, sanitize_time
 from minion.backend.app import app
 
 #
@@ -31,26 +36,31 @@ from minion.backend.app import app
 #
 
 #
-# TODO This is all really bad. We get away with it because mongo is so fast but we
-# obviously need to make some big changes in the data model.
+# For every site of the group the most recent finished scan of the plan
+# that found any of the issue codes is returned, with just those issues.
+# Scans that have not been migrated with minion-db-migrate-issues still
+# have their issues in their sessions; those are found as well.
 #
 
 @app.route('/issues', methods=['GET'])
 @api_guard
 def get_issues():
     issue_codes = request.args.getlist('issue_code')
+    plan_name = request.args.get('plan_name')
 
-    issues = []
+    hits = []
 
     group = groups.find_one({'name': request.args.get('group_name')})
     if group is not None:
         for target in group['sites']:
-            scan = scans.find_one({"plan.name": request.args.get('plan_name'),
-                                   "configuration.target": target,
-                                   "state": "FINISHED",
-                                   "sessions.issues.Code": {"$in": issue_codes}},
+            scan_ids = issues.find({"target": target, "plan": plan_name, "code": {"$in": issue_codes}}).distinct("scan_id")
+            scan = scans.find_one({"configuration.target": target, "plan.name": plan_name, "state": "FINISHED",
+                                   "$or": [{"id": {"$in": scan_ids}},
+                                           {"sessions.issues.Code": {"$in": issue_codes}}]},
                                   {"id": 1, "created": 1, "started": 1, "finished": 1,
-                                   "configuration.target": 1, "sessions.issues.$": 1})
+                                   "configuration.target": 1, "sessions.id": 1, "sessions.plugin": 1,
+                                   "sessions.issues": 1},
+                                  sort=[("created", -1)])
             if scan:
                 hit = {"site": {"url": scan["configuration"]["target"]},
                        "scan": {"id": scan["id"],
@@ -58,12 +68,128 @@ def get_issues():
                                 "started": sanitize_time(scan["started"]),
                                 "finished": sanitize_time(scan["finished"]),
                                 "sessions": []}}
+                found = session_issues(issues, scan["id"], {"code": {"$in": issue_codes}})
                 for session in scan["sessions"]:
+                    embedded = [issue for issue in session.get("issues", []) if issue.get("Code") in issue_codes]
+                    if not embedded and session["id"] not in found:
+                        continue
                     s = {"plugin": {"class": session["plugin"]["class"]}, "issues": []}
-                    for issue in session['issues']:
-                        if issue['Code'] in issue_codes:
-                            s["issues"].append({"summary": issue["Summary"], "id": issue["Id"], "code": issue["Code"]})
+                    for issue in embedded + found.get(session["id"], []):
+                        s["issues"].append({"summary": issue["Summary"], "id": issue["Id"], "code": issue["Code"]})
                     hit["scan"]["sessions"].append(s)
-                issues.append(hit)
+                hits.append(hit)
+
+    return jsonify(success=True, issues=hits)
+
+#
+# Search all stored issues:
+#
+#  GET /issues/search
+#
+# Parameters, all optional and all but the times can be repeated:
+#
+#  group_name    only issues of the sites in these groups
+#  target        only issues of these sites
+#  plan_name     only issues found by these plans
+#  issue_code    only issues with these codes
+#  code_prefix   only issues with a code that starts with this, like SD-
+#  severity      only issues with these severities
+#  min_severity  only issues that are this severe or more, like High
+#  since, until  only issues found in this time range, in seconds since the epoch
+#  user          only issues of the sites that this user can see
+#  facet         count the matching issues per severity, code, target or plan
+#
+# The issues are returned most recently found first and can be paged with
+# ?limit= and ?after= like the other listings.
+#
+# Only the issues collection is searched. Issues of scans that still have
+# them in their sessions are not found until those scans are migrated with
+# minion-db-migrate-issues.
+#
+# Returns:
+#
+#  { success: true,
+#    issues: [
+#      { id: "", scan_id: "", session_id: "", target: "", plan: "",
+#        code: "", severity: "", summary: "", found: 1372181278 }
+#    ],
+#    facets: { severity: { "High": 12, "Info": 80 } },
+#    next: "<cursor>" }
+#
+# Examples:
+#
+#  All Server Identifying issues of the last 30 days, per site:
+#
+#   GET /issues/search?code_prefix=SD-0&since=1370000000&facet=target
+#
+
+SEARCH_FIELDS = {"scan_id": 1, "session_id": 1, "target": 1, "plan": 1, "code": 1,
+                 "severity": 1, "found": 1, "issue.Summary": 1}
+
+def _search_result(document):
+    return {"id": document["_id"],
+            "scan_id": document["scan_id"],
+            "session_id": document["session_id"],
+            "target": document["target"],
+            "plan": document["plan"],
+            "code": document["code"],
+            "severity": document["severity"],
+            "summary": document["issue"].get("Summary"),
+            "found": sanitize_time(document["found"]) if document.get("found") else None}
+
+def _search_time(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    return datetime.datetime.utcfromtimestamp(float(value))
+
+@app.route('/issues/search', methods=['GET'])
+@api_guard
+def search_issues():
+    targets = None
+    group_names = request.args.getlist('group_name')
+    if group_names:
+        found = list(groups.find({'name': {'$in': group_names}}, {'name': 1, 'sites': 1}))
+        if len(found) != len(set(group_names)):
+            return jsonify(success=False, reason='no-such-group')
+        targets = set()
+        for group in found:
+            targets.update(group.get('sites', []))
+    target_names = request.args.getlist('target')
+    if target_names:
+        targets = set(target_names) if targets is None else targets & set(target_names)
+    user_email = request.args.get('user')
+    if user_email is not None:
+        user = acl.user(user_email)
+        if user is None:
+            return jsonify(success=False, reason='no-such-user')
+        if user.role == 'user':
+            targets = set(user.targets) if targets is None else targets & user.targets
+
+    severities = set(request.args.getlist('severity')) or None
+    min_severity = request.args.get('min_severity')
+    if min_severity is not None:
+        at_least = severities_at_least(min_severity)
+        if at_least is None:
+            return jsonify(success=False, reason='invalid-severity')
+        severities = set(at_least) if severities is None else severities & set(at_least)
+
+    try:
+        since, until = _search_time('since'), _search_time('until')
+    except ValueError:
+        return jsonify(success=False, reason='invalid-time')
+
+    facets = request.args.getlist('facet')
+    for facet in facets:
+        if facet not in FACETS:
+            return jsonify(success=False, reason='invalid-facet')
 
-    return jsonify(success=True, issues=issues)
+    query = search_query(targets=targets,
+                         plans=request.args.getlist('plan_name'),
+                         codes=request.args.getlist('issue_code'),
+                         code_prefixes=request.args.getlist('code_prefix'),
+                         severities=severities,
+                         since=since, until=until)
+    extra = {'facets': facet_counts(issues, query, facets)} if facets else None
+    return listing('issues', issues, query, _search_result, SEARCH_FIELDS,
+                   order=('found', DESCENDING), extra=extra)
@@ -11,7 +11,8 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, plans, plugins, users, sites, groups
+from minion.backend.views.base import acl, acl_changed, api_guard, plans, plugins
+from minion.backend.workflow import step_dependencies, WorkflowError
 
 def _plan_description(plan):
     return {
@@ -23,38 +24,30 @@ def _plan_description(plan):
 def get_plan_by_plan_name(plan_name):
     return plans.find_one({'name': plan_name})
 
-def get_sanitized_plans():
-    return [sanitize_plan(_plan_description(plan)) for plan in plans.find()]
-
-def _check_plan_by_email(email, plan_name):
-    plan = plans.find_one({'name': plan_name})
-    if not plan:
-        return False
-    sitez = sites.find({'plans': plan_name})
-    if sitez.count():
-        matches = 0
-        for site in sitez:
-            groupz = groups.find({'users': email, 'sites': site['url']})
-            if groupz.count():
-                matches += 1
-        return matches
+def get_sanitized_plans(query=None):
+    return [sanitize_plan(_plan_description(plan)) for plan in plans.find(query or {})]
 
 def get_plans_by_email(email):
-    plans = get_sanitized_plans()
-    matched_plans = [plan for plan in plans if _check_plan_by_email(email, plan["name"])]
-    return matched_plans
+    """ Return the plans of the sites in the groups of the user. The
+    plans a user can see come from the ACL index, so this is one query for
+    the plans themselves. Like before the index, an email that is only
+    listed in groups gets the plans of those groups. """
+    user = acl.member(email)
+    if user is None or not user.plans:
+        return []
+    return get_sanitized_plans({'name': {'$in': list(user.plans)}})
 
 def permission(view):
     @functools.wraps(view)
     def has_permission(*args, **kwargs):
         email = request.args.get('email')
         if email:
-            user = users.find_one({'email': email})
+            user = acl.user(email)
             if not user:
                 return jsonify(success=False, reason='User does not exist.')
-            if user['role'] == 'user':
+            if user.role == 'user':
                 plan_name = request.view_args['plan_name']
-                if not _check_plan_by_email(email, plan_name):
+                if plan_name not in user.plans:
                     return jsonify(success=False, reason="Plan does not exist.")
         return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
     return has_permission
@@ -94,6 +87,11 @@ def _check_plan_workflow(workflow):
             _import_plugin(plugin['plugin_name'])
         except (AttributeError, ImportError):
             return False
+    # Make sure step dependencies refer to existing steps and have no cycles
+    try:
+        step_dependencies(workflow)
+    except WorkflowError:
+        return False
     return True
 
 def _check_plan_exists(plan_name):
@@ -149,6 +147,7 @@ def delete_plan(plan_name):
         return jsonify(success=False, reason="Plan does not exist.")
     # Remove the plan
     plans.remove({'name': plan_name})
+    acl_changed()
     return jsonify(success=True)
 
 #
@@ -173,6 +172,7 @@ def create_plan():
                  'workflow': plan['workflow'],
                  'created': datetime.datetime.utcnow() }
     plans.insert(new_plan)
+    acl_changed()
 
     # Return the new plan
     plan = plans.find_one({"name": plan['name']})
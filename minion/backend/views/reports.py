@@ -6,19 +6,22 @@ import importlib
 import uuid
 
 from flask import jsonify, request
+from pymongo import DESCENDING
 
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, scans, sites, users, scanschedules
-from minion.backend.views.users import _find_sites_for_user, _find_sites_for_user_by_group_name
-from minion.backend.views.scans import sanitize_scan, summarize_scan
+from minion.backend.issuestore import embed_issues_of_scans
+from minion.backend.views.base import acl, api_guard, issues, latest_scans, listing, requested_fields, scans, sites, sparse
+from minion.backend.views.users import _find_sites_for_user_by_group_name
+from minion.backend.views.scans import sanitize_scan, summarize_scan, SUMMARY_FIELDS
 
 # API Methods to return reports
 
 #
 # Returns a scan history report, which is simply a list of all
-# scans that have been recently done.
+# scans that have been recently done. Accepts ?fields= to only
+# return some fields of the scan summaries.
 #
 # If the user is specified then only scans are returned that
 # the user can see.
@@ -26,18 +29,28 @@ from minion.backend.views.scans import sanitize_scan, summarize_scan
 @app.route('/reports/history', methods=['GET'])
 @api_guard
 def get_reports_history():
-    history = []
+    fields = requested_fields()
+    query = {}
     user_email = request.args.get('user')
     if user_email is not None:
-        user = users.find_one({'email': user_email})
+        user = acl.user(user_email)
         if user is None:
             return jsonify(success=False, reason='no-such-user')
-        for s in scans.find({'configuration.target': {'$in': _find_sites_for_user(user_email)}}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    else:
-        for s in scans.find({}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    return jsonify(success=True, report=history)
+        query = {'configuration.target': {'$in': list(user.targets)}}
+    return listing('report', scans, query, lambda s: sparse(summarize_scan(sanitize_scan(s)), fields),
+                   SUMMARY_FIELDS, order=('created', DESCENDING), default_limit=100)
+
+#
+# The status and issues reports look up the sites and the latest scans
+# of the sites that the user can see at once. The latest scan and the
+# schedule of each site and plan come from the latest_scans collection.
+#
+
+def _find_sites(site_list):
+    return dict((site['url'], site) for site in sites.find({'url': {'$in': list(site_list)}}, {'url': 1, 'plans': 1}))
+
+def _find_latest_scans(site_list):
+    return dict(((l['target'], l['plan']), l) for l in latest_scans.find({'target': {'$in': list(site_list)}}))
 
 #
 # Returns a status report that lists each site and attached plans
@@ -71,28 +84,24 @@ def get_reports_sites():
     user_email = request.args.get('user')
     if user_email is not None:
         # User specified, so return recent scans for each site/plan that the user can see
-        user = users.find_one({'email': user_email})
+        user = acl.user(user_email)
         if user is None:
             return jsonify(success=False, reason='no-such-user')
         if group_name:
             site_list = _find_sites_for_user_by_group_name(user_email, group_name)
         else:
-            site_list = _find_sites_for_user(user_email)
+            site_list = user.targets
+        sitez = _find_sites(site_list)
+        latest = _find_latest_scans(site_list)
         for site_url in sorted(site_list):
-            site = sites.find_one({'url': site_url})
+            site = sitez.get(site_url)
             if site is not None:
                 for plan_name in site['plans']:
-                    schedule = scanschedules.find_one({'site':site_url, 'plan':plan_name})
-                    crontab = None
-                    scheduleEnabled = False
-                    if schedule is not None:
-                        crontab = schedule['crontab']
-                        scheduleEnabled = schedule['enabled']
-
-                    l = list(scans.find({'configuration.target':site['url'], 'plan.name': plan_name}).sort("created", -1).limit(1))
-                    if len(l) == 1:
-                        scan = summarize_scan(sanitize_scan(l[0]))
-                        s = {v: scan.get(v) for v in ('id', 'created', 'state', 'issues')}
+                    l = latest.get((site_url, plan_name), {})
+                    crontab = l.get('crontab')
+                    scheduleEnabled = l.get('scheduleEnabled', False)
+                    if l.get('scan'):
+                        scan = summarize_scan(sanitize_scan(l['scan']))
                         result.append({'target': site_url, 'plan': plan_name, 'scan': scan, 'crontab': crontab, 'scheduleEnabled': scheduleEnabled})
                     else:
                         result.append({'target': site_url, 'plan': plan_name, 'scan': None, 'crontab': crontab, 'scheduleEnabled': scheduleEnabled})
@@ -119,25 +128,29 @@ def get_reports_issues():
     user_email = request.args.get('user')
     if user_email is not None:
         # User specified, so return recent scans for each site/plan that the user can see
-        user = users.find_one({'email': user_email})
+        user = acl.user(user_email)
         if user is None:
             return jsonify(success=False, reason='no-such-user')
         if group_name:
             site_list = _find_sites_for_user_by_group_name(user_email, group_name)
         else:
-            site_list = _find_sites_for_user(user_email)
+            site_list = user.targets
 
+        sitez = _find_sites(site_list)
+        latest = _find_latest_scans(site_list)
+        embed_issues_of_scans(scans, issues, [l['scan'] for l in latest.values() if l.get('scan')])
         for site_url in sorted(site_list):
             r = {'target': site_url, 'issues': []}
-            site = sites.find_one({'url': site_url})
+            site = sitez.get(site_url)
             if site is not None:
                 for plan_name in site['plans']:
-                    for s in scans.find({'configuration.target':site['url'], 'plan.name': plan_name}).sort("created", -1).limit(1):
-                        for session in s['sessions']:
+                    l = latest.get((site_url, plan_name), {})
+                    if l.get('scan'):
+                        for session in l['scan'].get('sessions', []):
                             for issue in session['issues']:
                                 r['issues'].append({'severity': issue['Severity'],
                                                     'summary': issue['Summary'],
-                                                    'scan': { 'id': s['id'] },
+                                                    'scan': { 'id': l['scan']['id'] },
                                                     'id': issue['Id']})
             result.append(r)
     return jsonify(success=True, report=result)
@@ -9,8 +9,11 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, plans, plugins, scans, sanitize_session, users, sites
+from minion.backend.issuestore import embed_issues, empty_counts, issue_counts
+from minion.backend.latestscans import record_scan, LATEST_SCAN_FIELDS
+from minion.backend.views.base import acl, api_guard, issues, latest_scans, plans, plugins, requested_fields, scans, sanitize_session, sparse, sites
 from minion.backend.views.plans import sanitize_plan
+from minion.backend.workflow import step_dependencies
 
 
 
@@ -24,15 +27,14 @@ def permission(view):
             return view(*args, **kwargs)
 
         if email:
-            user = users.find_one({'email': email})
+            user = acl.user(email)
             if not user:
                 return jsonify(success=False, reason='user-does-not-exist')
-            scan = scans.find_one({"id": kwargs['scan_id']})
-            if user['role'] == 'user':
-                groupz = groups.find({'users': email, 'sites': scan['configuration']['target']})
-                if not groupz.count():
+            if user.role == 'user':
+                scan = scans.find_one({"id": kwargs['scan_id']}, {"configuration.target": 1})
+                if scan['configuration']['target'] not in user.targets:
                     return jsonify(success=False, reason='not-found')
-        return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
+        return view(*args, **kwargs) # if the user can see the site of the scan, or user is admin
     return has_permission
 
 def sanitize_scan(scan):
@@ -49,13 +51,7 @@ def sanitize_scan(scan):
     return scan
 
 def summarize_scan(scan):
-    def _count_issues(scan, severity):
-        count = 0
-        for session in scan['sessions']:
-            for issue in session['issues']:
-                if issue['Severity'] == severity:
-                    count += 1
-        return count
+    counts = issue_counts(scans, issues, scan)
     summary = { 'id': scan['id'],
                 'meta': scan['meta'],
                 'state': scan['state'],
@@ -65,17 +61,16 @@ def summarize_scan(scan):
                 'created': scan.get('created'),
                 'queued': scan.get('queued'),
                 'finished': scan.get('finished'),
-                'issues': { 'critical': _count_issues(scan, 'Critical'),
-                            'high': _count_issues(scan, 'High'),
-                            'medium': _count_issues(scan, 'Medium'),
-                            'low': _count_issues(scan, 'Low'),
-                            'info': _count_issues(scan, 'Info') } }
+                'issues': counts }
     for session in scan['sessions']:
         summary['sessions'].append({ 'plugin': session['plugin'],
                                      'id': session['id'],
                                      'state': session['state'] })
     return summary
 
+# The fields that summarize_scan needs, which is also what latest_scans keeps
+SUMMARY_FIELDS = LATEST_SCAN_FIELDS
+
 # API Methods to manage scans
 
 #
@@ -89,7 +84,7 @@ def get_scan(scan_id):
     scan = scans.find_one({"id": scan_id})
     if not scan:
         return jsonify(success=False, reason='not-found')
-    return jsonify(success=True, scan=sanitize_scan(scan))
+    return jsonify(success=True, scan=sanitize_scan(embed_issues(issues, scan)))
 
 #
 # Return a scan summary. Returns just the basic info about a scan
@@ -100,11 +95,60 @@ def get_scan(scan_id):
 @api_guard
 @permission
 def get_scan_summary(scan_id):
-    scan = scans.find_one({"id": scan_id})
+    scan = scans.find_one({"id": scan_id}, SUMMARY_FIELDS)
     if not scan:
         return jsonify(success=False, reason='not-found')
     return jsonify(success=True, summary=summarize_scan(sanitize_scan(scan)))
 
+#
+# Return the state of a scan and its sessions without any issues. This
+# is what the scan and plugin workers need to drive a scan. With
+# ?session_id=<id> only that session is included.
+#
+
+@app.route("/scans/<scan_id>/state")
+@api_guard
+@permission
+def get_scan_state(scan_id):
+    session_id = request.args.get('session_id')
+    if session_id:
+        projection = {"_id": 0, "id": 1, "state": 1, "finished": 1, "configuration": 1,
+                      "sessions": {"$elemMatch": {"id": session_id}}}
+    else:
+        projection = {"_id": 0, "sessions.issues": 0}
+    scan = scans.find_one({"id": scan_id}, projection)
+    if not scan:
+        return jsonify(success=False, reason='not-found')
+    scan.setdefault('sessions', [])
+    for session in scan['sessions']:
+        session.pop('issues', None)
+    return jsonify(success=True, scan=sanitize_scan(scan))
+
+#
+# Return the progress of all sessions of a scan. This only loads the
+# state and progress of the sessions so it is cheap to poll while a
+# scan is running:
+#
+#  { "success": true,
+#    "progress": { "id": "...", "state": "STARTED",
+#                  "sessions": [ { "id": "...", "state": "STARTED",
+#                                  "progress": { "percentage": 40, "description": "..." } } ] } }
+#
+
+@app.route("/scans/<scan_id>/progress")
+@api_guard
+@permission
+def get_scan_progress(scan_id):
+    scan = scans.find_one({"id": scan_id},
+                          {"_id": 0, "id": 1, "state": 1,
+                           "sessions.id": 1, "sessions.state": 1, "sessions.progress": 1})
+    if not scan:
+        return jsonify(success=False, reason='not-found')
+    sessions = [{'id': session['id'],
+                 'state': session['state'],
+                 'progress': session.get('progress')} for session in scan.get('sessions', [])]
+    return jsonify(success=True, progress={'id': scan['id'], 'state': scan['state'], 'sessions': sessions})
+
 #
 # Create a scan by POSTING a configuration to the /scan
 # resource. The configuration looks like this:
@@ -139,7 +183,9 @@ def post_scan_create():
              "plan": { "name": plan['name'], "revision": 0 },
              "configuration": configuration['configuration'],
              "sessions": [],
+             "issue_counts": empty_counts(),
              "meta": { "user": configuration['user'], "tags": [] } }
+    dependencies = step_dependencies(plan['workflow'])
     for step in plan['workflow']:
         session_configuration = step['configuration']
         session_configuration.update(configuration['configuration'])
@@ -149,16 +195,28 @@ def post_scan_create():
                     "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
                     "description": step["description"],
                     "artifacts": {},
-                    "issues": [],
+                    "issue_counts": empty_counts(),
                     "created": now,
                     "queued": None,
                     "started": None,
                     "finished": None,
                     "progress": None }
         scan['sessions'].append(session)
+    # Now that all sessions have an id, turn step dependencies into session dependencies
+    for session, deps in zip(scan['sessions'], dependencies):
+        session['dependencies'] = [scan['sessions'][i]['id'] for i in deps]
     scans.insert(scan)
+    record_scan(latest_scans, scans, scan['id'])
+    # Issues are stored in the issues collection, a new scan has none
+    for session in scan['sessions']:
+        session['issues'] = []
     return jsonify(success=True, scan=sanitize_scan(scan))
 
+#
+# Return summaries of the latest scans of a site and plan. With
+# ?fields=id,state only those fields of the summaries are returned.
+#
+
 @app.route("/scans", methods=["GET"])
 @permission
 def get_scans():
@@ -168,8 +226,9 @@ def get_scans():
     if not site:
         return jsonify(success=False, reason='no-such-site')
     scanz = scans.find({"plan.name": request.args.get("plan_name"),
-                        "configuration.target": site['url']}).sort("created", -1).limit(limit)
-    return jsonify(success=True, scans=[summarize_scan(sanitize_scan(s)) for s in scanz])
+                        "configuration.target": site['url']}, SUMMARY_FIELDS).sort("created", -1).limit(limit)
+    fields = requested_fields()
+    return jsonify(success=True, scans=[sparse(summarize_scan(sanitize_scan(s)), fields) for s in scanz])
 
 @app.route("/scans/<scan_id>/control", methods=["PUT"])
 @api_guard
@@ -189,10 +248,12 @@ def put_scan_control(scan_id):
             return jsonify(success=False, error='invalid-state-transition')
         # Queue the scan to start
         scans.update({"id": scan_id}, {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow()}})
+        record_scan(latest_scans, scans, scan_id)
         tasks.scan.apply_async([scan['id']], countdown=3, queue='scan')
     # Handle stop
     if state == 'STOP':
         scans.update({"id": scan_id}, {"$set": {"state": "STOPPING", "queued": datetime.datetime.utcnow()}})
-        tasks.scan_stop.apply_async([scan['id']], queue='state')
+        record_scan(latest_scans, scans, scan_id)
+        tasks.scan_stop.apply_async([scan['id']], queue=tasks.state_queue(scan['id']))
     return jsonify(success=True)
 
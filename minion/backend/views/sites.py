@@ -6,12 +6,15 @@ import re
 import uuid
 from flask import jsonify, request
 from celery.schedules import crontab_parser, ParseException
+from pymongo import ASCENDING
 
 from minion.backend.app import app
 import minion.backend.tasks as tasks
-from minion.backend.views.base import _check_required_fields, api_guard, groups, sites, scanschedules, siteCredentials
+from minion.backend.latestscans import record_schedule
+from minion.backend.views.base import _check_required_fields, acl_changed, api_guard, fields_projection, groups, latest_scans, listing, requested_fields, sites, scanschedules, siteCredentials, sparse, wants_field
 from minion.backend.views.groups import _check_group_exists
 from minion.backend.views.plans import _check_plan_exists
+from minion.backend.views.users import MembershipIndex
 
 def _check_site_url(url):
     regex = re.compile(r"^((http|https)://(localhost|([a-z0-9][-a-z0-9]*)(\.[a-z0-9][-a-z0-9]*)+)(:\d+)?)"
@@ -160,6 +163,7 @@ def create_site():
     for group_name in site.get('groups', []):
         # No need to check if the site is already in the group as we just added the site
         groups.update({'name':group_name},{'$addToSet': {'sites': site['url']}})
+    acl_changed()
     new_site['groups'] = site.get('groups', [])
     # Return the new site
     return jsonify(success=True, site=sanitize_site(new_site))
@@ -221,6 +225,9 @@ def update_site(site_id):
         # Update the site. At this point we can only update plans.
         sites.update({'id': site_id}, {'$set': {'plans': new_site.get('plans')}})
 
+    if 'groups' in new_site or 'plans' in new_site:
+        acl_changed()
+
     new_verification = new_site['verification']
     old_verification = site.get('verification')
     # if site doesn't have 'verification', do us a favor, update the document as it is outdated!
@@ -246,6 +253,7 @@ def update_site(site_id):
 #
 #  GET /sites
 #  GET /sites?url=http://www.mozilla.com
+#  GET /sites?fields=url,plans
 #
 # Returns a list of sites found, even if there is one result:
 #
@@ -262,21 +270,23 @@ def get_sites():
     url = request.args.get('url')
     if url:
         query['url'] = url
-    sitez = [sanitize_site(site) for site in sites.find(query)]
-    for site in sitez:
-        site['groups'] = _find_groups_for_site(site['url'])
-
-    return jsonify(success=True, sites=sitez)
+    fields = requested_fields()
+    membership = None
+    if wants_field(fields, 'groups'):
+        membership = MembershipIndex({'sites': url} if url else None)
+    def transform(site):
+        site = sanitize_site(site)
+        if wants_field(fields, 'groups'):
+            site['groups'] = membership.groups_for_site(site['url'])
+        return sparse(site, fields)
+    return listing('sites', sites, query, transform, fields_projection(fields, required=['url']))
 
 
 # Returns credential Info exept for password from siteCredentials collection
 @app.route('/credInfo', methods=['GET'])
 @api_guard
 def get_credInfo():
-    credInfo = {}
-    for site in siteCredentials.find():
-
-        authData = site['authData']
+    def transform(site):
         data = {
             'site':site['site'],
             'plan':site['plan'],
@@ -285,13 +295,15 @@ def get_credInfo():
 
         #remove password from the response
         data['authData']['password'] = ""
-        if not site['site'] in credInfo:
-            credInfo[site['site']] = {}
-
-        credInfo[site['site']][site['plan']] = data
+        return data
 
+    def assemble(items):
+        credInfo = {}
+        for data in items:
+            credInfo.setdefault(data['site'], {})[data['plan']] = data
+        return credInfo
 
-    return jsonify(success=True, credInfo=credInfo)
+    return listing('credInfo', siteCredentials, {}, transform, order=('site', ASCENDING), assemble=assemble)
 
 
 # Sets siteCredentials
@@ -404,6 +416,7 @@ def scanschedule():
     else:
       scanschedules.update({"site":target, "plan":plan},
                        {"$set": {"crontab": crontab, "enabled":enabled}});
+    record_schedule(latest_scans, target, plan, crontab, enabled)
 
 
     return jsonify(message=message,success=True)
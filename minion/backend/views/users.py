@@ -6,7 +6,7 @@ import uuid
 from flask import jsonify, request
 
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, sites, users
+from minion.backend.views.base import acl_changed, api_guard, fields_projection, groups, listing, requested_fields, sites, sparse, users, wants_field
 from minion.backend.views.groups import _check_group_exists
 
 def _find_groups_for_user(email):
@@ -29,6 +29,31 @@ def _find_sites_for_user(email):
             sitez.add(s)
     return list(sitez)
 
+class MembershipIndex(object):
+    """ The groups and sites of every user and the groups of every site,
+    built with one pass over the groups instead of a query per user or
+    site. query limits the groups that are looked at. """
+
+    def __init__(self, query=None):
+        self._user_groups = {}
+        self._user_sites = {}
+        self._site_groups = {}
+        for g in groups.find(query or {}, {'_id': 0, 'name': 1, 'users': 1, 'sites': 1}):
+            for email in g.get('users', []):
+                self._user_groups.setdefault(email, []).append(g['name'])
+                self._user_sites.setdefault(email, set()).update(g.get('sites', []))
+            for site in g.get('sites', []):
+                self._site_groups.setdefault(site, []).append(g['name'])
+
+    def groups_for_user(self, email):
+        return list(self._user_groups.get(email, []))
+
+    def sites_for_user(self, email):
+        return list(self._user_sites.get(email, []))
+
+    def groups_for_site(self, site):
+        return list(self._site_groups.get(site, []))
+
 def update_group_association(old_email, new_email):
     """ Update all associations with the old email
     to the new email. """
@@ -37,6 +62,7 @@ def update_group_association(old_email, new_email):
         {'$set': {'users.$': new_email}},
         upsert=False,
         multi=True)
+    acl_changed()
 
 def remove_group_association(email):
     """ Remove all associations with the recipient.
@@ -53,6 +79,7 @@ def remove_group_association(email):
         {'$pull': {'users': email}},
         upsert=False,
         multi=True)
+    acl_changed()
 
 def sanitize_user(user):
     if '_id' in user:
@@ -147,6 +174,7 @@ def create_user():
     # Add the user to the groups - group membership is stored in the group objet, not in the user
     for group_name in user.get('groups', []):
         groups.update({'name':group_name},{'$addToSet': {'users': user['email']}})
+    acl_changed()
     new_user['groups'] = user.get('groups', [])
     return jsonify(success=True, user=sanitize_user(new_user))
 
@@ -209,6 +237,7 @@ def update_user(user_email):
     if 'status' in new_user:
         changes['status'] = new_user['status']
     users.update({'email': user_email}, {'$set': changes})
+    acl_changed()
     # Return the updated user
     user = users.find_one({'email': user_email})
     if not user:
@@ -220,6 +249,7 @@ def update_user(user_email):
 # Retrieve all users in minion
 #
 #  GET /users
+#  GET /users?fields=email,role
 #
 # Returns a list of users
 #
@@ -234,12 +264,17 @@ def update_user(user_email):
 @app.route('/users', methods=['GET'])
 @api_guard
 def list_users():
-    userz = []
-    for user in users.find():
-        user['groups'] = _find_groups_for_user(user['email'])
-        user['sites'] = _find_sites_for_user(user['email'])
-        userz.append(sanitize_user(user))
-    return jsonify(success=True, users=userz)
+    fields = requested_fields()
+    membership = None
+    if wants_field(fields, 'groups') or wants_field(fields, 'sites'):
+        membership = MembershipIndex()
+    def transform(user):
+        if wants_field(fields, 'groups'):
+            user['groups'] = membership.groups_for_user(user['email'])
+        if wants_field(fields, 'sites'):
+            user['sites'] = membership.sites_for_user(user['email'])
+        return sparse(sanitize_user(user), fields)
+    return listing('users', users, {}, transform, fields_projection(fields, required=['email']))
 
 #
 # Delete a user
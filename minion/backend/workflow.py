@@ -0,0 +1,90 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Plan workflows can declare dependencies between their steps. A step
+# can be given an optional name and can list the names of the steps it
+# has to wait for in 'after':
+#
+#   { "name": "alive",
+#     "plugin_name": "minion.plugins.basic.AlivePlugin", ... },
+#   { "plugin_name": "minion.plugins.basic.HSTSPlugin",
+#     "after": ["alive"], ... }
+#
+# Steps that do not have a name can be referred to by their plugin_name
+# as long as that is unambiguous. Steps without 'after' can start right
+# away. When no step in the workflow uses 'after' then the workflow is
+# executed sequentially, which is how plans have always worked.
+#
+
+# Session states in which a session will not change anymore
+DONE_STATES = ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED', 'CANCELLED')
+
+# Session states that stop the whole scan
+STOP_STATES = ('ABORTED', 'STOPPED')
+
+
+class WorkflowError(Exception):
+    pass
+
+
+def _step_name(step):
+    return step.get('name') or step['plugin_name']
+
+def step_dependencies(workflow):
+    """ Return a list with, for every step in the workflow, the list of
+    indexes of the steps it depends on. Raises WorkflowError when a step
+    refers to an unknown or ambiguous step or when there is a cycle. """
+
+    if not any('after' in step for step in workflow):
+        return [[i - 1] if i > 0 else [] for i in range(len(workflow))]
+
+    names = {}
+    for i, step in enumerate(workflow):
+        names.setdefault(_step_name(step), []).append(i)
+
+    dependencies = []
+    for i, step in enumerate(workflow):
+        after = step.get('after', [])
+        if not isinstance(after, list):
+            raise WorkflowError("Step %d: 'after' must be a list" % i)
+        deps = []
+        for name in after:
+            if name not in names:
+                raise WorkflowError("Step %d depends on unknown step %s" % (i, name))
+            if len(names[name]) != 1:
+                raise WorkflowError("Step %d depends on ambiguous step %s" % (i, name))
+            if names[name][0] == i:
+                raise WorkflowError("Step %d depends on itself" % i)
+            deps.append(names[name][0])
+        dependencies.append(deps)
+
+    # Make sure the steps can be ordered
+    done = set()
+    while len(done) < len(workflow):
+        ready = [i for i in range(len(workflow)) if i not in done and set(dependencies[i]).issubset(done)]
+        if not ready:
+            raise WorkflowError("Workflow contains a dependency cycle")
+        done.update(ready)
+
+    return dependencies
+
+def ready_sessions(sessions):
+    """ Return the sessions that are still in the CREATED state and for
+    which all the sessions they depend on are done. """
+
+    # Scans created before workflows had dependencies run sequentially
+    if not any('dependencies' in session for session in sessions):
+        dependencies = [[sessions[i - 1]['id']] if i > 0 else [] for i in range(len(sessions))]
+    else:
+        dependencies = [session.get('dependencies', []) for session in sessions]
+
+    states = dict((session['id'], session['state']) for session in sessions)
+    ready = []
+    for session, deps in zip(sessions, dependencies):
+        if session['state'] != 'CREATED':
+            continue
+        if all(states.get(dependency) in DONE_STATES for dependency in deps):
+            ready.append(session)
+    return ready
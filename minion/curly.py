@@ -3,7 +3,18 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 
+import base64
+import collections
+import errno
+import fcntl
+import hashlib
+import json
+import os
 import re
+import stat
+import tempfile
+import threading
+import time
 import urlparse
 
 import pycurl
@@ -34,7 +45,7 @@ class CurlyError(Exception):
     """ Exception class for reporting CURL errors. """
     def __init__(self, id):
         self.id = id
-        self.issue = CURL_ERRORS.get(str(id), CURL_ERRORS['default'])
+        self.issue = dict(CURL_ERRORS.get(str(id), CURL_ERRORS['default']))
         self.issue['Description'] = self.issue['Description'] % self.id
         self.issue['Severity'] = 'Error'
         self.message = self.issue['Summary']
@@ -49,14 +60,49 @@ to learn about the meaning of the status code." % str(status_code)
             self.message = message
         super(BadResponseError, self).__init__(self.message)
 
-class HTTPResponse:
-    def __init__(self, url):
+#
+# Response bodies are written to a buffer that moves to a temporary file when
+# it grows beyond SPOOL_BODY_BYTES. With max_body_bytes the transfer is stopped
+# once that many bytes of the body have been received and the response is
+# marked as truncated. max_body_bytes=0 only reads the headers.
+#
+
+SPOOL_BODY_BYTES = 1024 * 1024
+
+class HTTPResponse(object):
+    def __init__(self, url, max_body_bytes=None):
         self.url = url
-        self.body = ""
         self.status = None
         self.headers = {}
+        self.truncated = False
+        self.max_body_bytes = max_body_bytes
+        self._buffer = None
+        self._size = 0
+        self._body = ""
+    @property
+    def body(self):
+        if self._buffer is not None:
+            self._buffer.seek(0)
+            self._body = self._buffer.read()
+            self._buffer.close()
+            self._buffer = None
+        return self._body
+    @body.setter
+    def body(self, body):
+        self._buffer = None
+        self._body = body
     def _body_callback(self, body):
-        self.body += body
+        if self.max_body_bytes is not None and self._size + len(body) > self.max_body_bytes:
+            body = body[:self.max_body_bytes - self._size]
+            self.truncated = True
+        if self._buffer is None:
+            self._buffer = tempfile.SpooledTemporaryFile(max_size=SPOOL_BODY_BYTES)
+            self._buffer.write(self._body)
+        self._buffer.write(body)
+        self._size += len(body)
+        # Returning a different length than we were given aborts the transfer
+        if self.truncated:
+            return 0
     def _header_callback(self, header):
         header = header.strip()
         m = re.match(r"HTTP/\d+\.\d+ (\d+) (.+)", header)
@@ -85,40 +131,344 @@ class Response:
     @property
     def headers(self):
         return self.history[-1].headers
+    @property
+    def truncated(self):
+        return self.history[-1].truncated
     def raise_for_status(self):
         if self.status != 200:
             raise BadResponseError(status_code=self.status)
 
-def _get(c, url, headers={}, connect_timeout=None, timeout=None):
-    http_response = HTTPResponse(url)
+#
+# Curl handles are pooled per host. A handle keeps its connections open, so
+# requests to a host that was used before reuse a kept-alive connection and
+# its TLS session. All handles share one DNS cache and TLS session cache.
+#
+
+MAX_IDLE_HANDLES_PER_HOST = 4
+MAX_IDLE_HANDLES = 64
+
+_pool_lock = threading.Lock()
+_pool = {}
+_share = None
+
+def _curl_share():
+    global _share
+    if _share is None:
+        _share = pycurl.CurlShare()
+        _share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_DNS)
+        _share.setopt(pycurl.SH_SHARE, pycurl.LOCK_DATA_SSL_SESSION)
+    return _share
+
+def _pool_key(url):
+    u = urlparse.urlparse(url)
+    return (u.scheme, u.hostname, u.port)
+
+def _new_handle():
+    with _pool_lock:
+        share = _curl_share()
+    c = pycurl.Curl()
+    c.setopt(pycurl.SHARE, share)
+    return c
+
+def _acquire(url):
+    with _pool_lock:
+        handles = _pool.get(_pool_key(url))
+        if handles:
+            return handles.pop()
+    return _new_handle()
+
+def _release(url, c):
+    with _pool_lock:
+        handles = _pool.setdefault(_pool_key(url), [])
+        idle = sum(len(h) for h in _pool.values())
+        if len(handles) < MAX_IDLE_HANDLES_PER_HOST and idle < MAX_IDLE_HANDLES:
+            handles.append(c)
+            return
+    c.close()
+
+def _prepare(c, url, headers={}, connect_timeout=None, timeout=None, max_body_bytes=None):
+    http_response = HTTPResponse(url, max_body_bytes)
+    # Forget the options of the previous request but keep the connections
+    c.reset()
+    c.setopt(pycurl.NOSIGNAL, 1)
+    c.setopt(pycurl.TCP_KEEPALIVE, 1)
     c.setopt(c.WRITEFUNCTION, http_response._body_callback)
     c.setopt(c.HEADERFUNCTION, http_response._header_callback)
     c.setopt(pycurl.FOLLOWLOCATION, 0)
     #c.setopt(pycurl.FAILONERROR, True)
     c.setopt(c.URL, url.encode('ascii'))
+    if connect_timeout is not None:
+        c.setopt(pycurl.CONNECTTIMEOUT_MS, int(connect_timeout * 1000))
     if timeout is not None:
-        c.setopt(pycurl.CONNECTTIMEOUT, connect_timeout)
-    if timeout is not None:
-        c.setopt(pycurl.TIMEOUT, timeout)
+        c.setopt(pycurl.TIMEOUT_MS, int(timeout * 1000))
     if len(headers):
         c.setopt(c.HTTPHEADER, ["%s: %s" % (name,value) for name,value in headers.items()])
+    return http_response
+
+def _get(c, url, headers={}, connect_timeout=None, timeout=None, max_body_bytes=None):
+    http_response = _prepare(c, url, headers=headers, connect_timeout=connect_timeout,
+                             timeout=timeout, max_body_bytes=max_body_bytes)
     try:
         c.perform()
         return http_response
     except pycurl.error as e:
+        if http_response.truncated:
+            return http_response
         raise CurlyError(e[0])
 
-def get(url, headers={}, connect_timeout=None, timeout=None):
-    c = pycurl.Curl()
-    responses = []
-    http_response = _get(c, url, headers=headers, connect_timeout=connect_timeout, timeout=timeout)
-    responses.append(http_response)
-    while http_response.status in (301, 302):
-        new_url = http_response.headers['location']
-        if new_url.startswith('/'):
-            u = urlparse.urlparse(url)
-            new_url = u.scheme + "://" + u.hostname + new_url
-        http_response = _get(c, new_url, headers)
+def _redirect_url(http_response):
+    return urlparse.urljoin(http_response.url, http_response.headers['location'])
+
+#
+# Plugins of the same scan often fetch the same page. The plugin runner can
+# enable a response cache in a directory that is shared by all the plugin
+# runners of a scan. Responses are kept for ttl seconds and the oldest ones
+# are removed when the cache grows beyond max_bytes. A lock per cache key
+# makes plugins that ask for the same page at the same time wait for the
+# first one instead of all fetching it. Failures are cached too, so that the
+# plugins of a scan of a site that is down do not all wait for the timeout.
+#
+# Cached responses are trusted, so a cache directory that someone else can
+# write to, like a directory that another user created in /tmp before us, is
+# not used.
+#
+
+def private_directory(path):
+    """ Whether path is a directory, and not a symlink, that belongs to us and
+    that nobody else can write to. """
+    st = os.lstat(path)
+    return stat.S_ISDIR(st.st_mode) and st.st_uid == os.getuid() and not st.st_mode & (stat.S_IWGRP | stat.S_IWOTH)
+
+def make_private_directory(path):
+    """ Create the directory if it does not exist yet and check that it is
+    private. Raises an exception when it is not. """
+    try:
+        os.makedirs(path, 0o700)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    if not private_directory(path):
+        raise Exception("Directory %s is not private" % path)
+
+class ResponseCache(object):
+
+    def __init__(self, directory, ttl=300, max_bytes=32*1024*1024):
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        make_private_directory(directory)
+
+    def _path(self, url, headers):
+        key = json.dumps([url, sorted(headers.items())])
+        return os.path.join(self.directory, hashlib.sha1(key).hexdigest())
+
+    def lookup(self, url, headers, max_body_bytes=None):
+        """ Return the cached Response, the cached CurlyError or None. """
+        return self._load(self._path(url, headers), max_body_bytes)
+
+    def store(self, url, headers, response, max_body_bytes=None):
+        self._store(self._path(url, headers), response, max_body_bytes)
+
+    def store_error(self, url, headers, error):
+        self._write(self._path(url, headers), json.dumps({'error': error.id}))
+
+    def get(self, url, headers, fetch, max_body_bytes=None):
+        path = self._path(url, headers)
+        with open(path + ".lock", "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                response = self._load(path, max_body_bytes)
+                if response is None:
+                    try:
+                        response = fetch()
+                    except CurlyError as e:
+                        self._write(path, json.dumps({'error': e.id}))
+                        raise
+                    self._store(path, response, max_body_bytes)
+                if isinstance(response, CurlyError):
+                    raise response
+                return response
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _load(self, path, max_body_bytes):
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                return None
+            with open(path) as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+        if 'error' in entry:
+            return CurlyError(entry['error'])
+        # A response that was cut off cannot be used for a request that wants more of the body
+        limit = entry.get('limit')
+        if limit is not None and (max_body_bytes is None or max_body_bytes > limit):
+            return None
+        responses = []
+        for r in entry['history']:
+            http_response = HTTPResponse(r['url'], max_body_bytes)
+            http_response.status = r['status']
+            http_response.headers = r['headers']
+            http_response.body = base64.b64decode(r['body'])
+            http_response.truncated = r.get('truncated', False)
+            if max_body_bytes is not None and len(http_response.body) > max_body_bytes:
+                http_response.body = http_response.body[:max_body_bytes]
+                http_response.truncated = True
+            responses.append(http_response)
+        return Response(responses)
+
+    def _store(self, path, response, max_body_bytes):
+        limit = max_body_bytes if any(r.truncated for r in response.history) else None
+        try:
+            data = json.dumps({'limit': limit,
+                               'history': [{'url': r.url,
+                                            'status': r.status,
+                                            'headers': r.headers,
+                                            'truncated': r.truncated,
+                                            'body': base64.b64encode(r.body)} for r in response.history]})
+        except UnicodeDecodeError:
+            return
+        if len(data) > self.max_bytes:
+            return
+        self._write(path, data)
+
+    def _write(self, path, data):
+        try:
+            with open(path + ".tmp", "w") as f:
+                f.write(data)
+            os.rename(path + ".tmp", path)
+            self._trim()
+        except (IOError, OSError):
+            pass
+
+    def _trim(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if '.' in name:
+                continue
+            try:
+                st = os.stat(os.path.join(self.directory, name))
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(os.path.join(self.directory, name))
+            except OSError:
+                pass
+            total -= size
+
+_cache = None
+
+def enable_cache(directory, ttl=300, max_bytes=32*1024*1024):
+    global _cache
+    _cache = ResponseCache(directory, ttl=ttl, max_bytes=max_bytes)
+
+def disable_cache():
+    global _cache
+    _cache = None
+
+def get(url, headers={}, connect_timeout=None, timeout=None, max_body_bytes=None, headers_only=False):
+    if headers_only:
+        max_body_bytes = 0
+    if _cache is not None:
+        return _cache.get(url, headers, lambda: _fetch(url, headers, connect_timeout, timeout, max_body_bytes),
+                          max_body_bytes)
+    return _fetch(url, headers, connect_timeout, timeout, max_body_bytes)
+
+def _fetch(url, headers, connect_timeout, timeout, max_body_bytes=None):
+    c = _acquire(url)
+    try:
+        responses = []
+        http_response = _get(c, url, headers=headers, connect_timeout=connect_timeout,
+                             timeout=timeout, max_body_bytes=max_body_bytes)
         responses.append(http_response)
-    c.close()
+        while http_response.status in (301, 302):
+            http_response = _get(c, _redirect_url(http_response), headers, connect_timeout=connect_timeout,
+                                 timeout=timeout, max_body_bytes=max_body_bytes)
+            responses.append(http_response)
+    except:
+        c.close()
+        raise
+    _release(url, c)
     return Response(responses)
+
+def get_many(urls, headers={}, connect_timeout=None, timeout=None, concurrency=10,
+             max_body_bytes=None, headers_only=False):
+
+    """ Fetch a number of urls concurrently. This is a generator that yields
+    a (url, response, error) tuple for every url as soon as it is done, so
+    not in the order of urls. Either response is a Response or error is a
+    CurlyError. Redirects are followed like get() does and the timeouts
+    apply to every single request. """
+
+    if headers_only:
+        max_body_bytes = 0
+
+    m = pycurl.CurlMulti()
+    pending = collections.deque(urls)
+    handles = []
+    transfers = {}
+
+    def start(url, history, request_url):
+        c = handles.pop() if handles else _new_handle()
+        http_response = _prepare(c, request_url, headers=headers, connect_timeout=connect_timeout,
+                                 timeout=timeout, max_body_bytes=max_body_bytes)
+        transfers[c] = (url, history + [http_response])
+        m.add_handle(c)
+
+    try:
+        while pending or transfers:
+            while pending and len(transfers) < concurrency:
+                url = pending.popleft()
+                response = _cache.lookup(url, headers, max_body_bytes) if _cache is not None else None
+                if isinstance(response, CurlyError):
+                    yield url, None, response
+                elif response is not None:
+                    yield url, response, None
+                else:
+                    start(url, [], url)
+
+            while True:
+                ret, num_handles = m.perform()
+                if ret != pycurl.E_CALL_MULTI_PERFORM:
+                    break
+
+            while True:
+                queued, succeeded, failed = m.info_read()
+                done = [(c, None) for c in succeeded] + [(c, error) for c, error, message in failed]
+                for c, error in done:
+                    m.remove_handle(c)
+                    url, history = transfers.pop(c)
+                    # Transfers that we stopped after max_body_bytes end with an error too
+                    if error is not None and not history[-1].truncated:
+                        c.close()
+                        error = CurlyError(error)
+                        if _cache is not None:
+                            _cache.store_error(url, headers, error)
+                        yield url, None, error
+                        continue
+                    handles.append(c)
+                    if history[-1].status in (301, 302):
+                        start(url, history, _redirect_url(history[-1]))
+                    else:
+                        response = Response(history)
+                        if _cache is not None:
+                            _cache.store(url, headers, response, max_body_bytes)
+                        yield url, response, None
+                if queued == 0:
+                    break
+
+            if transfers:
+                m.select(1.0)
+    finally:
+        for c in transfers:
+            m.remove_handle(c)
+            c.close()
+        for c in handles:
+            c.close()
+        m.close()
@@ -61,7 +61,7 @@ This indicates the site is reachable.",
 
     def do_run(self):
         try:
-            r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+            r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
             r.raise_for_status()
             issue = self.format_report('good', [
                 {"Description": {"status_code": str(r.status)}}
@@ -165,7 +165,7 @@ by ensuring that their content is not embedded into other sites.",
             return True
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
         if 'x-frame-options' in r.headers:
             xfo_value = r.headers['x-frame-options']
@@ -264,7 +264,7 @@ max-age=31536000 tells the browser to apply HSTS for one year.",
     }
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
         if r.url.startswith("https://"):
             if 'strict-transport-security' in r.headers:
@@ -337,7 +337,7 @@ prevent attacks based on MIME-type confusion.",
     }
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
         xcontent_value = r.headers.get('x-content-type-options')
         if not xcontent_value:
@@ -411,7 +411,7 @@ This header enables Cross-site scripting (XSS) filter built into most recent web
     }
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
         xxss_value = r.headers.get('x-xss-protection')
         if not xxss_value:
@@ -502,7 +502,7 @@ This is typically seem in ASP and PHP web applications.",
     }
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
         headers = ('Server', 'X-Powered-By', 'X-AspNet-Version', 'X-AspNetMvc-Version', 'X-Backend-Server')
         at_least_one = False
@@ -958,7 +958,7 @@ remove unsafe-eval from the Content-Security-Policy header.",
         self.report_issues(issues)
 
     def do_run(self):
-        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15)
+        r = minion.curly.get(self.configuration['target'], connect_timeout=5, timeout=15, headers_only=True)
         r.raise_for_status()
 
         self._check_headers(r.headers)
@@ -13,13 +13,14 @@ install_requires = [
     'celery==3.1.0',
     'flask>=0.9',
     'pymongo==2.8.1', # bug in 3.0 causes false ConnectionError; fixed in trunk, TODO update once fixed
-    'requests>=1.2.2',
+    'requests>=2.10.0',
     'twisted>=13.0.0',
     'pycurl>=7.19.0',
     'gunicorn>=0.17.4',
     'ipaddress>=1.0.4',
     'netaddr>=0.7.11',
-    'celerybeat-mongo>=0.0.5'
+    'celerybeat-mongo>=0.0.5',
+    'threadpool>=1.2.7', # for 'minion-plugin-worker async', which uses the celery threads pool
 ]
 
 plugins_requires = [
@@ -48,6 +49,10 @@ setup(name="minion-backend",
     scripts=['scripts/minion-backend-api',
            'scripts/minion-create-plan',
            'scripts/minion-db-init',
+           'scripts/minion-db-index',
+           'scripts/minion-db-migrate-issues',
+           'scripts/minion-db-count-issues',
+           'scripts/minion-db-latest-scans',
            'scripts/minion-create-user',
            'scripts/minion-delete-user',
            'scripts/minion-get-users',
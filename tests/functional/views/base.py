@@ -152,10 +152,18 @@ class Sites(Resource):
         super(Sites, self).__init__()
         self.api = self.domain + "/sites"
 
-    def get(self, url=None):
+    def get(self, url=None, fields=None, limit=None, after=None, stream=None):
         params = {}
         if url:
             params["url"] = url
+        if fields:
+            params["fields"] = ",".join(fields)
+        if limit:
+            params["limit"] = limit
+        if after:
+            params["after"] = after
+        if stream:
+            params["stream"] = stream
         return self.session.get(self.api, params=params)
 
 class Site(Resource):
@@ -307,6 +315,14 @@ class Scan(Resource):
         return self.session.get(self.api + "/" + scan_id + "/summary",
             params={"email": email})
 
+    def get_state(self, scan_id, session_id=None, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/state",
+            params={"session_id": session_id, "email": email})
+
+    def get_progress(self, scan_id, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/progress",
+            params={"email": email})
+
     def start(self, scan_id, email=None):
         return self._update(scan_id, "START", email=email)
 
@@ -352,6 +368,14 @@ class Reports(Resource):
                 params["group_name"] = group_name
         return self.session.get(self.api + "/issues", params=params)
 
+class Issues(Resource):
+    def __init__(self):
+        super(Issues, self).__init__()
+        self.api = self.domain + "/issues"
+
+    def search(self, **params):
+        return self.session.get(self.api + "/search", params=params)
+
 class TestAPIBaseClass(unittest.TestCase):
     def setUp(self):
         self.mongodb = MongoClient()
@@ -4,7 +4,7 @@
 
 import time
 
-from base import (TestAPIBaseClass, User, Site, Group, Plan, Scan, Scans, Reports)
+from base import (TestAPIBaseClass, User, Site, Group, Plan, Scan, Scans, Reports, Issues)
 
 class TestScanAPIs(TestAPIBaseClass):
     TEST_PLAN = {
@@ -40,7 +40,7 @@ class TestScanAPIs(TestAPIBaseClass):
         expected_top_keys = ('success', 'scan',)
         self.assertEqual(res.json()["success"], True)
         expected_scan_keys = set(['id', 'state', 'created', 'queued', 'started', \
-                'finished', 'plan', 'configuration', 'sessions', 'meta'])
+                'finished', 'plan', 'configuration', 'sessions', 'meta', 'issue_counts'])
         self.assertEqual(set(res.json()["scan"].keys()), expected_scan_keys)
 
         meta = res.json()['scan']['meta']
@@ -54,7 +54,7 @@ class TestScanAPIs(TestAPIBaseClass):
         scan = res.json()['scan']
         expected_session_keys = ['id', 'state', 'plugin', 'configuration', \
                 'description', 'artifacts', 'issues', 'created', 'started', \
-                'queued', 'finished', 'progress']
+                'queued', 'finished', 'progress', 'dependencies', 'issue_counts']
         for session in scan['sessions']:
             self.assertEqual(set(session.keys()), set(expected_session_keys))
             self.assertEqual(session['configuration']['target'], self.target_url)
@@ -62,6 +62,7 @@ class TestScanAPIs(TestAPIBaseClass):
             self.assertEqual(session['state'], 'CREATED')
             self.assertEqual(session['artifacts'], {})
             self.assertEqual(session['issues'], [])
+            self.assertEqual(session['dependencies'], [])
             for name in ('queued', 'started', 'finished', 'progress'):
                 self.assertEqual(session[name], None)
 
@@ -158,9 +159,25 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual(res5.json()['summary']['meta'], 
             {'user': self.email, 'tags': []})
 
+        # GET /scans/<scan_id>/state
+        res_state = scan.get_state(scan_id)
+        self.assertEqual(res_state.json()['scan']['state'], 'FINISHED')
+        self.assertTrue('issues' not in res_state.json()['scan']['sessions'][0])
+        session_id = res_state.json()['scan']['sessions'][0]['id']
+        res_state = scan.get_state(scan_id, session_id=session_id)
+        self.assertEqual([session_id], [s['id'] for s in res_state.json()['scan']['sessions']])
+
+        # GET /scans/<scan_id>/progress
+        res_progress = scan.get_progress(scan_id)
+        self.assertEqual(res_progress.json()['success'], True)
+        self.assertEqual(res_progress.json()['progress']['state'], 'FINISHED')
+        self.assertEqual(set(res_progress.json()['progress']['sessions'][0].keys()),
+                         set(['id', 'state', 'progress']))
+
         # GET /reports/history
         res6 = Reports().get_history()
         self.assertEqual(res6.json()["success"], True)
+        self.assertNotIn('next', res6.json())
         expected_inner_keys = set(['configuration', 'created', 'finished', 'id',
                 'issues', "meta", 'plan', 'queued', 'sessions', 'state'])
         self.assertEqual(set(res6.json()['report'][0].keys()), expected_inner_keys)
@@ -187,3 +204,14 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual('Info', issues[0]['severity'])
         self.assertEqual(issues[0]["severity"], "Info")
         self.assertEqual(res8.json()['report'][0]['target'], self.target_url)
+
+        # GET /issues/search
+        res9 = Issues().search(target=self.target_url, facet='severity')
+        self.assertEqual(res9.json()["success"], True)
+        self.assertEqual(["Hello World"], [issue["summary"] for issue in res9.json()['issues']])
+        self.assertEqual(scan_id, res9.json()['issues'][0]['scan_id'])
+        self.assertEqual({"Info": 1}, res9.json()['facets']['severity'])
+        res10 = Issues().search(user=self.user.email, min_severity='High')
+        self.assertEqual([], res10.json()['issues'])
+        res11 = Issues().search(min_severity='Severe')
+        self.assertEqual('invalid-severity', res11.json()['reason'])
@@ -2,6 +2,8 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
+
 from base import (TestAPIBaseClass, User, Users, Site, Sites, Group, Plan)
 
 class TestSitesAPIs(TestAPIBaseClass):
@@ -102,6 +104,42 @@ class TestSitesAPIs(TestAPIBaseClass):
         self.assertEqual(res.json()['sites'][0]['groups'], site.groups)
         self.assertEqual(res.json()['sites'][0]['plans'], site.plans)
 
+    def test_get_sites_with_fields(self):
+        group = Group(self.group_name)
+        group.create()
+        site = Site(self.target_url, groups=[group.group_name])
+        site.create()
+
+        res = Sites().get(fields=['url', 'groups'])
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual(res.json()['sites'], [{'url': site.url, 'groups': site.groups}])
+
+    def test_get_sites_in_pages(self):
+        urls = [self.target_url + "/%d" % n for n in range(5)]
+        for url in urls:
+            Site(url).create()
+
+        res = Sites().get(fields=['url'], limit=2)
+        self.assertEqual(res.json()['sites'], [{'url': url} for url in urls[:2]])
+        res = Sites().get(fields=['url'], limit=2, after=res.json()['next'])
+        self.assertEqual(res.json()['sites'], [{'url': url} for url in urls[2:4]])
+        res = Sites().get(fields=['url'], limit=2, after=res.json()['next'])
+        self.assertEqual(res.json()['sites'], [{'url': urls[4]}])
+        self.assertEqual(res.json()['next'], None)
+
+        res = Sites().get(after='not-a-cursor')
+        self.assertEqual(res.json(), {'success': False, 'reason': 'invalid-cursor'})
+
+    def test_stream_sites(self):
+        urls = [self.target_url + "/%d" % n for n in range(3)]
+        for url in urls:
+            Site(url).create()
+
+        res = Sites().get(fields=['url'], stream='ndjson')
+        self.assertEqual([json.loads(line) for line in res.text.splitlines()], [{'url': url} for url in urls])
+        res = Sites().get(fields=['url'], stream='json')
+        self.assertEqual(res.json(), [{'url': url} for url in urls])
+
     def test_get_site(self):
         group = Group(self.group_name)
         group.create()
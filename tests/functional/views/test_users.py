@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from base import (TestAPIBaseClass, Users, User, Group, Groups)
+from base import (TestAPIBaseClass, Users, User, Group, Groups, Site)
 
 class TestUserAPIs(TestAPIBaseClass):
     expected_inner_keys = ('id', 'created', 'role', 'email', 'status',
@@ -94,6 +94,22 @@ class TestUserAPIs(TestAPIBaseClass):
             set(_expected))
         self.assertEqual(1, len(res.json()['users']))
 
+    def test_get_all_users_with_groups_and_sites(self):
+        bob = User(self.email)
+        bob.create()
+        alice = User("alice@example.com")
+        alice.create()
+        Site(self.target_url).create()
+        Group("group1", users=[bob.email], sites=[self.target_url]).create()
+        Group("group2", users=[bob.email, alice.email]).create()
+
+        res = Users().get()
+        users = dict((user['email'], user) for user in res.json()['users'])
+        self.assertEqual(["group1", "group2"], users[bob.email]['groups'])
+        self.assertEqual([self.target_url], users[bob.email]['sites'])
+        self.assertEqual(["group2"], users[alice.email]['groups'])
+        self.assertEqual([], users[alice.email]['sites'])
+
     def test_delete_user(self):
         # Create a user
         bob = User(self.email)
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import MagicMock
+
+from minion.backend import acl
+
+def _collections():
+    users, groups, sites, plans, counters = MagicMock(), MagicMock(), MagicMock(), MagicMock(), MagicMock()
+    users.find.return_value = [{'email': 'alice@example.com', 'role': 'user'},
+                               {'email': 'bob@example.com', 'role': 'user'},
+                               {'email': 'admin@example.com', 'role': 'administrator'}]
+    groups.find.return_value = [{'users': ['alice@example.com'], 'sites': ['http://a.example.com']},
+                                {'users': ['alice@example.com', 'bob@example.com'], 'sites': ['http://b.example.com']}]
+    sites.find.return_value = [{'url': 'http://a.example.com', 'plans': ['basic', 'nmap']},
+                               {'url': 'http://b.example.com', 'plans': ['basic', 'deleted']}]
+    plans.find.return_value = [{'name': 'basic'}, {'name': 'nmap'}]
+    counters.find_one.return_value = {'_id': 'acl', 'version': 1, 'epoch': 'a'}
+    return users, groups, sites, plans, counters
+
+class Scope(object):
+    pass
+
+class TestACLIndex(unittest.TestCase):
+
+    def test_users_see_the_sites_and_plans_of_their_groups(self):
+        index = acl.ACLIndex(*_collections())
+        alice = index.user('alice@example.com')
+        self.assertEqual('user', alice.role)
+        self.assertEqual(set(['http://a.example.com', 'http://b.example.com']), alice.targets)
+        self.assertEqual(set(['basic', 'nmap']), alice.plans)
+        bob = index.user('bob@example.com')
+        self.assertEqual(set(['http://b.example.com']), bob.targets)
+        self.assertEqual(set(['basic']), bob.plans)
+        admin = index.user('admin@example.com')
+        self.assertEqual('administrator', admin.role)
+        self.assertEqual(set(), admin.targets)
+        self.assertEqual(None, index.user('nobody@example.com'))
+
+    def test_group_members_without_a_user_see_the_plans_of_their_groups(self):
+        users, groups, sites, plans, counters = _collections()
+        groups.find.return_value.append({'users': ['carol@example.com'], 'sites': ['http://a.example.com']})
+        index = acl.ACLIndex(users, groups, sites, plans, counters)
+        self.assertEqual(None, index.user('carol@example.com'))
+        carol = index.member('carol@example.com')
+        self.assertEqual(None, carol.role)
+        self.assertEqual(set(['http://a.example.com']), carol.targets)
+        self.assertEqual(set(['basic', 'nmap']), carol.plans)
+        self.assertEqual(index.user('alice@example.com'), index.member('alice@example.com'))
+        self.assertEqual(None, index.member('nobody@example.com'))
+
+    def test_index_is_rebuilt_when_the_version_changes(self):
+        users, groups, sites, plans, counters = _collections()
+        index = acl.ACLIndex(users, groups, sites, plans, counters)
+        index.user('alice@example.com')
+        index.user('bob@example.com')
+        self.assertEqual(1, groups.find.call_count)
+        self.assertEqual(2, counters.find_one.call_count)
+
+        groups.find.return_value = [{'users': ['bob@example.com'], 'sites': ['http://a.example.com']}]
+        counters.find_one.return_value = {'_id': 'acl', 'version': 2, 'epoch': 'a'}
+        self.assertEqual(set(['http://a.example.com']), index.user('bob@example.com').targets)
+        self.assertEqual(2, groups.find.call_count)
+
+    def test_version_is_checked_once_per_scope(self):
+        users, groups, sites, plans, counters = _collections()
+        scope = Scope()
+        index = acl.ACLIndex(users, groups, sites, plans, counters, scope=lambda: scope)
+        index.user('alice@example.com')
+        index.user('bob@example.com')
+        index.member('carol@example.com')
+        self.assertEqual(1, counters.find_one.call_count)
+
+        counters.find_one.return_value = {'_id': 'acl', 'version': 2, 'epoch': 'a'}
+        index.changed()
+        index.user('alice@example.com')
+        self.assertEqual(2, counters.find_one.call_count)
+        self.assertEqual(2, groups.find.call_count)
+
+        scope = Scope()
+        index.user('alice@example.com')
+        self.assertEqual(3, counters.find_one.call_count)
+
+    def test_index_is_rebuilt_when_the_counter_is_recreated(self):
+        users, groups, sites, plans, counters = _collections()
+        index = acl.ACLIndex(users, groups, sites, plans, counters)
+        index.user('alice@example.com')
+        counters.find_one.return_value = {'_id': 'acl', 'version': 1, 'epoch': 'b'}
+        index.user('alice@example.com')
+        counters.find_one.return_value = None
+        index.user('alice@example.com')
+        self.assertEqual(3, groups.find.call_count)
+
+    def test_bump_version(self):
+        counters = MagicMock()
+        acl.bump_version(counters)
+        spec, update = counters.update.call_args[0]
+        self.assertEqual({'_id': 'acl'}, spec)
+        self.assertEqual({'version': 1}, update['$inc'])
+        self.assertTrue(update['$setOnInsert']['epoch'])
+        self.assertEqual(True, counters.update.call_args[1]['upsert'])
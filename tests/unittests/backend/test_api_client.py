@@ -0,0 +1,140 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import json
+import os
+import threading
+import unittest
+from mock import patch
+
+from minion.backend import api_client
+from minion.backend.api_client import APIClient
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    timeout = 1
+
+    def _respond(self, status, body):
+        self.server.requests.append((self.command, self.path, self.headers.get('x-minion-backend-key'),
+                                     self.client_address[1]))
+        body = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.startswith('/unavailable') and self.server.failures > 0:
+            self.server.failures -= 1
+            return self._respond(503, {'success': False})
+        self._respond(200, {'success': True, 'sites': [{'url': 'http://example.com'}]})
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('content-length', 0)))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            return self._respond(503, {'success': False})
+        self._respond(200, {'success': True})
+
+    def log_message(self, format, *args):
+        pass
+
+class Server(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.requests = []
+        self.failures = 0
+        self.threads = []
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self._process_request, args=(request, client_address))
+        self.threads.append(thread)
+        thread.start()
+
+    def _process_request(self, request, client_address):
+        self.finish_request(request, client_address)
+        self.shutdown_request(request)
+
+class TestAPIClient(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, kwargs={'poll_interval': 0.05})
+        self.thread.start()
+        self.client = APIClient('http://127.0.0.1:%d/' % self.server.server_port, key='secret',
+                                backoff_factor=0, report_interval=None)
+
+    def tearDown(self):
+        self.client.session.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        for thread in self.server.threads:
+            thread.join()
+
+    def test_connection_is_kept_alive(self):
+        for n in range(5):
+            self.assertEqual(True, self.client.get_json('/sites', params={'url': 'http://example.com'})['success'])
+        self.assertEqual(5, len(self.server.requests))
+        self.assertEqual(1, len(set(port for method, path, key, port in self.server.requests)))
+        self.assertEqual(set(['secret']), set(key for method, path, key, port in self.server.requests))
+
+    def test_get_is_retried_when_the_api_is_unavailable(self):
+        self.server.failures = 2
+        self.assertEqual(True, self.client.get_json('/unavailable')['success'])
+        self.assertEqual(3, len(self.server.requests))
+
+    def test_post_is_not_retried(self):
+        self.server.failures = 1
+        r = self.client.post('/scans', data='{}')
+        self.assertEqual(503, r.status_code)
+        self.assertEqual(1, len(self.server.requests))
+        self.assertEqual(1, self.client.stats()['POST /scans']['failures'])
+
+    def test_cached_lookup_is_made_once(self):
+        for n in range(3):
+            self.client.get_json('/sites', params={'url': 'http://example.com'}, cache=True)
+        self.client.get_json('/sites', params={'url': 'http://example.org'}, cache=True)
+        self.assertEqual(2, len(self.server.requests))
+        stats = self.client.stats()['GET /sites']
+        self.assertEqual(2, stats['calls'])
+        self.assertEqual(2, stats['cache_hits'])
+        self.assertTrue(stats['max_seconds'] > 0)
+
+    def test_cache_keeps_at_most_cache_size_responses(self):
+        self.client.cache_size = 2
+        for url in ('http://a.example.com', 'http://b.example.com', 'http://c.example.com'):
+            self.client.get_json('/sites', params={'url': url}, cache=True)
+        self.assertEqual(2, len(self.client._cache))
+        self.client.get_json('/sites', params={'url': 'http://c.example.com'}, cache=True)
+        self.client.get_json('/sites', params={'url': 'http://a.example.com'}, cache=True)
+        self.assertEqual(4, len(self.server.requests))
+
+    def test_expired_responses_are_dropped_from_the_cache(self):
+        self.client.cache_size = 2
+        self.client.cache_ttl = 0
+        for url in ('http://a.example.com', 'http://b.example.com'):
+            self.client.get_json('/sites', params={'url': url}, cache=True)
+        self.client.cache_ttl = 60
+        self.client.get_json('/sites', params={'url': 'http://c.example.com'}, cache=True)
+        self.assertEqual([('/sites', (('url', 'http://c.example.com'),))], self.client._cache.keys())
+
+    def test_endpoint_groups_calls_in_the_stats(self):
+        self.client.get_json('/scans/a', endpoint='/scans/<id>')
+        self.client.get_json('/scans/b', endpoint='/scans/<id>')
+        self.assertEqual(['GET /scans/<id>'], self.client.stats().keys())
+        self.assertEqual(2, self.client.stats()['GET /scans/<id>']['calls'])
+
+class TestClientPerProcess(unittest.TestCase):
+
+    def test_client_is_recreated_after_fork(self):
+        cfg = {'api': {'url': 'http://127.0.0.1:8383'}}
+        client = api_client.api_client(cfg)
+        self.assertTrue(client is api_client.api_client(cfg))
+        with patch('minion.backend.api_client.os.getpid', return_value=os.getpid() + 1):
+            self.assertFalse(client is api_client.api_client(cfg))
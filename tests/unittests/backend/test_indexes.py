@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import MagicMock
+
+from pymongo.errors import OperationFailure
+
+from minion.backend import indexes
+
+DECLARED = [('scans', [('id', 1)], {'unique': True}),
+            ('scans', [('configuration.target', 1), ('created', -1)], {}),
+            ('users', [('email', 1)], {'unique': True})]
+
+def _db(existing):
+    db = {}
+    for collection in ('scans', 'users'):
+        db[collection] = MagicMock()
+        info = {'_id_': {'key': [('_id', 1)]}}
+        for name, keys in existing.get(collection, {}).items():
+            info[name] = {'key': keys}
+        db[collection].index_information.return_value = info
+    return db
+
+class TestIndexes(unittest.TestCase):
+
+    def test_missing_indexes_are_matched_by_keys(self):
+        db = _db({'scans': {'custom_name': [('id', 1)]}})
+        missing = indexes.missing_indexes(db, DECLARED)
+        self.assertEqual([DECLARED[1], DECLARED[2]], missing)
+
+    def test_only_missing_indexes_are_created(self):
+        db = _db({'scans': {'id_1': [('id', 1)]}})
+        db['users'].create_index.side_effect = OperationFailure("E11000 duplicate key error")
+        created, failed = indexes.create_indexes(db, DECLARED)
+        self.assertEqual([DECLARED[1]], created)
+        db['scans'].create_index.assert_called_once_with([('configuration.target', 1), ('created', -1)], background=True)
+        self.assertEqual('users', failed[0][0])
+        self.assertTrue('duplicate key' in failed[0][3])
+
+    def test_undeclared_indexes_are_reported(self):
+        db = _db({'scans': {'id_1': [('id', 1)], 'state_1': [('state', 1)]}})
+        self.assertEqual([('scans', 'state_1', [('state', 1)])], indexes.undeclared_indexes(db, DECLARED))
+
+    def test_unused_indexes_are_reported(self):
+        db = _db({})
+        db['scans'].aggregate.return_value = [{'name': '_id_', 'accesses': {'ops': 0}},
+                                              {'name': 'id_1', 'accesses': {'ops': 10}},
+                                              {'name': 'created_-1', 'accesses': {'ops': 0}}]
+        db['users'].aggregate.return_value = []
+        self.assertEqual([('scans', 'created_-1')], indexes.unused_indexes(db, DECLARED))
+
+    def test_unused_indexes_need_index_stats(self):
+        db = _db({})
+        db['scans'].aggregate.side_effect = OperationFailure("Unrecognized pipeline stage name: '$indexStats'")
+        self.assertEqual([], indexes.unused_indexes(db, DECLARED))
+
+    def test_index_names(self):
+        self.assertEqual('configuration.target_1_plan.name_1_created_-1', indexes.index_name(indexes.INDEXES[1][1]))
@@ -0,0 +1,215 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+from mock import MagicMock, patch
+
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend import issuestore, tasks
+
+class TestIssueStore(unittest.TestCase):
+
+    def test_issue_documents(self):
+        documents = issuestore.issue_documents('scan', 'session', 'http://example.com', 'basic',
+                                               [{'Id': 'a', 'Code': 'XFO-0', 'Severity': 'High'},
+                                                {'Code': 'HSTS-1', 'Severity': 'Info'}], seq=3)
+        self.assertEqual('a', documents[0]['_id'])
+        self.assertTrue(documents[1]['_id'])
+        self.assertEqual([('XFO-0', 'High', 3, 0), ('HSTS-1', 'Info', 3, 1)],
+                         [(d['code'], d['severity'], d['seq'], d['n']) for d in documents])
+        self.assertEqual(('scan', 'session', 'http://example.com', 'basic'),
+                         (documents[0]['scan_id'], documents[0]['session_id'], documents[0]['target'], documents[0]['plan']))
+        self.assertEqual({'Id': 'a', 'Code': 'XFO-0', 'Severity': 'High'}, documents[0]['issue'])
+        self.assertTrue(isinstance(documents[0]['found'], datetime.datetime))
+
+    def test_issues_that_are_already_stored_are_skipped(self):
+        collection = MagicMock()
+        collection.insert.side_effect = DuplicateKeyError("E11000 duplicate key error")
+        issuestore.insert_issues(collection, [{'_id': 'a'}])
+        collection.insert.assert_called_once_with([{'_id': 'a'}], continue_on_error=True)
+
+    def test_stored_and_embedded_issues_are_returned_in_the_sessions(self):
+        collection = MagicMock()
+        collection.find.return_value.sort.return_value = [
+            {'session_id': 'b', 'issue': {'Summary': 'first'}},
+            {'session_id': 'b', 'issue': {'Summary': 'second'}}]
+        scan = {'id': 'scan', 'sessions': [{'id': 'a', 'issues': [{'Summary': 'old'}]}, {'id': 'b'}]}
+        issuestore.embed_issues(collection, scan)
+        self.assertEqual([[{'Summary': 'old'}], [{'Summary': 'first'}, {'Summary': 'second'}]],
+                         [s['issues'] for s in scan['sessions']])
+
+    def test_issues_of_many_scans_are_embedded_in_session_order(self):
+        scans, collection = MagicMock(), MagicMock()
+        collection.find.return_value.sort.return_value = [
+            {'scan_id': 'x', 'session_id': 'b', 'issue': {'Summary': 'first'}},
+            {'scan_id': 'y', 'session_id': 'c', 'issue': {'Summary': 'new'}}]
+        scans.find.return_value = [{'id': 'y', 'sessions': [{'id': 'c', 'issues': [{'Summary': 'old'}]}]}]
+        scan_list = [{'id': 'x', 'sessions': [{'id': 'z'}, {'id': 'b'}]}, {'id': 'y', 'sessions': [{'id': 'c'}]}]
+        issuestore.embed_issues_of_scans(scans, collection, scan_list)
+        self.assertEqual([[], [{'Summary': 'first'}]], [s['issues'] for s in scan_list[0]['sessions']])
+        self.assertEqual([[{'Summary': 'old'}, {'Summary': 'new'}]], [s['issues'] for s in scan_list[1]['sessions']])
+
+    def test_severity_counts(self):
+        collection = MagicMock()
+        collection.aggregate.return_value = {'result': [{'_id': 'High', 'count': 2}, {'_id': 'Info', 'count': 1}]}
+        scan = {'id': 'scan', 'sessions': [{'id': 'a', 'issues': [{'Severity': 'High'}]}]}
+        self.assertEqual({'High': 3, 'Info': 1}, issuestore.severity_counts(collection, scan))
+
+    def test_migrate_scan(self):
+        scans, collection = MagicMock(), MagicMock()
+        scan = {'id': 'scan', 'configuration': {'target': 'http://example.com'}, 'plan': {'name': 'basic'},
+                'sessions': [{'id': 'a', 'issues': [{'Id': '1'}, {'Id': '2'}]}, {'id': 'b'}]}
+        self.assertEqual(2, issuestore.migrate_scan(scans, collection, scan))
+        self.assertEqual(['1', '2'], [d['_id'] for d in collection.insert.call_args[0][0]])
+        scans.update.assert_called_once_with({'id': 'scan', 'sessions.id': 'a'}, {'$unset': {'sessions.$.issues': ''}})
+
+    def test_migrated_issues_were_found_when_the_scan_finished(self):
+        scans, collection = MagicMock(), MagicMock()
+        finished = datetime.datetime(2015, 1, 1)
+        scan = {'id': 'scan', 'finished': finished, 'sessions': [{'id': 'a', 'issues': [{'Id': '1'}]}]}
+        issuestore.migrate_scan(scans, collection, scan)
+        self.assertEqual([finished], [d['found'] for d in collection.insert.call_args[0][0]])
+
+    def test_backfill_found(self):
+        scans, collection = MagicMock(), MagicMock()
+        collection.find.return_value.distinct.return_value = ['a', 'b']
+        created = datetime.datetime(2015, 1, 1)
+        scans.find_one.side_effect = [{'id': 'a', 'created': created, 'finished': None}, None]
+        self.assertEqual(1, issuestore.backfill_found(scans, collection))
+        collection.update.assert_called_once_with({'scan_id': 'a', 'found': {'$exists': False}},
+                                                  {'$set': {'found': created}}, multi=True)
+
+class TestIssueCounts(unittest.TestCase):
+
+    def test_count_increments(self):
+        inc = issuestore.count_increments([{'Severity': 'High'}, {'Severity': 'High'},
+                                           {'Severity': 'Info'}, {'Severity': 'Error'}])
+        self.assertEqual({'issue_counts.high': 2, 'sessions.$.issue_counts.high': 2,
+                          'issue_counts.info': 1, 'sessions.$.issue_counts.info': 1}, inc)
+
+    def test_counters_are_used_when_the_scan_has_them(self):
+        scans, collection = MagicMock(), MagicMock()
+        stored = {'critical': 0, 'high': 2, 'medium': 0, 'low': 0, 'info': 0}
+        counts = issuestore.issue_counts(scans, collection, {'id': 'scan', 'issue_counts': stored})
+        self.assertEqual(stored, counts)
+        self.assertFalse(collection.aggregate.called)
+        self.assertFalse(scans.find_one.called)
+
+    def test_issues_are_counted_when_the_scan_has_no_counters(self):
+        scans, collection = MagicMock(), MagicMock()
+        collection.aggregate.return_value = {'result': [{'_id': 'Low', 'count': 4}]}
+        counts = issuestore.issue_counts(scans, collection, {'id': 'scan', 'sessions': [{'issues': []}]})
+        self.assertEqual(4, counts['low'])
+        self.assertFalse(scans.find_one.called)
+
+    def test_partial_counters_are_recounted(self):
+        scans, collection = MagicMock(), MagicMock()
+        collection.aggregate.return_value = {'result': [{'_id': 'High', 'count': 3}, {'_id': 'Low', 'count': 4}]}
+        counts = issuestore.issue_counts(scans, collection, {'id': 'scan', 'issue_counts': {'high': 1},
+                                                             'sessions': [{'issues': []}]})
+        self.assertEqual({'critical': 0, 'high': 3, 'medium': 0, 'low': 4, 'info': 0}, counts)
+
+    def test_embedded_issues_are_read_for_a_summary_without_counters(self):
+        scans, collection = MagicMock(), MagicMock()
+        scans.find_one.return_value = {'id': 'scan', 'sessions': [{'issues': [{'Severity': 'High'}]},
+                                                                  {'issues': [{'Severity': 'High'}]}]}
+        collection.aggregate.return_value = {'result': [{'_id': 'Low', 'count': 1}]}
+        counts = issuestore.issue_counts(scans, collection, {'id': 'scan', 'sessions': [{'id': 's1'}, {'id': 's2'}]})
+        self.assertEqual({'critical': 0, 'high': 2, 'medium': 0, 'low': 1, 'info': 0}, counts)
+        self.assertEqual({'id': 'scan'}, scans.find_one.call_args[0][0])
+
+    def test_backfill_counts(self):
+        scans, collection = MagicMock(), MagicMock()
+        collection.aggregate.return_value = {'result': [
+            {'_id': {'session_id': 'b', 'severity': 'High'}, 'count': 3},
+            {'_id': {'session_id': 'b', 'severity': 'Error'}, 'count': 1}]}
+        scan = {'id': 'scan', 'sessions': [{'id': 'a', 'issues': [{'Severity': 'High'}, {'Severity': 'Info'}]},
+                                           {'id': 'b'}]}
+        counts = issuestore.backfill_counts(scans, collection, scan)
+        self.assertEqual(4, counts['high'])
+        self.assertEqual(1, counts['info'])
+        spec, update = scans.update.call_args[0]
+        self.assertEqual('scan', spec['id'])
+        self.assertEqual({'issue_counts.info': {'$exists': False}}, spec['$or'][-1])
+        self.assertEqual(1, update['$set']['sessions.0.issue_counts']['high'])
+        self.assertEqual(3, update['$set']['sessions.1.issue_counts']['high'])
+        self.assertEqual(counts, update['$set']['issue_counts'])
+
+class TestReportIssues(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.scans', create=True)
+        self._mk2 = patch('minion.backend.tasks.db', create=True)
+        self.mk_scans = self._mk1.start()
+        self.mk_db = self._mk2.start()
+        self.mk_scans.find_one.return_value = {'configuration': {'target': 'http://example.com'}, 'plan': {'name': 'basic'},
+                                               'issue_counts': issuestore.empty_counts()}
+        self.mk_scans.update.return_value = {'n': 1}
+        tasks._scan_details.clear()
+
+    def tearDown(self):
+        self._mk1.stop()
+        self._mk2.stop()
+
+    def test_issues_are_inserted_and_the_sequence_is_advanced(self):
+        tasks.session_report_issues('scan', 'session', [{'Id': 'a'}], seq=2)
+        tasks.session_report_issues('scan', 'session', [{'Id': 'b'}], seq=3)
+        self.assertEqual(1, self.mk_scans.find_one.call_count)
+        self.assertEqual([['a'], ['b']], [[d['_id'] for d in c[0][0]] for c in self.mk_db.issues.insert.call_args_list])
+        self.assertEqual('http://example.com', self.mk_db.issues.insert.call_args[0][0][0]['target'])
+        self.assertEqual({'$set': {'sessions.$._seq': 3}}, self.mk_scans.update.call_args[0][1])
+
+    def test_issues_without_sequence_do_not_update_the_scan(self):
+        tasks.session_report_issue('scan', 'session', {'Id': 'a'})
+        self.assertFalse(self.mk_scans.update.called)
+        self.assertTrue(self.mk_db.issues.insert.called)
+
+    def test_counters_are_incremented_with_the_ordered_update(self):
+        tasks.session_report_issues('scan', 'session', [{'Id': 'a', 'Severity': 'High'}], seq=1)
+        self.assertEqual({'$inc': {'issue_counts.high': 1, 'sessions.$.issue_counts.high': 1},
+                          '$set': {'sessions.$._seq': 1}}, self.mk_scans.update.call_args[0][1])
+
+    def test_scan_without_counters_is_not_given_partial_ones(self):
+        del self.mk_scans.find_one.return_value['issue_counts']
+        tasks.session_report_issues('scan', 'session', [{'Id': 'a', 'Severity': 'High'}], seq=1)
+        self.assertEqual({'$set': {'sessions.$._seq': 1}}, self.mk_scans.update.call_args[0][1])
+
+class TestIssueSearch(unittest.TestCase):
+
+    def test_severities_at_least(self):
+        self.assertEqual(['Critical', 'High'], issuestore.severities_at_least('high'))
+        self.assertEqual(list(issuestore.SEVERITIES), issuestore.severities_at_least('Info'))
+        self.assertEqual(None, issuestore.severities_at_least('Severe'))
+
+    def test_no_filters_match_everything(self):
+        self.assertEqual({}, issuestore.search_query())
+
+    def test_search_query(self):
+        since = datetime.datetime(2015, 1, 1)
+        query = issuestore.search_query(targets=['http://example.com'], plans=['basic'], codes=['SD-0'],
+                                        severities=['High'], since=since)
+        self.assertEqual({'target': {'$in': ['http://example.com']},
+                          'plan': {'$in': ['basic']},
+                          'code': {'$in': ['SD-0']},
+                          'severity': {'$in': ['High']},
+                          'found': {'$gte': since}}, query)
+
+    def test_codes_and_code_prefixes(self):
+        self.assertEqual({'code': {'$regex': '^SD\\-'}}, issuestore.search_query(code_prefixes=['SD-']))
+        self.assertEqual({'$or': [{'code': {'$in': ['XFO-0']}}, {'code': {'$regex': '^SD\\-'}}]},
+                         issuestore.search_query(codes=['XFO-0'], code_prefixes=['SD-']))
+
+    def test_no_targets_match_nothing(self):
+        self.assertEqual({'target': {'$in': []}}, issuestore.search_query(targets=set()))
+
+    def test_facet_counts(self):
+        collection = MagicMock()
+        collection.aggregate.return_value = {'result': [{'_id': 'High', 'count': 2}, {'_id': 'Info', 'count': 1}]}
+        self.assertEqual({'severity': {'High': 2, 'Info': 1}},
+                         issuestore.facet_counts(collection, {'code': {'$in': ['SD-0']}}, ['severity']))
+        pipeline = collection.aggregate.call_args[0][0]
+        self.assertEqual({'$match': {'code': {'$in': ['SD-0']}}}, pipeline[0])
+        self.assertEqual({'_id': '$severity', 'count': {'$sum': 1}}, pipeline[1]['$group'])
@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+from mock import MagicMock, patch
+
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend import latestscans, tasks
+
+def _scan(id, created):
+    return {'id': id, 'state': 'FINISHED', 'created': created,
+            'configuration': {'target': 'http://example.com'}, 'plan': {'name': 'basic'}}
+
+class TestLatestScans(unittest.TestCase):
+
+    def test_scan_replaces_older_scans_of_its_site_and_plan(self):
+        latest_scans, scans = MagicMock(), MagicMock()
+        created = datetime.datetime(2015, 1, 1)
+        scans.find_one.return_value = _scan('a', created)
+        latestscans.record_scan(latest_scans, scans, 'a')
+        self.assertEqual(latestscans.LATEST_SCAN_FIELDS, scans.find_one.call_args[0][1])
+        spec, update = latest_scans.update.call_args[0]
+        self.assertEqual({'target': 'http://example.com', 'plan': 'basic',
+                          '$or': [{'scan': None}, {'scan.created': {'$lte': created}}]}, spec)
+        self.assertEqual({'$set': {'scan': _scan('a', created)}}, update)
+        self.assertEqual(True, latest_scans.update.call_args[1]['upsert'])
+        latest_scans.ensure_index.assert_called_once_with([('target', 1), ('plan', 1)], unique=True)
+
+    def test_older_scan_does_not_replace_a_newer_one(self):
+        latest_scans, scans = MagicMock(), MagicMock()
+        scans.find_one.return_value = _scan('a', datetime.datetime(2015, 1, 1))
+        latest_scans.update.side_effect = DuplicateKeyError("E11000 duplicate key error")
+        latestscans.record_scan(latest_scans, scans, 'a')
+
+    def test_backfill(self):
+        latest_scans, scans, scanschedules = MagicMock(), MagicMock(), MagicMock()
+        scans.aggregate.return_value = {'result': [{'_id': {'target': 'http://example.com', 'plan': 'basic'}, 'id': 'a'}]}
+        scans.find_one.return_value = _scan('a', datetime.datetime(2015, 1, 1))
+        scanschedules.find.return_value = [{'site': 'http://example.com', 'plan': 'basic',
+                                            'crontab': {'minute': '0'}, 'enabled': True}]
+        self.assertEqual((1, 1), latestscans.backfill(latest_scans, scans, scanschedules))
+        self.assertEqual(({'target': 'http://example.com', 'plan': 'basic'},
+                          {'$set': {'crontab': {'minute': '0'}, 'scheduleEnabled': True}}),
+                         latest_scans.update.call_args[0])
+
+class TestScanFinishRecordsLatestScan(unittest.TestCase):
+
+    @patch('minion.backend.tasks.db', create=True)
+    @patch('minion.backend.tasks.scans', create=True)
+    def test_finished_scan_is_recorded(self, mk_scans, mk_db):
+        mk_scans.find_one.return_value = dict(_scan('scan', datetime.datetime(2015, 1, 1)), sessions=[])
+        tasks.scan_finish('scan', 'FINISHED', 1400000000)
+        self.assertTrue(mk_db.latest_scans.update.called)
+
+    @patch('minion.backend.tasks.revoke')
+    @patch('minion.backend.tasks.db', create=True)
+    @patch('minion.backend.tasks.scans', create=True)
+    def test_stopped_scan_that_was_finished_is_recorded(self, mk_scans, mk_db, mk_revoke):
+        mk_scans.find_one.return_value = dict(_scan('scan', datetime.datetime(2015, 1, 1)),
+                                              finished=datetime.datetime(2015, 1, 2), sessions=[])
+        tasks.scan_stop('scan')
+        self.assertTrue(mk_db.latest_scans.update.called)
+
+    @patch('minion.backend.tasks.db', create=True)
+    @patch('minion.backend.tasks.scans', create=True)
+    def test_finished_session_records_its_scan(self, mk_scans, mk_db):
+        mk_scans.find_one.return_value = dict(_scan('scan', datetime.datetime(2015, 1, 1)),
+                                              sessions=[{'id': 'session', 'state': 'STARTED'}])
+        mk_scans.update.return_value = {'n': 1}
+        tasks.session_finish('scan', 'session', 'FINISHED', 1400000000)
+        self.assertTrue(mk_db.latest_scans.update.called)
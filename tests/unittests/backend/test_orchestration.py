@@ -0,0 +1,176 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+from mock import MagicMock, patch
+
+from minion.backend import tasks
+
+def _session(id, state='CREATED', dependencies=None):
+    return {'id': id, 'state': state, 'dependencies': dependencies or [],
+            'plugin': {'class': 'minion.plugins.test.HelloWorldPlugin', 'weight': 'light'}}
+
+class TestScanOrchestration(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self._mk2 = patch('minion.backend.tasks.get_scan_state')
+        self._mk3 = patch('minion.backend.tasks.revoke')
+
+        self.mocks = [self._mk1, self._mk2, self._mk3]
+
+        self.mk_send_task = self._mk1.start()
+        self.mk_get_scan = self._mk2.start()
+        self.mk_revoke = self._mk3.start()
+
+        # Every claim succeeds and every plugin task gets its own id
+        self.mk_send_task.return_value.get.return_value = True
+        self.mk_send_task.return_value.id = 'task-id'
+
+    def tearDown(self):
+        for mock in self.mocks:
+            mock.stop()
+
+    def _sent(self, name):
+        return [c[0][1] for c in self.mk_send_task.call_args_list
+                if c[0][0] == 'minion.backend.tasks.' + name]
+
+    def test_ready_sessions_are_dispatched_together(self):
+        scan = {'id': 'scan', 'state': 'STARTED',
+                'sessions': [_session('alive', state='FINISHED'),
+                             _session('b', dependencies=['alive']),
+                             _session('c', dependencies=['alive'])]}
+        tasks.advance_scan(scan)
+        self.assertEqual([['scan', 'b'], ['scan', 'c']], self._sent('run_plugin'))
+        self.assertEqual([], self._sent('scan_finish'))
+
+    def test_lost_claim_is_not_dispatched_and_does_not_finish_the_scan(self):
+        self.mk_send_task.return_value.get.return_value = False
+        scan = {'id': 'scan', 'state': 'STARTED',
+                'sessions': [_session('a', state='FINISHED'), _session('b', dependencies=['a'])]}
+        tasks.advance_scan(scan)
+        self.assertEqual([], self._sent('run_plugin'))
+        self.assertEqual([], self._sent('scan_finish'))
+
+    def test_scan_finishes_when_nothing_is_left(self):
+        scan = {'id': 'scan', 'state': 'STARTED',
+                'sessions': [_session('a', state='FINISHED'), _session('b', state='FAILED')]}
+        tasks.advance_scan(scan)
+        self.assertEqual('FAILED', self._sent('scan_finish')[0][1])
+
+    def test_aborted_session_stops_the_scan(self):
+        self.mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'STARTED', 'finished': None,
+            'sessions': [_session('alive', state='ABORTED'),
+                         _session('b', state='STARTED'),
+                         _session('c', dependencies=['alive'])]}
+        self.mk_get_scan.return_value['sessions'][1]['_task'] = 'task-b'
+        tasks.scan_session_done('ABORTED', 'scan', 'alive')
+        self.mk_revoke.assert_called_with('task-b', terminate=True, signal='SIGUSR1')
+        self.assertEqual('ABORTED', self._sent('scan_finish')[0][1])
+        self.assertEqual([['scan', 'c', 'CANCELLED']], [args[:3] for args in self._sent('session_finish')])
+        self.assertEqual([], self._sent('run_plugin'))
+
+    def test_finished_scan_is_left_alone(self):
+        self.mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'ABORTED', 'finished': 1400000000,
+            'sessions': [_session('a', state='FINISHED')]}
+        tasks.scan_session_done('FINISHED', 'scan', 'a')
+        self.assertFalse(self.mk_send_task.called)
+
+    def test_failed_plugin_task_stores_the_session_as_failed(self):
+        self.mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'STARTED', 'finished': None,
+            'sessions': [_session('a', state='STARTED')]}
+        tasks.scan_session_error('task-a', 'scan', 'a')
+        self.assertEqual([['scan', 'a', 'FAILED']], [args[:3] for args in self._sent('session_finish')])
+        self.assertEqual('FAILED', self._sent('scan_finish')[0][1])
+
+    def test_stopped_plugin_of_a_failed_session_does_not_stop_the_scan(self):
+        self.mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'STARTED', 'finished': None,
+            'sessions': [_session('a', state='FAILED'), _session('b', dependencies=['a'])]}
+        tasks.scan_session_done('STOPPED', 'scan', 'a')
+        self.assertFalse(self.mk_revoke.called)
+        self.assertEqual([], self._sent('session_finish'))
+        self.assertEqual([['scan', 'b']], self._sent('run_plugin'))
+
+class TestSessionWatchdog(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self._mk2 = patch('minion.backend.tasks.get_scan_state')
+        self._mk3 = patch('minion.backend.tasks.revoke')
+        self._mk4 = patch('minion.backend.tasks.scans', create=True)
+        self._mk5 = patch('minion.backend.tasks.celery.AsyncResult')
+
+        self.mocks = [self._mk1, self._mk2, self._mk3, self._mk4, self._mk5]
+
+        self.mk_send_task = self._mk1.start()
+        self.mk_get_scan = self._mk2.start()
+        self.mk_revoke = self._mk3.start()
+        self.mk_scans = self._mk4.start()
+        self.mk_async_result = self._mk5.start()
+
+        self.mk_async_result.return_value.state = 'STARTED'
+        self.now = datetime.datetime.utcnow()
+
+    def tearDown(self):
+        for mock in self.mocks:
+            mock.stop()
+
+    def _running(self, started=None):
+        session = _session('a', state='STARTED')
+        session.update(_task='task-a', started=started or self.now)
+        self.mk_scans.find.return_value = [{'id': 'scan', 'sessions': [session]}]
+        self.mk_get_scan.return_value = {'id': 'scan', 'state': 'STARTED', 'finished': None,
+                                         'sessions': [dict(session)]}
+
+    def _finished(self):
+        return [c[0][1][:3] for c in self.mk_send_task.call_args_list
+                if c[0][0] == 'minion.backend.tasks.session_finish']
+
+    def test_running_session_is_left_alone(self):
+        self._running()
+        tasks.check_sessions()
+        self.assertEqual([], self._finished())
+        self.assertFalse(self.mk_revoke.called)
+
+    def test_session_of_lost_task_is_failed_and_the_scan_continues(self):
+        self.mk_async_result.return_value.state = 'FAILURE'
+        self._running()
+        tasks.check_sessions()
+        self.assertEqual([['scan', 'a', 'FAILED']], self._finished())
+        scan_finish = [c[0][1] for c in self.mk_send_task.call_args_list
+                       if c[0][0] == 'minion.backend.tasks.scan_finish']
+        self.assertEqual('FAILED', scan_finish[0][1])
+
+    def test_task_result_of_a_queued_session_is_not_looked_at(self):
+        self._running()
+        self.mk_scans.find.return_value[0]['sessions'][0]['state'] = 'QUEUED'
+        tasks.check_sessions()
+        self.assertFalse(self.mk_async_result.called)
+        self.assertEqual([], self._finished())
+
+    def test_session_that_runs_too_long_is_revoked_and_failed(self):
+        self._running(started=self.now - datetime.timedelta(seconds=tasks.SESSION_TIMEOUT + 60))
+        tasks.check_sessions()
+        self.mk_revoke.assert_called_with('task-a', terminate=True, signal='SIGUSR1')
+        self.assertEqual([['scan', 'a', 'FAILED']], self._finished())
+
+    def test_threaded_session_is_revoked_without_terminate(self):
+        self._running(started=self.now - datetime.timedelta(seconds=tasks.SESSION_TIMEOUT + 60))
+        self.mk_scans.find.return_value[0]['sessions'][0]['_threaded'] = True
+        tasks.check_sessions()
+        self.mk_revoke.assert_called_with('task-a')
+
+class TestGetScanState(unittest.TestCase):
+
+    @patch('minion.backend.tasks.api_client')
+    def test_only_the_state_of_one_session_is_requested(self, mk_api_client):
+        mk_api_client.return_value.get_json.return_value = {'success': True, 'scan': {'id': 'scan'}}
+        self.assertEqual({'id': 'scan'}, tasks.get_scan_state('scan', 'session'))
+        mk_api_client.return_value.get_json.assert_called_once_with(
+            '/scans/scan/state', params={'session_id': 'session'}, endpoint='/scans/<id>/state')
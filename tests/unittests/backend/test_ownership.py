@@ -8,9 +8,6 @@ from mock import MagicMock, patch
 import minion.curly
 from minion.backend import ownership
 
-minion.curly.CurlyError = Exception
-minion.curly.BadResponseError = Exception
-
 class TestOwnership(unittest.TestCase):
     
     def setUp(self):
@@ -18,16 +15,19 @@ class TestOwnership(unittest.TestCase):
         self._mk2 = patch('minion.backend.ownership.Popen')
         self._mk3 = patch('minion.backend.ownership.PIPE')
         self._mk4 = patch('minion.curly.get')
-        
+        self._mk5 = patch('minion.curly.CurlyError', Exception)
+        self._mk6 = patch('minion.curly.BadResponseError', Exception)
 
         self.mocks = []
-        for i in xrange(1, 5):
+        for i in xrange(1, 7):
             self.mocks.append(getattr(self, '_mk%s' % str(i)))
 
         self.mk_urlparse = self._mk1.start()
         self.mk_popen = self._mk2.start()
         self.mk_pipe = self._mk3.start()
         self.mk_curly = self._mk4.start()
+        self._mk5.start()
+        self._mk6.start()
 
         self.target = 'http://foobar.com'
         self.file_name = '/burger.txt'
@@ -0,0 +1,119 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import subprocess
+import sys
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+def _pipe():
+    r, w = os.pipe()
+    return os.fdopen(r, 'rb'), w
+
+def _read_all(output):
+    lines = []
+    while not output.closed:
+        lines.extend(output.read(1.0))
+    return lines
+
+class TestPluginOutput(unittest.TestCase):
+
+    def test_lines_are_framed_across_reads(self):
+        stdout, w = _pipe()
+        output = tasks.PluginOutput(stdout)
+        os.write(w, '{"msg": "st')
+        self.assertEqual([], output.read(1.0))
+        os.write(w, 'art"}\n{"msg": "finish"}\n{"msg"')
+        self.assertEqual(['{"msg": "start"}', '{"msg": "finish"}'], output.read(1.0))
+        os.write(w, ': "last"}')
+        os.close(w)
+        self.assertEqual(['{"msg": "last"}'], _read_all(output))
+
+    def test_long_lines_are_dropped(self):
+        stdout, w = _pipe()
+        output = tasks.PluginOutput(stdout, max_line_length=10)
+        os.write(w, 'short\n' + 'x' * 8)
+        os.write(w, 'x' * 8 + '\nafter\n')
+        os.close(w)
+        self.assertEqual(['short', 'after'], _read_all(output))
+
+    def test_stderr_tail_is_kept(self):
+        stdout, w1 = _pipe()
+        stderr, w2 = _pipe()
+        output = tasks.PluginOutput(stdout, stderr, stderr_tail_bytes=10)
+        os.write(w2, 'Traceback: something went wrong')
+        os.close(w1)
+        os.close(w2)
+        self.assertEqual([], _read_all(output))
+        self.assertEqual('went wrong', output.stderr)
+
+class TestRunPlugin(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.get_scan_state')
+        self._mk2 = patch('minion.backend.tasks.send_task')
+        self._mk3 = patch('minion.backend.tasks.start_plugin_runner')
+
+        self.mocks = [self._mk1, self._mk2, self._mk3]
+
+        self.mk_get_scan = self._mk1.start()
+        self.mk_send_task = self._mk2.start()
+        self.mk_start_plugin_runner = self._mk3.start()
+
+        self.mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'STARTED',
+            'sessions': [{'id': 'session', 'state': 'QUEUED', 'configuration': {},
+                          'plugin': {'class': 'minion.plugins.test.HelloWorldPlugin'}}]}
+
+    def tearDown(self):
+        for mock in self.mocks:
+            mock.stop()
+
+    def _runner(self, script):
+        self.mk_start_plugin_runner.return_value = subprocess.Popen(
+            [sys.executable, '-c', script], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _sent(self, name):
+        return [c[0][1] for c in self.mk_send_task.call_args_list
+                if c[0][0] == 'minion.backend.tasks.' + name]
+
+    def test_issues_and_finish_are_reported(self):
+        messages = [{"msg": "start"},
+                    {"msg": "issue", "data": {"Summary": "Hello World"}},
+                    {"msg": "finish", "data": {"state": "FINISHED", "failure": ""}}]
+        self._runner("import sys\n" + "".join("print %r\n" % json.dumps(m) for m in messages)
+                     + "sys.stderr.write('x' * 200000)\n")
+        self.assertEqual('FINISHED', tasks.run_plugin('scan', 'session'))
+        self.assertEqual([[{"Summary": "Hello World"}]], [args[2] for args in self._sent('session_report_issues')])
+        self.assertEqual('FINISHED', self._sent('session_finish')[0][2])
+
+    def test_stderr_is_added_to_the_failure(self):
+        self._runner("import sys\nsys.stderr.write('ImportError: No module named nmap\\n')\n")
+        self.assertEqual('FAILED', tasks.run_plugin('scan', 'session'))
+        failure = self._sent('session_finish')[0][4]
+        self.assertEqual('FAILED', self._sent('session_finish')[0][2])
+        self.assertEqual('ImportError: No module named nmap\n', failure['stderr'])
+
+    def test_session_that_cannot_be_found_is_failed(self):
+        self.mk_get_scan.return_value['sessions'] = []
+        self.assertEqual('FAILED', tasks.run_plugin('scan', 'session'))
+        self.assertEqual(['scan', 'session', 'FAILED'], self._sent('session_finish')[0][:3])
+        self.assertFalse(self.mk_start_plugin_runner.called)
+
+    def test_queued_session_of_a_finished_scan_is_cancelled(self):
+        self.mk_get_scan.return_value['state'] = 'ABORTED'
+        self.assertEqual('CANCELLED', tasks.run_plugin('scan', 'session'))
+        self.assertEqual(['scan', 'session', 'CANCELLED'], self._sent('session_finish')[0][:3])
+        self.assertFalse(self.mk_start_plugin_runner.called)
+
+    def test_runner_with_malformed_output_is_killed_and_the_session_fails(self):
+        self._runner("import sys, time\nprint 'this is not json'\nsys.stdout.flush()\ntime.sleep(60)\n")
+        p = self.mk_start_plugin_runner.return_value
+        self.assertEqual('FAILED', tasks.run_plugin('scan', 'session'))
+        self.assertEqual(-9, p.returncode)
+        self.assertEqual('FAILED', self._sent('session_finish')[-1][2])
@@ -0,0 +1,108 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+SESSION = {'id': 'session',
+           'configuration': {'target': 'http://localhost'},
+           'plugin': {'class': 'minion.plugins.test.HelloWorldPlugin'}}
+
+class FakePool(threading.Thread):
+
+    """ Accepts one connection and answers like a plugin runner pool child """
+
+    def __init__(self, path, status=0):
+        threading.Thread.__init__(self)
+        self.status = status
+        self.daemon = True
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.listener.bind(path)
+        self.listener.listen(1)
+
+    def run(self):
+        connection, _ = self.listener.accept()
+        self.request = json.loads(connection.makefile('rb').readline())
+        connection.sendall(json.dumps({"msg": "pid", "data": {"pid": 1234}}) + "\n")
+        connection.sendall(json.dumps({"msg": "start"}) + "\n")
+        if self.status is not None:
+            connection.sendall(json.dumps({"msg": "exit", "data": {"status": self.status}}) + "\n")
+        connection.close()
+        self.listener.close()
+
+class TestPluginRunnerPool(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'pool.sock')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_session_runs_in_the_pool(self):
+        pool = FakePool(self.path)
+        pool.start()
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        self.assertEqual(1234, p.pid)
+        self.assertEqual([json.dumps({"msg": "start"}) + "\n"], list(p.stdout))
+        self.assertEqual(0, p.wait())
+        pool.join()
+        self.assertEqual({'plugin': 'minion.plugins.test.HelloWorldPlugin',
+                          'configuration': {'target': 'http://localhost'},
+                          'session_id': 'session',
+                          'scan_id': 'scan'}, pool.request)
+
+    @patch('minion.backend.tasks.os.kill')
+    def test_signals_go_to_the_session_process(self, mk_kill):
+        pool = FakePool(self.path)
+        pool.start()
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        p.send_signal(10)
+        mk_kill.assert_called_once_with(1234, 10)
+        p.wait()
+        pool.join()
+
+    @patch('minion.backend.tasks.subprocess.Popen')
+    def test_falls_back_to_a_new_plugin_runner(self, mk_popen):
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        self.assertEqual(mk_popen.return_value, p)
+        self.assertEqual('minion-plugin-runner', mk_popen.call_args[0][0][0])
+
+    def test_exit_status_of_the_session_is_reported(self):
+        pool = FakePool(self.path, status=-9)
+        pool.start()
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        self.assertEqual([json.dumps({"msg": "start"}) + "\n"], list(p.stdout))
+        self.assertEqual(-9, p.wait())
+        pool.join()
+
+    def test_missing_exit_status_is_a_failure(self):
+        pool = FakePool(self.path, status=None)
+        pool.start()
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        list(p.stdout)
+        self.assertEqual(1, p.wait())
+        pool.join()
+
+    @patch('minion.backend.tasks.subprocess.Popen')
+    def test_socket_in_a_shared_directory_is_not_used(self, mk_popen):
+        os.chmod(self.directory, 0o777)
+        pool = FakePool(self.path)
+        with patch.dict(tasks.cfg, {'plugin_runner_pool': {'socket': self.path}}):
+            p = tasks.start_plugin_runner('scan', 'session', SESSION)
+        self.assertEqual(mk_popen.return_value, p)
+        pool.listener.close()
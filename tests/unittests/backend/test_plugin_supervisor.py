@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import sys
+import threading
+import time
+import unittest
+from mock import patch
+
+from twisted.internet import reactor
+
+from minion.backend import tasks
+
+supervisor = tasks.PluginSupervisor()
+
+def tearDownModule():
+    if supervisor._thread is not None:
+        reactor.callFromThread(reactor.stop)
+        supervisor._thread.join()
+
+def _script(*messages):
+    return "".join("print %r\n" % json.dumps(m) for m in messages) + "import sys\nsys.stdout.flush()\n"
+
+class TestPluginSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self.mk_send_task = self._mk1.start()
+
+    def tearDown(self):
+        self._mk1.stop()
+
+    def _sent(self, name):
+        return [c[0][1] for c in self.mk_send_task.call_args_list
+                if c[0][0] == 'minion.backend.tasks.' + name]
+
+    def test_sessions_run_concurrently(self):
+        script = "import time\ntime.sleep(0.5)\n" + _script(
+            {"msg": "issue", "data": {"Summary": "Hello World"}},
+            {"msg": "finish", "data": {"state": "FINISHED", "failure": ""}})
+        results = {}
+        def run(n):
+            plugin_session = tasks.PluginSession('scan', 'session-%d' % n)
+            supervisor.run('task-%d' % n, plugin_session, [sys.executable, '-c', script])
+            results[n] = plugin_session.end()
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(3.0)
+        self.assertEqual(dict((n, 'FINISHED') for n in range(8)), results)
+        self.assertEqual(8, len(self._sent('session_report_issues')))
+
+    STOPPABLE = ("import signal, sys, time, json\n"
+                 "time.sleep(%s)\n"
+                 "def stop(signum, frame):\n"
+                 "    print json.dumps({'msg': 'finish', 'data': {'state': 'STOPPED', 'failure': ''}})\n"
+                 "    sys.exit(0)\n"
+                 "signal.signal(signal.SIGUSR1, stop)\n"
+                 "print json.dumps({'msg': 'start'})\n"
+                 "sys.stdout.flush()\n"
+                 "time.sleep(30)\n")
+
+    def _run_in_thread(self, task_id, plugin_session, script):
+        thread = threading.Thread(target=supervisor.run, args=(task_id, plugin_session, [sys.executable, '-c', script]))
+        thread.start()
+        return thread
+
+    def test_revoked_session_is_stopped(self):
+        plugin_session = tasks.PluginSession('scan', 'session')
+        revoked = set()
+        with patch('minion.backend.tasks.worker_state.revoked', revoked):
+            thread = self._run_in_thread('task-revoked', plugin_session, self.STOPPABLE % 0)
+            deadline = time.time() + 10
+            while not plugin_session.started and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertTrue(plugin_session.started)
+            revoked.add('task-revoked')
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual('STOPPED', plugin_session.end())
+
+    def test_session_revoked_before_start_is_stopped_after_start(self):
+        plugin_session = tasks.PluginSession('scan', 'session')
+        with patch('minion.backend.tasks.worker_state.revoked', set(['task-early'])):
+            thread = self._run_in_thread('task-early', plugin_session, self.STOPPABLE % 1)
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual('STOPPED', plugin_session.end())
+
+    @patch('minion.backend.tasks.Runner.START_TIMEOUT', 0.5)
+    def test_revoked_runner_that_does_not_start_is_killed(self):
+        plugin_session = tasks.PluginSession('scan', 'session')
+        with patch('minion.backend.tasks.worker_state.revoked', set(['task-silent'])):
+            thread = self._run_in_thread('task-silent', plugin_session, "import time\ntime.sleep(30)\n")
+            thread.join(10)
+        self.assertFalse(thread.is_alive())
+        self.assertEqual('FAILED', plugin_session.end())
+        self.assertEqual('FAILED', self._sent('session_finish')[0][2])
+
+    def test_session_updates_are_not_sent_from_the_reactor_thread(self):
+        threads = []
+        def send_task(*args, **kwargs):
+            threads.append(threading.current_thread())
+        self.mk_send_task.side_effect = send_task
+        plugin_session = tasks.PluginSession('scan', 'session')
+        script = _script({"msg": "issue", "data": {"Summary": "Hello World"}},
+                         {"msg": "finish", "data": {"state": "FINISHED", "failure": ""}})
+        supervisor.run('task-updates', plugin_session, [sys.executable, '-c', script])
+        self.assertEqual(2, len(threads))
+        self.assertFalse(supervisor._thread in threads)
+
+    def test_malformed_output_fails_the_session(self):
+        plugin_session = tasks.PluginSession('scan', 'session')
+        with self.assertRaises(ValueError):
+            supervisor.run('task-malformed', plugin_session,
+                           [sys.executable, '-c', "print 'this is not json'\nimport time\ntime.sleep(30)\n"])
+
+    def test_runner_that_dies_fails_the_session(self):
+        plugin_session = tasks.PluginSession('scan', 'session')
+        status = supervisor.run('task-dies', plugin_session,
+                                [sys.executable, '-c', "import sys\nsys.stderr.write('Segmentation fault')\nsys.exit(11)"])
+        self.assertEqual(11, status)
+        self.assertEqual('FAILED', plugin_session.end())
+        failure = self._sent('session_finish')[0][4]
+        self.assertEqual('Segmentation fault', failure['stderr'])
+
+    @patch('minion.backend.tasks.supervisor')
+    @patch('minion.backend.tasks.get_scan_state')
+    def test_run_plugin_in_a_task_thread_uses_the_supervisor(self, mk_get_scan, mk_supervisor):
+        mk_get_scan.return_value = {
+            'id': 'scan', 'state': 'STARTED',
+            'sessions': [{'id': 'session', 'state': 'QUEUED', 'configuration': {},
+                          'plugin': {'class': 'minion.plugins.test.HelloWorldPlugin'}}]}
+        thread = threading.Thread(target=tasks.run_plugin, args=('scan', 'session'))
+        thread.start()
+        thread.join()
+        self.assertEqual(True, self._sent('session_start')[0][3])
+        arguments = mk_supervisor.run.call_args[0][2]
+        self.assertEqual(['minion-plugin-runner', '-c', '{}', '-p', 'minion.plugins.test.HelloWorldPlugin',
+                          '-s', 'session', '--scan-id', 'scan'], arguments)
@@ -0,0 +1,244 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import unittest
+from mock import MagicMock, patch
+
+from minion.backend import tasks
+
+class Retry(Exception):
+    pass
+
+class TestOrderedSessionUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.scans', create=True)
+        self._mk2 = patch('minion.backend.tasks.send_task')
+
+        self.mocks = [self._mk1, self._mk2]
+
+        self.mk_scans = self._mk1.start()
+        self.mk_send_task = self._mk2.start()
+
+        self.task = MagicMock()
+        self.task.request.retries = 0
+        self.task.retry.return_value = Retry()
+
+    def tearDown(self):
+        for mock in self.mocks:
+            mock.stop()
+
+    def _stored_seq(self, seq):
+        self.mk_scans.update.return_value = {'n': 0}
+        self.mk_scans.find_one.return_value = {'sessions': [{'id': 'session', '_seq': seq}]}
+
+    def test_update_without_sequence_is_applied(self):
+        tasks.apply_session_update(self.task, 'scan', 'session', None, {'$set': {'sessions.$.state': 'STARTED'}})
+        self.mk_scans.update.assert_called_once_with({'id': 'scan', 'sessions.id': 'session'},
+                                                     {'$set': {'sessions.$.state': 'STARTED'}})
+
+    def test_update_in_sequence_is_applied_once(self):
+        self.mk_scans.update.return_value = {'n': 1}
+        tasks.apply_session_update(self.task, 'scan', 'session', 3, {'$push': {'sessions.$.issues': {}}})
+        self.mk_scans.update.assert_called_once_with(
+            {'id': 'scan', 'sessions': {'$elemMatch': {'id': 'session', '_seq': 2}}},
+            {'$push': {'sessions.$.issues': {}}, '$set': {'sessions.$._seq': 3}})
+
+    def test_first_update_expects_no_sequence(self):
+        self.mk_scans.update.return_value = {'n': 1}
+        tasks.apply_session_update(self.task, 'scan', 'session', 1, {})
+        query = self.mk_scans.update.call_args[0][0]
+        self.assertEqual(None, query['sessions']['$elemMatch']['_seq'])
+
+    def test_early_update_is_retried(self):
+        self._stored_seq(1)
+        self.assertRaises(Retry, tasks.apply_session_update, self.task, 'scan', 'session', 3, {})
+        self.assertEqual(1, self.mk_scans.update.call_count)
+
+    def test_duplicate_update_is_dropped(self):
+        self._stored_seq(3)
+        tasks.apply_session_update(self.task, 'scan', 'session', 2, {})
+        self.assertFalse(self.task.retry.called)
+        self.assertEqual(1, self.mk_scans.update.call_count)
+
+    def test_early_update_is_applied_when_retries_run_out(self):
+        self._stored_seq(1)
+        self.task.request.retries = tasks.ORDERED_UPDATE_RETRIES
+        tasks.apply_session_update(self.task, 'scan', 'session', 3, {'$set': {'sessions.$.progress': {}}})
+        self.assertEqual(2, self.mk_scans.update.call_count)
+        # The sequence is not moved past the missing update
+        self.mk_scans.update.assert_called_with({'id': 'scan', 'sessions.id': 'session'},
+                                                {'$set': {'sessions.$.progress': {}}})
+
+    def test_missing_update_is_applied_after_a_forced_one(self):
+        self._stored_seq(1)
+        self.task.request.retries = tasks.ORDERED_UPDATE_RETRIES
+        tasks.apply_session_update(self.task, 'scan', 'session', 3, {'$inc': {'issue_counts.high': 1}})
+        self.assertEqual(2, self.mk_scans.update.call_count)
+        self.assertEqual({'$inc': {'issue_counts.high': 1}}, self.mk_scans.update.call_args[0][1])
+        self.mk_scans.update.reset_mock()
+        self.mk_scans.update.return_value = {'n': 1}
+        self.task.request.retries = 0
+        tasks.apply_session_update(self.task, 'scan', 'session', 2, {'$set': {'sessions.$.state': 'FINISHED'}})
+        self.mk_scans.update.assert_called_once_with(
+            {'id': 'scan', 'sessions': {'$elemMatch': {'id': 'session', '_seq': 1}}},
+            {'$set': {'sessions.$.state': 'FINISHED', 'sessions.$._seq': 2}})
+
+    def test_finish_keeps_the_state_of_a_finished_session(self):
+        self.mk_scans.find_one.return_value = {'sessions': [{'id': 'session', 'state': 'FAILED', '_seq': 4}]}
+        self.mk_scans.update.return_value = {'n': 1}
+        tasks.session_finish('scan', 'session', 'STOPPED', 1400000000, None, seq=5)
+        self.mk_scans.update.assert_called_once_with(
+            {'id': 'scan', 'sessions': {'$elemMatch': {'id': 'session', '_seq': 4}}},
+            {'$set': {'sessions.$._seq': 5}})
+
+class TestSessionStart(unittest.TestCase):
+
+    @patch('minion.backend.tasks.apply_session_update')
+    def test_threaded_sessions_are_marked(self, mk_apply):
+        tasks.session_start('scan', 'session', 1.0, True, seq=1)
+        self.assertEqual(True, mk_apply.call_args[0][4]['$set']['sessions.$._threaded'])
+        tasks.session_start('scan', 'session', 1.0, seq=1)
+        self.assertFalse('sessions.$._threaded' in mk_apply.call_args[0][4]['$set'])
+
+class TestSessionUpdates(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self.mk_send_task = self._mk1.start()
+
+    def tearDown(self):
+        self._mk1.stop()
+
+    def test_updates_are_numbered_and_only_the_last_is_waited_for(self):
+        results = [MagicMock(), MagicMock()]
+        self.mk_send_task.side_effect = results
+        updates = tasks.SessionUpdates('scan', 'session')
+        updates.send('session_start', 1.0)
+        updates.send('session_finish', 'FINISHED', 2.0, None)
+        updates.wait()
+        self.assertEqual([1, 2], [c[1]['kwargs']['seq'] for c in self.mk_send_task.call_args_list])
+        self.assertEqual(['scan', 'session', 'FINISHED', 2.0, None], self.mk_send_task.call_args[0][1])
+        self.assertFalse(results[0].get.called)
+        results[1].get.assert_called_once_with(timeout=tasks.SessionUpdates.WAIT_TIMEOUT)
+
+    def test_updates_without_result_are_not_waited_for(self):
+        results = [MagicMock(), MagicMock()]
+        self.mk_send_task.side_effect = results
+        updates = tasks.SessionUpdates('scan', 'session')
+        updates.send('session_finish', 'FINISHED', 2.0, None)
+        updates.send('session_report_progress', {'percentage': 100})
+        updates.wait()
+        self.assertTrue(results[0].get.called)
+        self.assertFalse(results[1].get.called)
+
+class TestIssueBuffer(unittest.TestCase):
+
+    def test_flush_by_count(self):
+        buffer = tasks.IssueBuffer(max_issues=2, max_bytes=1000, max_delay=60)
+        buffer.add({'Summary': 'a'}, 10)
+        self.assertFalse(buffer.should_flush())
+        buffer.add({'Summary': 'b'}, 10)
+        self.assertTrue(buffer.should_flush())
+        self.assertEqual([{'Summary': 'a'}, {'Summary': 'b'}], buffer.flush())
+        self.assertFalse(buffer.should_flush())
+        self.assertEqual([], buffer.flush())
+
+    def test_flush_by_bytes(self):
+        buffer = tasks.IssueBuffer(max_issues=100, max_bytes=100, max_delay=60)
+        buffer.add({'Summary': 'a'}, 60)
+        self.assertFalse(buffer.should_flush())
+        buffer.add({'Summary': 'b'}, 60)
+        self.assertTrue(buffer.should_flush())
+
+    @patch('minion.backend.tasks.time')
+    def test_flush_by_time(self, mk_time):
+        buffer = tasks.IssueBuffer(max_issues=100, max_bytes=1000, max_delay=1.0)
+        mk_time.time.return_value = 100.0
+        buffer.add({'Summary': 'a'}, 10)
+        mk_time.time.return_value = 100.5
+        self.assertFalse(buffer.should_flush())
+        mk_time.time.return_value = 101.0
+        self.assertTrue(buffer.should_flush())
+
+class TestProgressBuffer(unittest.TestCase):
+
+    @patch('minion.backend.tasks.time')
+    def test_only_the_latest_progress_is_flushed_once_per_interval(self, mk_time):
+        buffer = tasks.ProgressBuffer(interval=5.0)
+        mk_time.time.return_value = 100.0
+        self.assertFalse(buffer.should_flush())
+        buffer.add({'percentage': 10})
+        self.assertTrue(buffer.should_flush())
+        self.assertEqual({'percentage': 10}, buffer.flush())
+        buffer.add({'percentage': 20})
+        buffer.add({'percentage': 30})
+        mk_time.time.return_value = 104.0
+        self.assertFalse(buffer.should_flush())
+        mk_time.time.return_value = 105.0
+        self.assertTrue(buffer.should_flush())
+        self.assertEqual({'percentage': 30}, buffer.flush())
+        self.assertEqual(None, buffer.flush())
+
+class TestPluginSessionProgress(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self.mk_send_task = self._mk1.start()
+
+    def tearDown(self):
+        self._mk1.stop()
+
+    def _sent(self, name):
+        return [c[0][1][2:] for c in self.mk_send_task.call_args_list
+                if c[0][0] == 'minion.backend.tasks.' + name]
+
+    def _progress(self, percentage):
+        return json.dumps({'msg': 'progress', 'data': {'percentage': percentage, 'description': 'Scanning'}})
+
+    def test_progress_is_coalesced_and_the_last_one_is_stored_before_finish(self):
+        session = tasks.PluginSession('scan', 'session')
+        for percentage in range(0, 50):
+            session.handle_line(self._progress(percentage))
+            session.tick()
+        session.handle_line(self._progress(50))
+        session.handle_line(json.dumps({'msg': 'finish', 'data': {'state': 'FINISHED', 'failure': None}}))
+        self.assertEqual([[{'percentage': 0, 'description': 'Scanning'}],
+                          [{'percentage': 50, 'description': 'Scanning'}]],
+                         self._sent('session_report_progress'))
+        names = [c[0][0].split('.')[-1] for c in self.mk_send_task.call_args_list]
+        self.assertEqual('session_finish', names[-1])
+
+class TestPluginSessionFinish(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.backend.tasks.send_task')
+        self.mk_send_task = self._mk1.start()
+
+    def tearDown(self):
+        self._mk1.stop()
+
+    def test_unknown_finish_state_fails_the_session_once(self):
+        session = tasks.PluginSession('scan', 'session')
+        session.handle_line(json.dumps({'msg': 'finish', 'data': {'state': 'DONE', 'failure': None}}))
+        self.assertEqual('FAILED', session.end())
+        finishes = [c[0][1] for c in self.mk_send_task.call_args_list
+                    if c[0][0] == 'minion.backend.tasks.session_finish']
+        self.assertEqual(1, len(finishes))
+        self.assertEqual('FAILED', finishes[0][2])
+        self.assertTrue('DONE' in finishes[0][4]['message'])
+
+class TestStateQueue(unittest.TestCase):
+
+    def test_single_partition_uses_state_queue(self):
+        with patch.dict(tasks.cfg, {'state': {'partitions': 1}}):
+            self.assertEqual('state', tasks.state_queue('a2ae0ab2-3bc3-4dbc-8fd4-2bbd1a8ba3a9'))
+
+    def test_updates_of_a_scan_always_go_to_the_same_partition(self):
+        with patch.dict(tasks.cfg, {'state': {'partitions': 4}}):
+            scan_id = 'a2ae0ab2-3bc3-4dbc-8fd4-2bbd1a8ba3a9'
+            self.assertEqual(tasks.state_queue(scan_id), tasks.state_queue(unicode(scan_id)))
+            queues = set(tasks.state_queue(str(n)) for n in range(100))
+            self.assertEqual(set(['state-0', 'state-1', 'state-2', 'state-3']), queues)
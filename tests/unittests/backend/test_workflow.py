@@ -0,0 +1,74 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend.workflow import ready_sessions, step_dependencies, WorkflowError
+
+def _step(plugin_name, name=None, after=None):
+    step = {'plugin_name': plugin_name, 'description': '', 'configuration': {}}
+    if name is not None:
+        step['name'] = name
+    if after is not None:
+        step['after'] = after
+    return step
+
+def _session(id, state='CREATED', dependencies=None):
+    session = {'id': id, 'state': state}
+    if dependencies is not None:
+        session['dependencies'] = dependencies
+    return session
+
+class TestStepDependencies(unittest.TestCase):
+
+    def test_workflow_without_after_is_sequential(self):
+        workflow = [_step('a.A'), _step('a.B'), _step('a.C')]
+        self.assertEqual([[], [0], [1]], step_dependencies(workflow))
+
+    def test_steps_without_after_start_immediately(self):
+        workflow = [_step('a.Alive', name='alive'),
+                    _step('a.B', after=['alive']),
+                    _step('a.C', after=['alive']),
+                    _step('a.D')]
+        self.assertEqual([[], [0], [0], []], step_dependencies(workflow))
+
+    def test_steps_can_be_referred_to_by_plugin_name(self):
+        workflow = [_step('a.A'), _step('a.B', after=['a.A'])]
+        self.assertEqual([[], [0]], step_dependencies(workflow))
+
+    def test_unknown_step(self):
+        workflow = [_step('a.A'), _step('a.B', after=['cheese'])]
+        self.assertRaises(WorkflowError, step_dependencies, workflow)
+
+    def test_ambiguous_step(self):
+        workflow = [_step('a.A'), _step('a.A'), _step('a.B', after=['a.A'])]
+        self.assertRaises(WorkflowError, step_dependencies, workflow)
+
+    def test_cycle(self):
+        workflow = [_step('a.A', after=['a.B']), _step('a.B', after=['a.A'])]
+        self.assertRaises(WorkflowError, step_dependencies, workflow)
+
+class TestReadySessions(unittest.TestCase):
+
+    def _ids(self, sessions):
+        return [session['id'] for session in sessions]
+
+    def test_parallel_group_becomes_ready_together(self):
+        sessions = [_session('alive', dependencies=[]),
+                    _session('b', dependencies=['alive']),
+                    _session('c', dependencies=['alive'])]
+        self.assertEqual(['alive'], self._ids(ready_sessions(sessions)))
+        sessions[0]['state'] = 'STARTED'
+        self.assertEqual([], self._ids(ready_sessions(sessions)))
+        sessions[0]['state'] = 'FINISHED'
+        self.assertEqual(['b', 'c'], self._ids(ready_sessions(sessions)))
+
+    def test_failed_dependency_is_done(self):
+        sessions = [_session('a', state='FAILED', dependencies=[]),
+                    _session('b', dependencies=['a'])]
+        self.assertEqual(['b'], self._ids(ready_sessions(sessions)))
+
+    def test_sessions_without_dependencies_run_sequentially(self):
+        sessions = [_session('a', state='FINISHED'), _session('b'), _session('c')]
+        self.assertEqual(['b'], self._ids(ready_sessions(sessions)))
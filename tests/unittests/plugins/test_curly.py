@@ -0,0 +1,267 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import BaseHTTPServer
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from mock import MagicMock, patch
+
+import pycurl
+
+import minion.curly
+
+def _response(url, body="<html></html>", status=200):
+    r = minion.curly.HTTPResponse(url)
+    r.status = status
+    r.headers = {'content-type': 'text/html', 'x-frame-options': 'DENY'}
+    r.body = body
+    return minion.curly.Response([r])
+
+class FetchError(Exception):
+    pass
+
+class TestResponseCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        minion.curly.enable_cache(os.path.join(self.directory, 'scan'))
+        self._mk1 = patch('minion.curly._fetch')
+        self.mk_fetch = self._mk1.start()
+        self.mk_fetch.side_effect = lambda url, *args: _response(url)
+
+    def tearDown(self):
+        self._mk1.stop()
+        minion.curly.disable_cache()
+        shutil.rmtree(self.directory)
+
+    def test_same_request_is_fetched_once(self):
+        r1 = minion.curly.get('http://localhost:1234', connect_timeout=5, timeout=15)
+        r2 = minion.curly.get('http://localhost:1234', connect_timeout=5, timeout=15)
+        self.assertEqual(1, self.mk_fetch.call_count)
+        self.assertEqual(r1.body, r2.body)
+        self.assertEqual(r1.status, r2.status)
+        self.assertEqual(r1.headers, r2.headers)
+        self.assertEqual(r1.url, r2.url)
+
+    def test_headers_are_part_of_the_key(self):
+        minion.curly.get('http://localhost:1234')
+        minion.curly.get('http://localhost:1234', headers={'Origin': 'http://example.com'})
+        self.assertEqual(2, self.mk_fetch.call_count)
+
+    def test_expired_response_is_fetched_again(self):
+        minion.curly.get('http://localhost:1234')
+        with patch('minion.curly.time') as mk_time:
+            mk_time.time.return_value = time.time() + 3600
+            minion.curly.get('http://localhost:1234')
+        self.assertEqual(2, self.mk_fetch.call_count)
+
+    def test_errors_are_not_cached(self):
+        self.mk_fetch.side_effect = FetchError()
+        self.assertRaises(FetchError, minion.curly.get, 'http://localhost:1234')
+        self.mk_fetch.side_effect = lambda url, *args: _response(url)
+        minion.curly.get('http://localhost:1234')
+        self.assertEqual(2, self.mk_fetch.call_count)
+
+    def test_curl_errors_are_cached(self):
+        self.mk_fetch.side_effect = minion.curly.CurlyError(7)
+        self.assertRaises(minion.curly.CurlyError, minion.curly.get, 'http://localhost:1234')
+        try:
+            minion.curly.get('http://localhost:1234')
+            self.fail("The cached error was not raised")
+        except minion.curly.CurlyError as e:
+            self.assertEqual(7, e.id)
+        self.assertEqual(1, self.mk_fetch.call_count)
+
+    def test_truncated_response_is_not_used_for_a_full_request(self):
+        self.mk_fetch.side_effect = None
+        response = _response('http://localhost:1234', body="")
+        response.history[-1].truncated = True
+        self.mk_fetch.return_value = response
+        minion.curly.get('http://localhost:1234', headers_only=True)
+        minion.curly.get('http://localhost:1234', headers_only=True)
+        self.assertEqual(1, self.mk_fetch.call_count)
+        minion.curly.get('http://localhost:1234')
+        self.assertEqual(2, self.mk_fetch.call_count)
+
+    def test_full_response_is_used_for_a_headers_only_request(self):
+        minion.curly.get('http://localhost:1234')
+        r = minion.curly.get('http://localhost:1234', headers_only=True)
+        self.assertEqual(1, self.mk_fetch.call_count)
+        self.assertEqual('', r.body)
+        self.assertTrue(r.truncated)
+        self.assertEqual('DENY', r.headers['x-frame-options'])
+
+    def test_cache_size_is_bounded(self):
+        minion.curly.enable_cache(os.path.join(self.directory, 'small'), max_bytes=1000)
+        self.mk_fetch.side_effect = lambda url, *args: _response(url, body="x" * 400)
+        minion.curly.get('http://localhost:1234/a')
+        minion.curly.get('http://localhost:1234/b')
+        entries = [name for name in os.listdir(os.path.join(self.directory, 'small')) if '.' not in name]
+        self.assertEqual(1, len(entries))
+
+    def test_cache_directory_that_others_can_write_to_is_not_used(self):
+        directory = os.path.join(self.directory, 'shared')
+        os.mkdir(directory)
+        os.chmod(directory, 0o777)
+        self.assertRaises(Exception, minion.curly.enable_cache, directory)
+
+    def test_symlinked_cache_directory_is_not_used(self):
+        os.symlink(os.path.join(self.directory, 'scan'), os.path.join(self.directory, 'link'))
+        self.assertRaises(Exception, minion.curly.enable_cache, os.path.join(self.directory, 'link'))
+
+class TestConnectionPool(unittest.TestCase):
+
+    def setUp(self):
+        self._mk1 = patch('minion.curly.pycurl.Curl')
+        self._mk2 = patch.dict('minion.curly._pool', clear=True)
+        self.mk_curl = self._mk1.start()
+        self._mk2.start()
+        self.mk_curl.side_effect = lambda: MagicMock()
+
+    def tearDown(self):
+        self._mk2.stop()
+        self._mk1.stop()
+
+    def test_handle_is_reused_for_the_same_host(self):
+        minion.curly.get('http://localhost:1234/a')
+        minion.curly.get('http://localhost:1234/b', timeout=15)
+        self.assertEqual(1, self.mk_curl.call_count)
+
+    def test_hosts_get_their_own_handles(self):
+        minion.curly.get('http://localhost:1234/')
+        minion.curly.get('https://localhost/')
+        self.assertEqual(2, self.mk_curl.call_count)
+
+    def test_options_are_reset_between_requests(self):
+        minion.curly.get('http://localhost:1234/', headers={'Origin': 'http://example.com'})
+        minion.curly.get('http://localhost:1234/')
+        c = minion.curly._pool[('http', 'localhost', 1234)][0]
+        self.assertEqual(2, c.reset.call_count)
+
+    def test_failed_handle_is_not_reused(self):
+        c = MagicMock()
+        c.perform.side_effect = pycurl.error(7, "Failed to connect")
+        self.mk_curl.side_effect = None
+        self.mk_curl.return_value = c
+        self.assertRaises(Exception, minion.curly.get, 'http://localhost:1234/')
+        self.assertTrue(c.close.called)
+        self.assertEqual({}, minion.curly._pool)
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+
+    # Kept-alive connections are closed after a second without requests
+    timeout = 1
+
+    def do_GET(self):
+        if self.path == '/slow':
+            time.sleep(0.5)
+        if self.path == '/redirect':
+            self.send_response(302)
+            self.send_header('Location', '/')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = 'Hello from ' + self.path
+        if self.path == '/big':
+            body = 'x' * 1024 * 1024
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class Server(BaseHTTPServer.HTTPServer):
+
+    def __init__(self, *args):
+        BaseHTTPServer.HTTPServer.__init__(self, *args)
+        self.threads = []
+
+    def process_request(self, request, client_address):
+        thread = threading.Thread(target=self._process_request, args=(request, client_address))
+        self.threads.append(thread)
+        thread.start()
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            # Clients that stop reading after max_body_bytes close the connection on us
+            pass
+        self.shutdown_request(request)
+
+class TestGetMany(unittest.TestCase):
+
+    def setUp(self):
+        self.server = Server(('127.0.0.1', 0), Handler)
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        for thread in self.server.threads:
+            thread.join()
+
+    def test_all_urls_are_fetched(self):
+        urls = [self.url + '/%d' % n for n in range(20)]
+        results = dict((url, (response, error)) for url, response, error in minion.curly.get_many(urls, concurrency=4))
+        self.assertEqual(set(urls), set(results.keys()))
+        for url, (response, error) in results.items():
+            self.assertEqual(None, error)
+            self.assertEqual(200, response.status)
+            self.assertEqual('Hello from /' + url.split('/')[-1], response.body)
+
+    def test_results_are_returned_as_they_finish(self):
+        urls = [self.url + '/slow', self.url + '/fast']
+        order = [url for url, response, error in minion.curly.get_many(urls)]
+        self.assertEqual([self.url + '/fast', self.url + '/slow'], order)
+
+    def test_redirects_are_followed(self):
+        [(url, response, error)] = list(minion.curly.get_many([self.url + '/redirect']))
+        self.assertEqual([302, 200], [r.status for r in response.history])
+        self.assertEqual(self.url + '/', response.url)
+
+    def test_timeouts_apply_to_every_request(self):
+        [(url, response, error)] = list(minion.curly.get_many([self.url + '/slow'], timeout=0.1))
+        self.assertEqual(None, response)
+        self.assertTrue(error is not None)
+
+    def test_connection_errors_are_returned(self):
+        s = socket.socket()
+        s.bind(('127.0.0.1', 0))
+        url = 'http://127.0.0.1:%d/' % s.getsockname()[1]
+        s.close()
+        results = list(minion.curly.get_many([url, self.url + '/']))
+        errors = dict((url, error) for url, response, error in results)
+        self.assertTrue(errors[url] is not None)
+        self.assertEqual(None, errors[self.url + '/'])
+
+    def test_body_is_cut_off_at_max_body_bytes(self):
+        r = minion.curly.get(self.url + '/big', max_body_bytes=1000)
+        self.assertEqual(200, r.status)
+        self.assertEqual('x' * 1000, r.body)
+        self.assertTrue(r.truncated)
+
+    def test_headers_only(self):
+        [(url, response, error)] = list(minion.curly.get_many([self.url + '/big'], headers_only=True))
+        self.assertEqual(None, error)
+        self.assertEqual(200, response.status)
+        self.assertEqual(str(1024 * 1024), response.headers['content-length'])
+        self.assertEqual('', response.body)
+
+    def test_complete_body_is_not_truncated(self):
+        r = minion.curly.get(self.url + '/big', max_body_bytes=2 * 1024 * 1024)
+        self.assertEqual(1024 * 1024, len(r.body))
+        self.assertFalse(r.truncated)